@@ -0,0 +1,44 @@
+"""
+Redis key schema.
+
+The part of a key in braces is its hash tag. With Redis Cluster, keys sharing a hash tag
+are stored in the same slot, so they can be used together in pipelines, transactions and
+multi-key commands. Keys only used on their own aren't tagged, so they spread across slots.
+"""
+
+# Recently used destinations and WPS Watch sites, updated together
+ACTIVE_DESTINATIONS_KEY = "{wpswatch_dispatcher}.active_destinations"
+UPLOAD_HOSTS_KEY = "{wpswatch_dispatcher}.upload_hosts"
+
+
+def integration_key(kind: str, integration_id) -> str:
+    # All the keys of an integration are cleared at once when it changes
+    return f"{kind}.{{{integration_id}}}"
+
+
+def outbound_detail_key(integration_id) -> str:
+    return integration_key("outbound_detail", integration_id)
+
+
+def inbound_detail_key(integration_id) -> str:
+    return integration_key("inbound_detail", integration_id)
+
+
+def integration_details_key(integration_id) -> str:
+    return integration_key("integration_details", integration_id)
+
+
+def image_metadata_key(gundi_id, destination_id) -> str:
+    return f"wps_image_metadata.{gundi_id}.{destination_id}"
+
+
+def rate_limiter_key(url: str) -> str:
+    return f"rate_limiter.{{{url}}}"
+
+
+def circuit_breaker_key(host: str) -> str:
+    return f"circuit_breaker.{{{host}}}"
+
+
+def image_hash_key(destination_id, camera_id, digest: str) -> str:
+    return f"wps_image_hash.{destination_id}.{camera_id}.{digest}"
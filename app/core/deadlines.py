@@ -0,0 +1,105 @@
+import asyncio
+import logging
+import time
+from contextvars import ContextVar
+from typing import Optional
+from . import settings, errors
+
+
+logger = logging.getLogger(__name__)
+
+
+# Smallest timeout given to clients for which 0 means no timeout
+MIN_TIMEOUT_SEC = 0.001
+
+# Monotonic time at which the message being processed must be done
+_deadline: ContextVar[Optional[float]] = ContextVar("deadline", default=None)
+
+
+def start_deadline(seconds: float = None) -> float:
+    """
+    Set the deadline for the message being processed.
+    Tasks created afterwards (i.e. by asyncio.gather) inherit it.
+    """
+    if seconds is None:
+        seconds = settings.MESSAGE_DEADLINE_SEC
+    deadline = time.monotonic() + seconds
+    _deadline.set(deadline)
+    return deadline
+
+
+def get_remaining() -> Optional[float]:
+    """
+    Seconds left before the deadline, or None if there is no deadline set
+    """
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return max(deadline - time.monotonic(), 0.0)
+
+
+def check_deadline(stage: str):
+    if get_remaining() == 0:
+        raise errors.DeadlineExceeded(f"Deadline exceeded before {stage}")
+
+
+def bounded_timeout(timeout: float, minimum: float = 0.0) -> float:
+    """
+    Shorten the timeout of a stage so it doesn't go past the deadline.
+    Clients reading a timeout of 0 as no timeout (i.e. aiohttp) need a positive minimum.
+    """
+    remaining = get_remaining()
+    if remaining is None:
+        return timeout
+    return max(min(timeout, remaining), minimum)
+
+
+async def _wait(awaitable):
+    return await awaitable
+
+
+async def run_with_deadline(awaitable, stage: str):
+    """
+    Await a stage and cancel it if the deadline is reached
+    """
+    remaining = get_remaining()
+    if remaining is None:
+        return await awaitable
+    if remaining == 0:
+        if asyncio.iscoroutine(awaitable):
+            awaitable.close()  # Don't leave it un-awaited
+        raise errors.DeadlineExceeded(f"Deadline exceeded before {stage}")
+    try:
+        return await asyncio.wait_for(_wait(awaitable), timeout=remaining)
+    except asyncio.TimeoutError as e:
+        if get_remaining():  # Timeout raised by the stage itself
+            raise e
+        raise errors.DeadlineExceeded(f"Deadline exceeded during {stage}")
+
+
+async def cancel_on_disconnect(request, awaitable):
+    """
+    Await the processing of a request, cancelling it when the push client disconnects
+    (i.e. Pub/Sub gave up waiting) or when the deadline is reached.
+    """
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait(
+                {task}, timeout=settings.DISCONNECT_POLL_INTERVAL_SEC
+            )
+            if done:
+                return task.result()
+            if get_remaining() == 0:
+                raise errors.DeadlineExceeded(
+                    "Deadline exceeded processing the message"
+                )
+            if await request.is_disconnected():
+                raise errors.ClientDisconnected(
+                    "Client disconnected before the message was processed"
+                )
+    finally:
+        if not task.done():
+            logger.warning("Cancelling in-flight processing of the message")
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
@@ -16,3 +16,27 @@ class DispatcherException(Exception):
 
 class TooManyRequests(Exception):
     pass
+
+
+class CircuitBreakerOpen(Exception):
+    pass
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+class DuplicateImage(Exception):
+    pass
+
+
+class BulkheadFull(TooManyRequests):
+    pass
+
+
+class ByteBudgetExceeded(TooManyRequests):
+    pass
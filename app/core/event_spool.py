@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+from . import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class EventSpool:
+    """
+    Append-only SQLite spool for system events that couldn't be published right away.
+    Several processes can share the file: events are claimed for a while before
+    being replayed, so each one is replayed by a single process at a time.
+    """
+
+    def __init__(self, path: str, claim_timeout_sec: float = 60.0):
+        self.path = path
+        self.claim_timeout_sec = claim_timeout_sec
+        self.claimer_id = f"{os.getpid()}-{id(self)}"
+        # SQLite calls are blocking, so they run in a thread. One is enough and avoids locking.
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="spool")
+        self._db = None
+
+    def _get_db(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(
+                self.path, isolation_level=None, check_same_thread=False, timeout=10
+            )
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS events (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    topic TEXT NOT NULL,
+                    payload BLOB NOT NULL,
+                    created_at REAL NOT NULL,
+                    claimed_by TEXT,
+                    claimed_at REAL
+                )
+                """
+            )
+        return self._db
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _append(self, topic: str, payload: bytes):
+        self._get_db().execute(
+            "INSERT INTO events (topic, payload, created_at) VALUES (?, ?, ?)",
+            (topic, payload, time.time()),
+        )
+
+    def _claim_batch(self, limit: int) -> List[Tuple[int, str, bytes]]:
+        db = self._get_db()
+        now = time.time()
+        db.execute(
+            """
+            UPDATE events SET claimed_by = ?, claimed_at = ?
+            WHERE id IN (
+                SELECT id FROM events
+                WHERE claimed_by IS NULL OR claimed_at < ?
+                ORDER BY id LIMIT ?
+            )
+            """,
+            (self.claimer_id, now, now - self.claim_timeout_sec, limit),
+        )
+        return db.execute(
+            "SELECT id, topic, payload FROM events WHERE claimed_by = ? ORDER BY id",
+            (self.claimer_id,),
+        ).fetchall()
+
+    def _delete(self, ids: List[int]):
+        self._get_db().executemany(
+            "DELETE FROM events WHERE id = ?", [(i,) for i in ids]
+        )
+
+    def _unclaim(self, ids: List[int]):
+        self._get_db().executemany(
+            "UPDATE events SET claimed_by = NULL, claimed_at = NULL WHERE id = ?",
+            [(i,) for i in ids],
+        )
+
+    def _count(self) -> int:
+        return self._get_db().execute("SELECT COUNT(*) FROM events").fetchone()[0]
+
+    async def append(self, topic: str, payload: bytes):
+        await self._run(self._append, topic, payload)
+
+    async def claim_batch(self, limit: int) -> List[Tuple[int, str, bytes]]:
+        return await self._run(self._claim_batch, limit)
+
+    async def delete(self, ids: List[int]):
+        await self._run(self._delete, ids)
+
+    async def unclaim(self, ids: List[int]):
+        await self._run(self._unclaim, ids)
+
+    async def count(self) -> int:
+        return await self._run(self._count)
+
+    async def close(self):
+        if self._db is not None:
+            await self._run(self._db.close)
+            self._db = None
+
+
+async def drain(spool: EventSpool, publish, batch_size: int) -> int:
+    """
+    Replay one batch of spooled events, publishing them together by topic.
+    Events are removed once published, or given back to be retried later.
+    """
+    events = await spool.claim_batch(limit=batch_size)
+    events_by_topic = {}
+    for event_id, topic, payload in events:
+        events_by_topic.setdefault(topic, []).append((event_id, payload))
+    published = 0
+    for topic, topic_events in events_by_topic.items():
+        ids = [event_id for event_id, _ in topic_events]
+        try:
+            await publish(topic, [payload for _, payload in topic_events])
+        except Exception as e:
+            logger.warning(
+                f"Error replaying {len(ids)} spooled events to {topic}: {type(e)}: {e}"
+            )
+            await spool.unclaim(ids)
+        else:
+            await spool.delete(ids)
+            published += len(ids)
+    return published
+
+
+async def drain_all(spool: EventSpool, publish, batch_size: int) -> int:
+    """
+    Replay the spooled events batch by batch, until it's empty or publishing fails
+    """
+    total = 0
+    while True:
+        published = await drain(spool, publish, batch_size=batch_size)
+        total += published
+        if published < batch_size:
+            return total
+
+
+async def run_drainer(spool: EventSpool, publish):
+    """
+    Background task replaying spooled events, backing off while publishing fails
+    """
+    interval = settings.EVENTS_SPOOL_DRAIN_INTERVAL_SEC
+    while True:
+        try:
+            published = await drain(
+                spool, publish, batch_size=settings.EVENTS_SPOOL_BATCH_SIZE
+            )
+        except Exception as e:
+            logger.exception(f"Error draining the events spool: {type(e)}: {e}")
+            published = 0
+        if published:
+            logger.info(f"{published} spooled events published")
+            interval = settings.EVENTS_SPOOL_DRAIN_INTERVAL_SEC
+            if published == settings.EVENTS_SPOOL_BATCH_SIZE:
+                continue  # There might be more
+        else:
+            interval = min(interval * 2, settings.EVENTS_SPOOL_MAX_DRAIN_INTERVAL_SEC)
+        await asyncio.sleep(interval)
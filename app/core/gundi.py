@@ -1,4 +1,9 @@
+import asyncio
 import logging
+import time
+from enum import Enum
+from functools import partial
+from typing import Optional, Tuple
 from uuid import UUID
 import backoff
 import httpx
@@ -6,14 +11,27 @@ from gundi_core import schemas
 from app.core import settings
 from app.core.utils import (
     ExtraKeys,
+    LazyClient,
+    find_config_for_action,
     read_config_from_cache_safe,
-    write_config_in_cache_safe,
 )
 from app.core.errors import ReferenceDataError
+from app.core.deadlines import (
+    bounded_timeout,
+    get_remaining,
+    run_with_deadline,
+    start_deadline,
+)
 from gundi_client import PortalApi
 from gundi_core.schemas import v2 as gundi_schemas_v2
 from gundi_client_v2 import GundiClient
-from .utils import redis_client
+from app.core.cache_keys import (
+    inbound_detail_key,
+    integration_details_key,
+    outbound_detail_key,
+)
+from app.core.serialization import construct_model, pack, unpack, versioned_key
+from .utils import get_redis_db, redis_client
 
 logger = logging.getLogger(__name__)
 
@@ -23,8 +41,250 @@ GUNDI_V1 = "v1"
 GUNDI_V2 = "v2"
 
 connect_timeout, read_timeout = settings.DEFAULT_REQUESTS_TIMEOUT
-portal_client = PortalApi(connect_timeout=connect_timeout, data_timeout=read_timeout)
+portal_client = LazyClient(
+    lambda: PortalApi(connect_timeout=connect_timeout, data_timeout=read_timeout)
+)
+# Cached configs are refreshed in the background after the soft TTL, and dropped after the hard TTL
 _cache_ttl = settings.PORTAL_CONFIG_OBJECT_CACHE_TTL
+# Configs are cached in a compact binary format, so this client doesn't decode responses
+_cache_db = LazyClient(partial(get_redis_db, decode_responses=False))
+_cache_hard_ttl = settings.PORTAL_CONFIG_OBJECT_CACHE_HARD_TTL
+_negative_cache_ttl = settings.PORTAL_CONFIG_NEGATIVE_CACHE_TTL
+
+
+class ConfigIssue(str, Enum):
+    NOT_FOUND = "not_found"
+    DECODE_ERROR = "decode_error"
+    MISCONFIGURED = "misconfigured"
+
+
+def _negative_cache_key(cache_key: str) -> str:
+    return f"{cache_key}.invalid"
+
+
+async def raise_if_cached_as_invalid(cache_key: str, extra_dict: dict):
+    """
+    Fail fast for integrations recently found missing or invalid in the portal
+    """
+    reason = await read_config_from_cache_safe(
+        cache_key=_negative_cache_key(cache_key), extra_dict=extra_dict
+    )
+    if reason:
+        message = f"{cache_key} was recently found invalid in the portal ({reason}). Will retry later."
+        logger.warning(message, extra=extra_dict)
+        raise ReferenceDataError(message)
+
+
+async def cache_as_invalid(cache_key: str, reason: ConfigIssue, extra_dict: dict):
+    _local_configs.pop(cache_key, None)
+    try:
+        await redis_client.delete(versioned_key(cache_key))  # Don't keep serving it
+        await redis_client.setex(
+            _negative_cache_key(cache_key), _negative_cache_ttl, reason.value
+        )
+    except Exception as e:
+        logger.warning(
+            f"Error caching {cache_key} as invalid ({reason.value}): {type(e)}: {e}",
+            extra=extra_dict,
+        )
+
+
+def _integration_cache_keys(integration_id: str):
+    return [
+        outbound_detail_key(integration_id),
+        inbound_detail_key(integration_id),
+        integration_details_key(integration_id),
+    ]
+
+
+def _all_integration_cache_keys(integration_id: str):
+    cache_keys = _integration_cache_keys(integration_id)
+    return [
+        *[versioned_key(key) for key in cache_keys],
+        *[_negative_cache_key(key) for key in cache_keys],
+    ]
+
+
+async def invalidate_integration_cache(integration_id: str):
+    """
+    Forget the cached details of an integration, including known issues.
+    To be used when the integration is updated in the portal.
+    Other instances are notified so they drop their in-process copies too.
+    """
+    await redis_client.delete(*_all_integration_cache_keys(integration_id))
+    forget_local_configs(integration_id)
+    await redis_client.publish(settings.CONFIG_INVALIDATION_CHANNEL, integration_id)
+
+
+# In-process copies of the cached configs: (fetched_at, config) by cache key.
+# Only used while subscribed to invalidations, otherwise they could outlive a change.
+_local_configs = {}
+_local_cache_enabled = False
+# Invalidations seen by cache key. Configs read or fetched before the latest
+# invalidation of their key aren't cached again, as they might be outdated.
+_invalidations = {}
+
+
+def get_generation(cache_key: str) -> int:
+    return _invalidations.get(cache_key, 0)
+
+
+def forget_local_configs(integration_id: str):
+    for cache_key in _integration_cache_keys(integration_id):
+        _local_configs.pop(cache_key, None)
+        _invalidations[cache_key] = get_generation(cache_key) + 1
+
+
+def _keep_local_config(cache_key: str, fetched_at: float, config):
+    if not _local_cache_enabled:
+        return
+    _local_configs.pop(cache_key, None)
+    if len(_local_configs) >= settings.LOCAL_CONFIG_CACHE_MAX_ENTRIES:
+        _local_configs.pop(next(iter(_local_configs)))  # Oldest first
+    _local_configs[cache_key] = (fetched_at, config)
+
+
+async def handle_invalidation_message(message: dict):
+    if message.get("type") != "message":
+        return
+    integration_id = message["data"]
+    logger.debug(f"Config invalidation received for integration {integration_id}")
+    forget_local_configs(integration_id)
+    # Changes might be published directly by the portal, so clear the shared cache too
+    await redis_client.delete(*_all_integration_cache_keys(integration_id))
+
+
+async def run_invalidation_listener():
+    """
+    Listen for config changes, keeping in-process copies of configs only while subscribed
+    """
+    global _local_cache_enabled
+    while True:
+        pubsub = redis_client.pubsub()
+        try:
+            await pubsub.subscribe(settings.CONFIG_INVALIDATION_CHANNEL)
+            _local_cache_enabled = True
+            async for message in pubsub.listen():
+                await handle_invalidation_message(message)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(
+                f"Error listening for config invalidations: {type(e)}: {e}. Reconnecting.."
+            )
+            await asyncio.sleep(1)
+        finally:
+            # Changes might be missed until subscribed again
+            _local_cache_enabled = False
+            _local_configs.clear()
+            await pubsub.close()
+
+
+def start_invalidation_listener():
+    if not settings.CONFIG_INVALIDATION_ENABLED:
+        return None
+    return asyncio.ensure_future(run_invalidation_listener())
+
+
+async def stop_invalidation_listener(task):
+    if task and not task.done():
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+async def cache_config(
+    cache_key: str, config, extra_dict: dict, generation: Optional[int] = None
+):
+    """
+    Cache a config along with the time it was fetched from the portal.
+    Configs fetched before an invalidation (i.e. with an older generation) are dropped.
+    """
+    if generation is not None and generation != get_generation(cache_key):
+        logger.debug(f"{cache_key} was invalidated while fetched, not caching it")
+        return
+    fetched_at = time.time()
+    envelope = pack({"fetched_at": fetched_at, "config": config.dict(by_alias=True)})
+    _keep_local_config(cache_key, fetched_at, config)
+    try:
+        await _cache_db.setex(versioned_key(cache_key), _cache_hard_ttl, envelope)
+        if generation is not None and generation != get_generation(cache_key):
+            # Invalidated while writing, the shared cache might have been cleared before it
+            _local_configs.pop(cache_key, None)
+            await _cache_db.delete(versioned_key(cache_key))
+    except Exception as e:
+        logger.warning(
+            f"Error writing integration configuration to Cache: {type(e)}: {e}",
+            extra=extra_dict,
+        )
+
+
+async def read_cached_config(cache_key: str, schema, extra_dict: dict) -> Tuple:
+    """
+    Returns the cached config, if any, and whether it's past the soft TTL
+    """
+    if cache_key in _local_configs:
+        fetched_at, config = _local_configs[cache_key]
+        age = time.time() - fetched_at
+        if age < _cache_hard_ttl:
+            return config, age > _cache_ttl
+        del _local_configs[cache_key]
+    generation = get_generation(cache_key)
+    try:
+        cached = await _cache_db.get(versioned_key(cache_key))
+    except Exception as e:
+        logger.warning(
+            f"Error reading integration configuration from Cache: {type(e)}: {e}",
+            extra=extra_dict,
+        )
+        return None, False
+    if not cached:
+        return None, False
+    envelope = unpack(cached)
+    fetched_at = envelope["fetched_at"]
+    config = construct_model(schema, envelope["config"])  # Trusted, written by us
+    if generation == get_generation(cache_key):  # Not invalidated while reading
+        _keep_local_config(cache_key, fetched_at, config)
+    return config, time.time() - fetched_at > _cache_ttl
+
+
+# Background refreshes in progress by cache key
+_refresh_tasks = {}
+
+
+def refresh_in_background(cache_key: str, fetch):
+    """
+    Fetch a stale config again without making the caller wait.
+    Only one refresh per key runs at a time, and the stale config is kept if it fails.
+    """
+    if cache_key in _refresh_tasks:
+        return
+
+    async def refresh():
+        start_deadline()  # Not bound to the deadline of the message that started it
+        try:
+            await fetch()
+        except Exception as e:
+            logger.warning(
+                f"Error refreshing {cache_key}: {type(e)}: {e}. The cached config is used meanwhile."
+            )
+
+    task = asyncio.ensure_future(refresh())
+    _refresh_tasks[cache_key] = task
+    task.add_done_callback(lambda _: _refresh_tasks.pop(cache_key, None))
+
+
+def find_integration_issue(
+    integration: gundi_schemas_v2.Integration,
+) -> Optional[str]:
+    auth_config = find_config_for_action(
+        configurations=integration.configurations,
+        action_value=gundi_schemas_v2.WPSWatchActions.AUTHENTICATE.value,
+    )
+    if not auth_config:
+        return "Authentication settings are missing"
+    if not auth_config.data.get("api_key"):
+        return "API Key is missing"
+    return None
 
 
 async def get_outbound_config_detail(
@@ -38,11 +298,14 @@ async def get_outbound_config_detail(
         ExtraKeys.OutboundIntId: str(outbound_id),
     }
 
-    cache_key = f"outbound_detail.{outbound_id}"
-    cached = await redis_client.get(cache_key)
+    cache_key = outbound_detail_key(outbound_id)
+    config, is_stale = await read_cached_config(
+        cache_key=cache_key,
+        schema=schemas.OutboundConfiguration,
+        extra_dict=extra_dict,
+    )
 
-    if cached:
-        config = schemas.OutboundConfiguration.parse_raw(cached)
+    if config:
         logger.debug(
             "Using cached outbound integration detail",
             extra={
@@ -51,13 +314,27 @@ async def get_outbound_config_detail(
                 "outbound_detail": config,
             },
         )
+        if is_stale:
+            refresh_in_background(
+                cache_key,
+                partial(_fetch_outbound_config_detail, outbound_id, extra_dict),
+            )
         return config
 
     logger.debug(f"Cache miss for outbound integration detail", extra={**extra_dict})
+    await raise_if_cached_as_invalid(cache_key=cache_key, extra_dict=extra_dict)
+    return await _fetch_outbound_config_detail(outbound_id, extra_dict)
 
+
+async def _fetch_outbound_config_detail(
+    outbound_id: UUID, extra_dict: dict
+) -> schemas.OutboundConfiguration:
+    cache_key = outbound_detail_key(outbound_id)
+    generation = get_generation(cache_key)
     try:
-        response = await portal_client.get_outbound_integration(
-            integration_id=str(outbound_id)
+        response = await run_with_deadline(
+            portal_client.get_outbound_integration(integration_id=str(outbound_id)),
+            stage="outbound integration lookup",
         )
     except httpx.HTTPStatusError as e:
         error = f"HTTPStatusError: {e.response.status_code}, {e.response.text}"
@@ -73,6 +350,8 @@ async def get_outbound_config_detail(
                 ExtraKeys.Url: target_url,
             },
         )
+        if e.response.status_code == httpx.codes.NOT_FOUND:
+            await cache_as_invalid(cache_key, ConfigIssue.NOT_FOUND, extra_dict)
         # Raise again so it's retried later
         raise ReferenceDataError(message)
     except httpx.HTTPError as e:
@@ -99,12 +378,20 @@ async def get_outbound_config_detail(
                 f"Failed decoding response for Outbound Integration Detail",
                 extra={**extra_dict, "resp_text": response},
             )
+            await cache_as_invalid(cache_key, ConfigIssue.DECODE_ERROR, extra_dict)
             raise ReferenceDataError(
                 "Failed decoding response for Outbound Integration Detail"
             )
         else:
-            if config:  # don't cache empty response
-                await redis_client.setex(cache_key, _cache_ttl, config.json())
+            if not config:  # don't cache empty response
+                await cache_as_invalid(cache_key, ConfigIssue.NOT_FOUND, extra_dict)
+                return config
+            if not config.token:
+                message = f"Token for outbound integration {outbound_id} is missing. Please fix the integration setup in the portal."
+                logger.error(message, extra=extra_dict)
+                await cache_as_invalid(cache_key, ConfigIssue.MISCONFIGURED, extra_dict)
+                raise ReferenceDataError(message)
+            await cache_config(cache_key, config, extra_dict, generation=generation)
             return config
 
 
@@ -119,22 +406,39 @@ async def get_inbound_integration_detail(
         ExtraKeys.InboundIntId: str(integration_id),
     }
 
-    cache_key = f"inbound_detail.{integration_id}"
-    cached = await redis_client.get(cache_key)
+    cache_key = inbound_detail_key(integration_id)
+    config, is_stale = await read_cached_config(
+        cache_key=cache_key,
+        schema=schemas.IntegrationInformation,
+        extra_dict=extra_dict,
+    )
 
-    if cached:
-        config = schemas.IntegrationInformation.parse_raw(cached)
+    if config:
         logger.debug(
             "Using cached inbound integration detail",
             extra={**extra_dict, "integration_detail": config},
         )
+        if is_stale:
+            refresh_in_background(
+                cache_key,
+                partial(_fetch_inbound_integration_detail, integration_id, extra_dict),
+            )
         return config
 
     logger.debug(f"Cache miss for inbound integration detai", extra={**extra_dict})
+    await raise_if_cached_as_invalid(cache_key=cache_key, extra_dict=extra_dict)
+    return await _fetch_inbound_integration_detail(integration_id, extra_dict)
 
+
+async def _fetch_inbound_integration_detail(
+    integration_id: UUID, extra_dict: dict
+) -> schemas.IntegrationInformation:
+    cache_key = inbound_detail_key(integration_id)
+    generation = get_generation(cache_key)
     try:
-        response = await portal_client.get_inbound_integration(
-            integration_id=str(integration_id)
+        response = await run_with_deadline(
+            portal_client.get_inbound_integration(integration_id=str(integration_id)),
+            stage="inbound integration lookup",
         )
     except httpx.HTTPStatusError as e:
         error = f"HTTPStatusError: {e.response.status_code}, {e.response.text}"
@@ -148,6 +452,8 @@ async def get_inbound_integration_detail(
                 ExtraKeys.Url: target_url,
             },
         )
+        if e.response.status_code == httpx.codes.NOT_FOUND:
+            await cache_as_invalid(cache_key, ConfigIssue.NOT_FOUND, extra_dict)
         # Raise again so it's retried later
         raise ReferenceDataError(message)
     except httpx.HTTPError as e:
@@ -172,16 +478,21 @@ async def get_inbound_integration_detail(
                 f"Failed decoding response for InboundIntegration Detail",
                 extra={**extra_dict, "resp_text": response},
             )
+            await cache_as_invalid(cache_key, ConfigIssue.DECODE_ERROR, extra_dict)
             raise ReferenceDataError(
                 "Failed decoding response for InboundIntegration Detail"
             )
         else:
             if config:  # don't cache empty response
-                await redis_client.setex(cache_key, _cache_ttl, config.json())
+                await cache_config(cache_key, config, extra_dict, generation=generation)
+            else:
+                await cache_as_invalid(cache_key, ConfigIssue.NOT_FOUND, extra_dict)
             return config
 
 
-@backoff.on_exception(backoff.expo, (httpx.HTTPError,), max_tries=5)
+@backoff.on_exception(
+    backoff.expo, (httpx.HTTPError,), max_tries=5, max_time=get_remaining
+)
 async def get_integration_details(integration_id: str) -> gundi_schemas_v2.Integration:
     """
     Helper function to retrieve integration configurations from Gundi API v2
@@ -196,13 +507,14 @@ async def get_integration_details(integration_id: str) -> gundi_schemas_v2.Integ
     }
 
     # Retrieve from cache if possible
-    cache_key = f"integration_details.{integration_id}"
-    cached = await read_config_from_cache_safe(
-        cache_key=cache_key, extra_dict=extra_dict
+    cache_key = integration_details_key(integration_id)
+    config, is_stale = await read_cached_config(
+        cache_key=cache_key,
+        schema=gundi_schemas_v2.Integration,
+        extra_dict=extra_dict,
     )
 
-    if cached:
-        config = gundi_schemas_v2.Integration.parse_raw(cached)
+    if config:
         logger.debug(
             "Using cached integration details",
             extra={
@@ -211,17 +523,33 @@ async def get_integration_details(integration_id: str) -> gundi_schemas_v2.Integ
                 "integration_detail": config,
             },
         )
+        if is_stale:
+            refresh_in_background(
+                cache_key,
+                partial(_fetch_integration_details, integration_id, extra_dict),
+            )
         return config
 
     # Retrieve details from the portal
     logger.debug(f"Cache miss for integration details.", extra={**extra_dict})
+    await raise_if_cached_as_invalid(cache_key=cache_key, extra_dict=extra_dict)
+    return await _fetch_integration_details(integration_id, extra_dict)
+
+
+async def _fetch_integration_details(
+    integration_id: str, extra_dict: dict
+) -> gundi_schemas_v2.Integration:
+    cache_key = integration_details_key(integration_id)
+    generation = get_generation(cache_key)
     connect_timeout, read_timeout = settings.DEFAULT_REQUESTS_TIMEOUT
     async with GundiClient(
-        connect_timeout=connect_timeout, data_timeout=read_timeout
+        connect_timeout=bounded_timeout(connect_timeout),
+        data_timeout=bounded_timeout(read_timeout),
     ) as portal_v2:
         try:
-            integration = await portal_v2.get_integration_details(
-                integration_id=integration_id
+            integration = await run_with_deadline(
+                portal_v2.get_integration_details(integration_id=integration_id),
+                stage="integration lookup",
             )
         # ToDo: Catch more specific exceptions once the gundi client supports them
         except Exception as e:
@@ -230,13 +558,24 @@ async def get_integration_details(integration_id: str) -> gundi_schemas_v2.Integ
                 error_msg,
                 extra=extra_dict,
             )
+            if (
+                isinstance(e, httpx.HTTPStatusError)
+                and e.response.status_code == httpx.codes.NOT_FOUND
+            ):
+                await cache_as_invalid(cache_key, ConfigIssue.NOT_FOUND, extra_dict)
+                raise ReferenceDataError(error_msg)  # Not retried
             raise e
         else:
-            if integration:  # don't cache empty response
-                await write_config_in_cache_safe(
-                    key=cache_key,
-                    ttl=_cache_ttl,
-                    config=integration,
-                    extra_dict=extra_dict,
-                )
+            if not integration:  # don't cache empty response
+                await cache_as_invalid(cache_key, ConfigIssue.NOT_FOUND, extra_dict)
+                return integration
+            issue = find_integration_issue(integration)
+            if issue:
+                error_msg = f"{issue} for integration {integration_id}. Please fix the integration setup in the portal."
+                logger.error(error_msg, extra=extra_dict)
+                await cache_as_invalid(cache_key, ConfigIssue.MISCONFIGURED, extra_dict)
+                raise ReferenceDataError(error_msg)
+            await cache_config(
+                cache_key, integration, extra_dict, generation=generation
+            )
             return integration
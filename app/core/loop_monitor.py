@@ -0,0 +1,117 @@
+import asyncio
+import collections
+import logging
+import sys
+import threading
+import time
+import traceback
+from typing import Optional
+from opentelemetry.metrics import Observation
+from . import metrics, settings
+
+
+logger = logging.getLogger(__name__)
+
+
+# Latest lag measurements in ms, for the percentiles
+_lags = collections.deque(maxlen=settings.LOOP_MONITOR_WINDOW_SIZE)
+# Monotonic time of the last run of the lag monitor in the loop
+_last_tick: Optional[float] = None
+_watchdog: Optional["StallWatchdog"] = None
+
+
+def percentile(samples, pct) -> float:
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * pct / 100), len(samples) - 1)]
+
+
+def _observe_lag(options):
+    if not _lags:
+        return []
+    lags = list(_lags)
+    return [
+        Observation(percentile(lags, 50), {"quantile": "p50"}),
+        Observation(percentile(lags, 99), {"quantile": "p99"}),
+        Observation(max(lags), {"quantile": "max"}),
+    ]
+
+
+metrics.meter.create_observable_gauge(
+    name="event_loop.lag.recent",
+    callbacks=[_observe_lag],
+    unit="ms",
+    description="Percentiles of the latest event loop lag measurements",
+)
+
+
+async def run_lag_monitor(interval: float):
+    """
+    Measure how late the loop wakes up this task, which is how long every other
+    callback waits when something blocks the loop
+    """
+    global _last_tick
+    while True:
+        _last_tick = time.monotonic()
+        await asyncio.sleep(interval)
+        lag_ms = max(time.monotonic() - _last_tick - interval, 0) * 1000
+        _lags.append(lag_ms)
+        metrics.event_loop_lag.record(lag_ms)
+
+
+class StallWatchdog(threading.Thread):
+    """
+    Log the stack of the loop thread when the lag monitor is late past the threshold,
+    pointing to the callback blocking the loop while it's still running.
+    """
+
+    def __init__(self, loop_thread_id: int, interval: float, threshold: float):
+        super().__init__(name="event-loop-watchdog", daemon=True)
+        self.loop_thread_id = loop_thread_id
+        self.interval = interval
+        self.threshold = threshold
+        self._stop_event = threading.Event()
+
+    def run(self):
+        reported_tick = None
+        while not self._stop_event.wait(self.threshold / 2):
+            tick = _last_tick
+            if tick is None or tick == reported_tick:
+                continue  # One report per stall
+            blocked_for = time.monotonic() - tick - self.interval
+            if blocked_for < self.threshold:
+                continue
+            reported_tick = tick
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else "unavailable"
+            metrics.event_loop_stalls.add(1)
+            logger.warning(
+                f"Event loop blocked for over {blocked_for * 1000:.0f} ms. Loop thread stack:\n{stack}"
+            )
+
+    def stop(self):
+        self._stop_event.set()
+
+
+def start_loop_monitor():
+    global _watchdog
+    if not settings.LOOP_MONITOR_ENABLED:
+        return None
+    interval = settings.LOOP_MONITOR_INTERVAL_SEC
+    _watchdog = StallWatchdog(
+        loop_thread_id=threading.get_ident(),
+        interval=interval,
+        threshold=settings.LOOP_SLOW_CALLBACK_THRESHOLD_MS / 1000,
+    )
+    _watchdog.start()
+    return asyncio.ensure_future(run_lag_monitor(interval))
+
+
+async def stop_loop_monitor(task):
+    global _watchdog, _last_tick
+    if _watchdog:
+        _watchdog.stop()
+        _watchdog = None
+    if task and not task.done():
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    _last_tick = None
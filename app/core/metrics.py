@@ -0,0 +1,66 @@
+import logging
+import os
+import socket
+from opentelemetry import metrics
+from app.core import settings
+from app.core.tracing import SERVICE_NAME, SERVICE_VERSION
+
+
+logger = logging.getLogger(__name__)
+
+
+# Measurements are recorded once the meter provider is set up in configure()
+meter = metrics.get_meter(SERVICE_NAME, SERVICE_VERSION)
+_is_configured = False
+
+
+redis_pool_wait_time = meter.create_histogram(
+    name="redis.pool.wait_time",
+    unit="ms",
+    description="Time waited for a connection from the Redis pool",
+)
+event_loop_lag = meter.create_histogram(
+    name="event_loop.lag",
+    unit="ms",
+    description="Delay of the event loop in running a scheduled callback",
+)
+event_loop_stalls = meter.create_counter(
+    name="event_loop.stalls",
+    description="Times the event loop was blocked past the slow callback threshold",
+)
+
+
+def configure():
+    """
+    Set up the metrics export on startup, deferring the SDK and exporter imports
+    """
+    global _is_configured
+    if _is_configured or not settings.METRICS_ENABLED:
+        return
+    from opentelemetry.sdk.metrics import MeterProvider
+    from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
+    from opentelemetry.sdk.resources import Resource
+
+    try:  # Endpoint and headers are set with the standard OTEL_EXPORTER_OTLP_* env vars
+        from opentelemetry.exporter.otlp.proto.http.metric_exporter import (
+            OTLPMetricExporter,
+        )
+    except ImportError as e:
+        logger.warning(f"Metrics export is disabled, the exporter is unavailable: {e}")
+        return
+    reader = PeriodicExportingMetricReader(
+        OTLPMetricExporter(),
+        export_interval_millis=settings.METRICS_EXPORT_INTERVAL_MS,
+    )
+    resource = Resource.create(
+        {
+            "service.name": SERVICE_NAME,
+            "service.version": SERVICE_VERSION,
+            # Each worker process reports its own gauges
+            "service.instance.id": f"{socket.gethostname()}-{os.getpid()}",
+        }
+    )
+    metrics.set_meter_provider(
+        MeterProvider(resource=resource, metric_readers=[reader])
+    )
+    _is_configured = True
@@ -0,0 +1,91 @@
+import asyncio
+import cProfile
+import hmac
+import json
+import logging
+import os
+import random
+import re
+import time
+from contextlib import asynccontextmanager
+from . import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+# cProfile sees every coroutine running in the thread, so one request is profiled at a time
+_is_profiling = False
+
+
+def should_profile(request) -> bool:
+    token = request.headers.get(settings.PROFILING_HEADER)
+    if token and settings.PROFILING_TOKEN:
+        return hmac.compare_digest(token, settings.PROFILING_TOKEN)
+    return random.random() < settings.PROFILING_SAMPLE_RATE
+
+
+def get_tags(body: bytes) -> dict:
+    """
+    Gundi id and destination of the message, to find the profile later
+    """
+    try:
+        attributes = json.loads(body)["message"].get("attributes") or {}
+    except (ValueError, KeyError, TypeError, AttributeError):
+        attributes = {}
+    return {
+        "gundi_id": attributes.get("gundi_id") or "unknown",
+        # Gundi v2 destination or v1 outbound config
+        "destination": attributes.get("destination_id")
+        or attributes.get("outbound_config_id")
+        or "unknown",
+    }
+
+
+def save_profile(profiler: cProfile.Profile, tags: dict, duration_ms: float) -> str:
+    os.makedirs(settings.PROFILING_OUTPUT_DIR, exist_ok=True)
+    name = "_".join(
+        [
+            time.strftime("%Y%m%dT%H%M%S"),
+            re.sub(r"[^\w-]", "", tags["gundi_id"]),
+            re.sub(r"[^\w-]", "", tags["destination"]),
+            f"{duration_ms:.0f}ms",
+        ]
+    )
+    path = os.path.join(settings.PROFILING_OUTPUT_DIR, f"{name}.prof")
+    profiler.dump_stats(path)  # Load it with pstats, snakeviz or convert to speedscope
+    return path
+
+
+@asynccontextmanager
+async def profile_request(request, body: bytes):
+    """
+    Profile the processing of a request if it's sampled or has the profiling token.
+    The stats are written to a pstats file named after the gundi id, destination and duration.
+    """
+    global _is_profiling
+    if _is_profiling or not should_profile(request):
+        yield
+        return
+    _is_profiling = True
+    profiler = cProfile.Profile()
+    start = time.perf_counter()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _is_profiling = False
+        duration_ms = (time.perf_counter() - start) * 1000
+        tags = get_tags(body)
+        try:
+            path = await asyncio.get_running_loop().run_in_executor(
+                None, save_profile, profiler, tags, duration_ms
+            )
+        except Exception as e:
+            logger.warning(f"Error saving the request profile: {type(e)}: {e}")
+        else:
+            logger.info(
+                f"Request profiled in {duration_ms:.0f} ms: {path}",
+                extra={**tags, "duration_ms": duration_ms},
+            )
@@ -0,0 +1,87 @@
+import datetime
+import uuid
+from typing import Any, Optional, Type, TypeVar
+import msgpack
+from pydantic import BaseModel
+from pydantic.fields import SHAPE_LIST, SHAPE_SINGLETON
+
+
+# Part of the cache keys, so entries written in another format are never read.
+# Bump it when the encoding or the cached schemas change.
+CACHE_FORMAT_VERSION = "mp1"
+
+_UUID_EXT = 1
+_DATETIME_EXT = 2
+
+Model = TypeVar("Model", bound=BaseModel)
+
+
+def versioned_key(key: str) -> str:
+    return f"{key}.{CACHE_FORMAT_VERSION}"
+
+
+def _encode_default(value):
+    if isinstance(value, uuid.UUID):
+        return msgpack.ExtType(_UUID_EXT, value.bytes)
+    if isinstance(value, datetime.datetime):
+        return msgpack.ExtType(_DATETIME_EXT, value.isoformat().encode())
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, str):  # i.e. str enums and URLs
+        return str(value)
+    raise TypeError(f"Can't encode {type(value)}")
+
+
+def _decode_ext(code: int, data: bytes):
+    if code == _UUID_EXT:
+        return uuid.UUID(bytes=data)
+    if code == _DATETIME_EXT:
+        return datetime.datetime.fromisoformat(data.decode())
+    return msgpack.ExtType(code, data)
+
+
+def pack(data: Any) -> bytes:
+    return msgpack.packb(data, default=_encode_default, use_bin_type=True)
+
+
+def unpack(data: bytes) -> Any:
+    return msgpack.unpackb(data, ext_hook=_decode_ext, raw=False)
+
+
+def pack_model(model: BaseModel) -> bytes:
+    return pack(model.dict(by_alias=True))
+
+
+def construct_model(schema: Type[Model], values: dict) -> Model:
+    """
+    Build a model and its nested models from trusted values, skipping validation.
+    Only for data produced by pack_model(). Constrained types (i.e. URLs) are kept as plain strings.
+    """
+    fields = {}
+    for name, field in schema.__fields__.items():
+        if field.alias not in values:
+            continue
+        value = values[field.alias]
+        nested = field.type_
+        if (
+            value is not None
+            and isinstance(nested, type)
+            and issubclass(nested, BaseModel)
+        ):
+            if field.shape == SHAPE_SINGLETON:
+                value = construct_model(nested, value)
+            elif field.shape == SHAPE_LIST:
+                value = [construct_model(nested, item) for item in value]
+        fields[name] = value
+    return schema.construct(**fields)
+
+
+def unpack_model(
+    schema: Type[Model], data: Optional[bytes], trusted: bool = True
+) -> Optional[Model]:
+    if not data:
+        return None
+    values = unpack(data)
+    if trusted:
+        return construct_model(schema, values)
+    return schema.parse_obj(values)
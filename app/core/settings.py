@@ -1,5 +1,7 @@
 import logging.config
+import os
 import sys
+import tempfile
 
 from environs import Env
 
@@ -43,16 +45,61 @@ PORTAL_INBOUND_INTEGRATIONS_ENDPOINT = (
 REDIS_HOST = env.str("REDIS_HOST", "localhost")
 REDIS_PORT = env.int("REDIS_PORT", 6379)
 REDIS_DB = env.int("REDIS_DB", 3)
+# standalone (REDIS_HOST/REDIS_PORT), sentinel (REDIS_SENTINELS) or cluster
+REDIS_MODE = env.str("REDIS_MODE", "standalone")
+# Sentinel addresses as host:port, comma separated
+REDIS_SENTINELS = env.list("REDIS_SENTINELS", [])
+REDIS_SENTINEL_SERVICE_NAME = env.str("REDIS_SENTINEL_SERVICE_NAME", "mymaster")
+# Connections shared by all the Redis users of the process
+REDIS_MAX_CONNECTIONS = env.int("REDIS_MAX_CONNECTIONS", 50)
+# Time to wait for a free connection before failing
+REDIS_POOL_TIMEOUT_SEC = env.float("REDIS_POOL_TIMEOUT_SEC", 5.0)
+REDIS_SOCKET_KEEPALIVE = env.bool("REDIS_SOCKET_KEEPALIVE", True)
+# Idle connections are checked with a PING before being used after this time
+REDIS_HEALTH_CHECK_INTERVAL_SEC = env.int("REDIS_HEALTH_CHECK_INTERVAL_SEC", 30)
 
 # N-seconds to cache portal responses for configuration objects.
 PORTAL_CONFIG_OBJECT_CACHE_TTL = env.int("PORTAL_CONFIG_OBJECT_CACHE_TTL", 60)
+# Configs past the TTL above are still used while they are refreshed, up to this age
+PORTAL_CONFIG_OBJECT_CACHE_HARD_TTL = env.int(
+    "PORTAL_CONFIG_OBJECT_CACHE_HARD_TTL", 60 * 10
+)
+# Integrations not found, undecodable or misconfigured are not looked up again for this time
+PORTAL_CONFIG_NEGATIVE_CACHE_TTL = env.int("PORTAL_CONFIG_NEGATIVE_CACHE_TTL", 30)
+# Integration ids published to this Redis channel (i.e. on portal changes) get their cached configs cleared.
+# With invalidations in place, the config TTLs above can be raised to hours.
+CONFIG_INVALIDATION_ENABLED = env.bool("CONFIG_INVALIDATION_ENABLED", False)
+CONFIG_INVALIDATION_CHANNEL = env.str(
+    "CONFIG_INVALIDATION_CHANNEL", "integration_config.invalidations"
+)
+# Configs kept in memory while subscribed to invalidations
+LOCAL_CONFIG_CACHE_MAX_ENTRIES = env.int("LOCAL_CONFIG_CACHE_MAX_ENTRIES", 1000)
 DISPATCHED_OBSERVATIONS_CACHE_TTL = env.int(
     "PORTAL_CONFIG_OBJECT_CACHE_TTL", 60 * 60
 )  # 1 Hour
 
 # Used in OTel traces/spans to set the 'environment' attribute, used on metrics calculation
 TRACING_ENABLED = env.bool("TRACING_ENABLED", True)
+# Metrics are exported with OTLP, set up with the standard OTEL_EXPORTER_OTLP_* env vars
+METRICS_ENABLED = env.bool("METRICS_ENABLED", False)
+METRICS_EXPORT_INTERVAL_MS = env.int("METRICS_EXPORT_INTERVAL_MS", 60000)
 TRACE_ENVIRONMENT = env.str("TRACE_ENVIRONMENT", "dev")
+# Head sampling: "parent_based_ratio", "ratio" or "always_on"
+TRACE_SAMPLER = env.str("TRACE_SAMPLER", "parent_based_ratio")
+TRACE_SAMPLE_RATIO = env.float("TRACE_SAMPLE_RATIO", 1.0)
+# Spans not sampled are still exported if they failed or were slow (0 disables it).
+# Off by default: every span is recorded then, and kept spans are exported without their
+# parents, so they show up as partial traces.
+TRACE_ALWAYS_KEEP_ERRORS = env.bool("TRACE_ALWAYS_KEEP_ERRORS", False)
+TRACE_ALWAYS_KEEP_SLOWER_THAN_MS = env.int("TRACE_ALWAYS_KEEP_SLOWER_THAN_MS", 0)
+# Caps on span attributes, such as message payloads
+TRACE_MAX_ATTRIBUTES = env.int("TRACE_MAX_ATTRIBUTES", 64)
+TRACE_MAX_ATTRIBUTE_LENGTH = env.int("TRACE_MAX_ATTRIBUTE_LENGTH", 1024)
+# Exporter queue and batches
+TRACE_EXPORT_MAX_QUEUE_SIZE = env.int("TRACE_EXPORT_MAX_QUEUE_SIZE", 2048)
+TRACE_EXPORT_SCHEDULE_DELAY_MS = env.int("TRACE_EXPORT_SCHEDULE_DELAY_MS", 5000)
+TRACE_EXPORT_MAX_BATCH_SIZE = env.int("TRACE_EXPORT_MAX_BATCH_SIZE", 512)
+TRACE_EXPORT_TIMEOUT_MS = env.int("TRACE_EXPORT_TIMEOUT_MS", 30000)
 
 # Retries and dead-letter settings
 GCP_PROJECT_ID = env.str("GCP_PROJECT_ID", "cdip-78ca")
@@ -76,7 +123,164 @@ MAX_EVENT_AGE_SECONDS = env.int("MAX_EVENT_AGE_SECONDS", 86400)  # 24hrs
 BUCKET_NAME = env.str("BUCKET_NAME", "cdip-files-dev")
 DELETE_FILES_AFTER_DELIVERY = env.bool("DELETE_FILES_AFTER_DELIVERY", False)
 IMAGE_METADATA_CACHE_TTL = env.int("IMAGE_METADATA_CACHE_TTL", 3600)  # 1 Hour
+# Also keep image metadata as JSON under the unversioned key, as cached by previous versions,
+# so events cached before a deploy or by instances not yet updated are found during a rollout.
+# Can be disabled once every instance is updated and IMAGE_METADATA_CACHE_TTL has passed.
+IMAGE_METADATA_LEGACY_FORMAT_ENABLED = env.bool(
+    "IMAGE_METADATA_LEGACY_FORMAT_ENABLED", True
+)
+# Attachments of the same event are sent together as Attachment1..N in one upload.
+# Only attachments handled by the same process within the wait are batched.
+ATTACHMENT_BATCHING_ENABLED = env.bool("ATTACHMENT_BATCHING_ENABLED", False)
+# Time the first attachment of an event waits for others
+ATTACHMENT_BATCH_MAX_WAIT_SEC = env.float("ATTACHMENT_BATCH_MAX_WAIT_SEC", 2.0)
+ATTACHMENT_BATCH_MAX_SIZE = env.int("ATTACHMENT_BATCH_MAX_SIZE", 5)
+# Images with the same content (SHA-256) sent to a camera within the TTL are skipped
+IMAGE_DEDUP_ENABLED = env.bool("IMAGE_DEDUP_ENABLED", False)
+IMAGE_DEDUP_TTL_SEC = env.int("IMAGE_DEDUP_TTL_SEC", 60 * 60 * 24)
 
 # Requests rate limitting
 MAX_REQUESTS = env.int("MAX_REQUESTS", 3)
 MAX_REQUESTS_TIME_WINDOW_SEC = env.int("MAX_REQUESTS_TIME_WINDOW_SEC", 1)
+
+# Circuit breaker for WPS Watch uploads (one circuit per destination host, shared through Redis)
+CIRCUIT_BREAKER_ENABLED = env.bool("CIRCUIT_BREAKER_ENABLED", True)
+# Consecutive failures that open the circuit
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = env.int("CIRCUIT_BREAKER_FAILURE_THRESHOLD", 5)
+# Failures older than this are forgotten
+CIRCUIT_BREAKER_FAILURE_WINDOW_SEC = env.int("CIRCUIT_BREAKER_FAILURE_WINDOW_SEC", 60)
+# Time the circuit stays open before letting probes through (half-open)
+CIRCUIT_BREAKER_RECOVERY_TIMEOUT_SEC = env.int(
+    "CIRCUIT_BREAKER_RECOVERY_TIMEOUT_SEC", 60
+)
+# Half-open admits 1 probe, plus one more per successful probe, up to this limit
+CIRCUIT_BREAKER_HALF_OPEN_MAX_PROBES = env.int(
+    "CIRCUIT_BREAKER_HALF_OPEN_MAX_PROBES", 5
+)
+# Successful probes needed to close the circuit again
+CIRCUIT_BREAKER_SUCCESS_THRESHOLD = env.int("CIRCUIT_BREAKER_SUCCESS_THRESHOLD", 5)
+
+# Bulkheads: concurrent dispatches per WPS Watch site (in each process), so a slow site
+# can't take the capacity of the others. Dispatches past the queue are rejected for retry.
+BULKHEAD_ENABLED = env.bool("BULKHEAD_ENABLED", True)
+BULKHEAD_MAX_CONCURRENCY = env.int("BULKHEAD_MAX_CONCURRENCY", 10)
+BULKHEAD_MAX_QUEUE = env.int("BULKHEAD_MAX_QUEUE", 20)
+BULKHEAD_MAX_QUEUE_WAIT_SEC = env.float("BULKHEAD_MAX_QUEUE_WAIT_SEC", 5.0)
+
+# Memory budget: bytes of images held at once by the dispatches of the instance, with the sizes
+# taken from the object metadata before downloading. Dispatches waiting past the limit are rejected for retry.
+BYTE_BUDGET_ENABLED = env.bool("BYTE_BUDGET_ENABLED", True)
+# Budget shared evenly by the worker processes of app.serve (0 to use a fraction of the container memory limit)
+BYTE_BUDGET_MAX_BYTES = env.int("BYTE_BUDGET_MAX_BYTES", 0)
+BYTE_BUDGET_MEMORY_FRACTION = env.float("BYTE_BUDGET_MEMORY_FRACTION", 0.25)
+# Budget used when there's no container memory limit
+BYTE_BUDGET_NO_LIMIT_MAX_BYTES = env.int(
+    "BYTE_BUDGET_NO_LIMIT_MAX_BYTES", 256 * 1024 * 1024
+)
+# Budget of each process, set by app.serve for its workers
+BYTE_BUDGET_WORKER_MAX_BYTES = env.int("BYTE_BUDGET_WORKER_MAX_BYTES", 0)
+BYTE_BUDGET_MAX_WAIT_SEC = env.float("BYTE_BUDGET_MAX_WAIT_SEC", 10.0)
+# Size reserved for a file when its metadata can't be read
+BYTE_BUDGET_UNKNOWN_SIZE_BYTES = env.int(
+    "BYTE_BUDGET_UNKNOWN_SIZE_BYTES", 5 * 1024 * 1024
+)
+
+# HTTP client for WPS Watch uploads (shared, so connections are reused across messages)
+WPSWATCH_HTTP2_ENABLED = env.bool("WPSWATCH_HTTP2_ENABLED", False)
+# Time a site failing with HTTP/2 is reached through HTTP/1.1 before trying HTTP/2 again
+WPSWATCH_HTTP1_FALLBACK_SEC = env.float("WPSWATCH_HTTP1_FALLBACK_SEC", 600.0)
+WPSWATCH_MAX_CONNECTIONS = env.int("WPSWATCH_MAX_CONNECTIONS", 100)
+WPSWATCH_MAX_KEEPALIVE_CONNECTIONS = env.int("WPSWATCH_MAX_KEEPALIVE_CONNECTIONS", 20)
+WPSWATCH_KEEPALIVE_EXPIRY_SEC = env.float("WPSWATCH_KEEPALIVE_EXPIRY_SEC", 30.0)
+
+# Timeouts of WPS Watch uploads, scaled to the file size.
+# Can be overridden per destination in the v1 `additional` config or the v2 push config,
+# with the keys upload_connect_timeout_sec, upload_response_timeout_sec,
+# upload_min_throughput_kbps and upload_stall_timeout_sec.
+UPLOAD_CONNECT_TIMEOUT_SEC = env.float(
+    "UPLOAD_CONNECT_TIMEOUT_SEC", 10.0, validate=lambda v: v > 0
+)
+# Time for the site to respond, plus the time to send the file at the minimum throughput
+UPLOAD_RESPONSE_TIMEOUT_SEC = env.float(
+    "UPLOAD_RESPONSE_TIMEOUT_SEC", 10.0, validate=lambda v: v > 0
+)
+UPLOAD_MIN_THROUGHPUT_KBPS = env.float(
+    "UPLOAD_MIN_THROUGHPUT_KBPS", 64.0, validate=lambda v: v > 0
+)
+# Uploads without progress (no data accepted by the connection) for this time are stalled
+UPLOAD_STALL_TIMEOUT_SEC = env.float(
+    "UPLOAD_STALL_TIMEOUT_SEC", 10.0, validate=lambda v: v > 0
+)
+
+# Deadline for processing a message, so work isn't wasted after Pub/Sub stops waiting for the response
+PUBSUB_PUSH_ACK_DEADLINE_SEC = env.int("PUBSUB_PUSH_ACK_DEADLINE_SEC", 60)
+# Time kept to respond before the ack deadline
+MESSAGE_DEADLINE_MARGIN_SEC = env.float("MESSAGE_DEADLINE_MARGIN_SEC", 5.0)
+MESSAGE_DEADLINE_SEC = env.float(
+    "MESSAGE_DEADLINE_SEC", PUBSUB_PUSH_ACK_DEADLINE_SEC - MESSAGE_DEADLINE_MARGIN_SEC
+)
+# How often to check if the push client is still waiting for the response
+DISCONNECT_POLL_INTERVAL_SEC = env.float("DISCONNECT_POLL_INTERVAL_SEC", 0.5)
+
+# Warm-up on startup: Redis connections, recently used WPS Watch sites and integration details
+WARMUP_ENABLED = env.bool("WARMUP_ENABLED", True)
+# The instance reports healthy once the warm-up finishes or after this time
+WARMUP_TIMEOUT_SEC = env.float("WARMUP_TIMEOUT_SEC", 10.0)
+WARMUP_REDIS_CONNECTIONS = env.int("WARMUP_REDIS_CONNECTIONS", 5)
+WARMUP_MAX_DESTINATIONS = env.int("WARMUP_MAX_DESTINATIONS", 20)
+WARMUP_MAX_UPLOAD_HOSTS = env.int("WARMUP_MAX_UPLOAD_HOSTS", 10)
+# Destinations and sites not used within this time are not warmed up
+WARMUP_ACTIVITY_WINDOW_SEC = env.int("WARMUP_ACTIVITY_WINDOW_SEC", 60 * 60 * 24)
+
+# Local spool for system events that can't be published right away, replayed in the background.
+# It's best effort: events still spooled when the instance stops are replayed within the shutdown
+# timeout, and the rest are only kept if EVENTS_SPOOL_PATH is on a durable volume. Without it,
+# the spool is kept in the temp dir, which on Cloud Run is in memory and lost with the instance.
+EVENTS_SPOOL_ENABLED = env.bool("EVENTS_SPOOL_ENABLED", True)
+EVENTS_SPOOL_PATH = env.str("EVENTS_SPOOL_PATH", "")
+EVENTS_SPOOL_SHUTDOWN_TIMEOUT_SEC = env.float("EVENTS_SPOOL_SHUTDOWN_TIMEOUT_SEC", 5.0)
+# Time given to Pub/Sub before spooling the event
+EVENTS_PUBLISH_TIMEOUT_SEC = env.float("EVENTS_PUBLISH_TIMEOUT_SEC", 2.0)
+EVENTS_SPOOL_BATCH_SIZE = env.int("EVENTS_SPOOL_BATCH_SIZE", 100)
+EVENTS_SPOOL_DRAIN_INTERVAL_SEC = env.float("EVENTS_SPOOL_DRAIN_INTERVAL_SEC", 1.0)
+EVENTS_SPOOL_MAX_DRAIN_INTERVAL_SEC = env.float(
+    "EVENTS_SPOOL_MAX_DRAIN_INTERVAL_SEC", 30.0
+)
+# Events claimed by a process that didn't publish them in this time can be replayed by others
+EVENTS_SPOOL_CLAIM_TIMEOUT_SEC = env.float("EVENTS_SPOOL_CLAIM_TIMEOUT_SEC", 60.0)
+
+# System events are published by background workers, off the request path
+EVENTS_EMITTER_QUEUE_SIZE = env.int("EVENTS_EMITTER_QUEUE_SIZE", 1000)
+EVENTS_EMITTER_WORKERS = env.int("EVENTS_EMITTER_WORKERS", 4)
+# Time given to publish the queued events when the service shuts down
+EVENTS_EMITTER_SHUTDOWN_TIMEOUT_SEC = env.float(
+    "EVENTS_EMITTER_SHUTDOWN_TIMEOUT_SEC", 10.0
+)
+
+# Profiling of POST / requests with cProfile, off by default
+# A share of the requests (0 to 1) is profiled
+PROFILING_SAMPLE_RATE = env.float("PROFILING_SAMPLE_RATE", 0.0)
+# Requests with this header set to the token are profiled too (i.e. replayed requests)
+PROFILING_HEADER = env.str("PROFILING_HEADER", "X-Profile-Token")
+PROFILING_TOKEN = env.str("PROFILING_TOKEN", None)
+PROFILING_OUTPUT_DIR = env.str(
+    "PROFILING_OUTPUT_DIR", os.path.join(tempfile.gettempdir(), "profiles")
+)
+
+# Event loop monitor: lag measurements and stacks of callbacks blocking the loop
+LOOP_MONITOR_ENABLED = env.bool("LOOP_MONITOR_ENABLED", True)
+LOOP_MONITOR_INTERVAL_SEC = env.float("LOOP_MONITOR_INTERVAL_SEC", 0.5)
+# The stack of the loop thread is logged when it's blocked for longer than this
+LOOP_SLOW_CALLBACK_THRESHOLD_MS = env.int("LOOP_SLOW_CALLBACK_THRESHOLD_MS", 500)
+# Lag percentiles are reported over the latest measurements
+LOOP_MONITOR_WINDOW_SIZE = env.int("LOOP_MONITOR_WINDOW_SIZE", 120)
+
+# Serving with `python -m app.serve`
+SERVER_HOST = env.str("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = env.int("PORT", 8080)
+# Worker processes, each with its own event loop and clients (0 to use one per available CPU)
+SERVER_WORKERS = env.int("SERVER_WORKERS", 0)
+SERVER_MAX_WORKERS = env.int("SERVER_MAX_WORKERS", 8)
+# uvloop and httptools, or asyncio and h11 (uvicorn defaults)
+SERVER_LOOP = env.str("SERVER_LOOP", "uvloop")
+SERVER_HTTP = env.str("SERVER_HTTP", "httptools")
@@ -1,39 +1,194 @@
 import asyncio
 import json
+import os
+import tempfile
 import aiohttp
 import logging
 import backoff
+from typing import List
 from gundi_core.events import SystemEventBaseModel
 from gcloud.aio import pubsub
 from . import settings
+from .deadlines import bounded_timeout, check_deadline, get_remaining
+from .event_spool import EventSpool, drain_all, run_drainer
 
 
 logger = logging.getLogger(__name__)
 
 
-# Events for other services or system components
-@backoff.on_exception(
-    backoff.expo, (aiohttp.ClientError, asyncio.TimeoutError), max_tries=5
-)
-async def publish_event(event: SystemEventBaseModel, topic_name: str):
-    timeout_settings = aiohttp.ClientTimeout(total=10.0)
+_spool = None
+# Events waiting to be published by the background emitter
+_queue = None
+
+
+def get_spool() -> EventSpool:
+    global _spool
+    if _spool is None:
+        path = settings.EVENTS_SPOOL_PATH
+        if not path:
+            path = os.path.join(tempfile.gettempdir(), "events_spool.sqlite3")
+            logger.warning(
+                f"EVENTS_SPOOL_PATH is not set. Events spooled in {path} are lost if the instance stops before replaying them."
+            )
+        _spool = EventSpool(
+            path=path,
+            claim_timeout_sec=settings.EVENTS_SPOOL_CLAIM_TIMEOUT_SEC,
+        )
+    return _spool
+
+
+async def publish_messages(topic_name: str, payloads: List[bytes], timeout: float):
+    timeout_settings = aiohttp.ClientTimeout(total=timeout)
     async with aiohttp.ClientSession(
         raise_for_status=True, timeout=timeout_settings
     ) as session:
         client = pubsub.PublisherClient(session=session)
-        # Get the topic
         topic = client.topic_path(settings.GCP_PROJECT_ID, topic_name)
-        # Prepare the payload
-        binary_payload = json.dumps(event.dict(), default=str).encode("utf-8")
-        messages = [pubsub.PubsubMessage(binary_payload)]
-        logger.debug(f"Sending event {event} to PubSub topic {topic_name}..")
-        try:  # Send to pubsub
-            response = await client.publish(topic, messages)
+        messages = [pubsub.PubsubMessage(payload) for payload in payloads]
+        response = await client.publish(topic, messages)
+        logger.debug(f"GCP PubSub response: {response}")
+        return response
+
+
+# Events for other services or system components
+async def publish_event(event: SystemEventBaseModel, topic_name: str):
+    if not settings.EVENTS_SPOOL_ENABLED:
+        return await publish_event_with_retries(event=event, topic_name=topic_name)
+    binary_payload = json.dumps(event.dict(), default=str).encode("utf-8")
+    logger.debug(f"Sending event {event} to PubSub topic {topic_name}..")
+    try:  # Single attempt, so Pub/Sub issues don't slow down deliveries
+        check_deadline(stage=f"publishing to {topic_name}")
+        await publish_messages(
+            topic_name=topic_name,
+            payloads=[binary_payload],
+            timeout=bounded_timeout(settings.EVENTS_PUBLISH_TIMEOUT_SEC),
+        )
+    except Exception as e:
+        logger.warning(
+            f"Error publishing system event to topic {topic_name}: {type(e)}: {e}. The event is spooled to be retried."
+        )
+        await get_spool().append(topic=topic_name, payload=binary_payload)
+    else:
+        logger.debug(f"System event {event} published successfully.")
+
+
+@backoff.on_exception(
+    backoff.expo,
+    (aiohttp.ClientError, asyncio.TimeoutError),
+    max_tries=5,
+    max_time=get_remaining,
+)
+async def publish_event_with_retries(event: SystemEventBaseModel, topic_name: str):
+    check_deadline(stage=f"publishing to {topic_name}")
+    # Prepare the payload
+    binary_payload = json.dumps(event.dict(), default=str).encode("utf-8")
+    logger.debug(f"Sending event {event} to PubSub topic {topic_name}..")
+    try:  # Send to pubsub
+        await publish_messages(
+            topic_name=topic_name,
+            payloads=[binary_payload],
+            timeout=bounded_timeout(10.0),
+        )
+    except Exception as e:
+        logger.exception(
+            f"Error publishing system event topic {topic_name}: {e}. This will be retried."
+        )
+        raise e
+    else:
+        logger.debug(f"System event {event} published successfully.")
+
+
+async def _publish_spooled(topic_name: str, payloads: List[bytes]):
+    await publish_messages(topic_name=topic_name, payloads=payloads, timeout=30.0)
+
+
+def start_spool_drainer():
+    if not settings.EVENTS_SPOOL_ENABLED:
+        return None
+    return asyncio.ensure_future(run_drainer(get_spool(), _publish_spooled))
+
+
+async def stop_spool_drainer(task):
+    """
+    Stop replaying in the background, and replay the events left within the shutdown timeout
+    """
+    global _spool
+    if task and not task.done():
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    if _spool is None:
+        return
+    spool, _spool = _spool, None
+    try:
+        await asyncio.wait_for(
+            drain_all(
+                spool, _publish_spooled, batch_size=settings.EVENTS_SPOOL_BATCH_SIZE
+            ),
+            timeout=settings.EVENTS_SPOOL_SHUTDOWN_TIMEOUT_SEC,
+        )
+    except asyncio.TimeoutError:
+        pass
+    except Exception as e:
+        logger.warning(f"Error replaying spooled events on shutdown: {type(e)}: {e}")
+    try:
+        left = await spool.count()
+    except Exception:
+        left = None
+    if left:
+        logger.warning(
+            f"{left} spooled system events weren't published before shutting down. They are kept in {spool.path}."
+        )
+    await spool.close()
+
+
+async def emit_event(event: SystemEventBaseModel, topic_name: str):
+    """
+    Hand the event over to the background emitter, waiting only if its queue is full.
+    Events are published right away when the emitter isn't running.
+    """
+    if _queue is None:
+        return await publish_event(event=event, topic_name=topic_name)
+    await _queue.put((event, topic_name))
+
+
+async def _run_emitter(queue: asyncio.Queue):
+    while True:
+        event, topic_name = await queue.get()
+        try:
+            await publish_event(event=event, topic_name=topic_name)
         except Exception as e:
             logger.exception(
-                f"Error publishing system event topic {topic_name}: {e}. This will be retried."
+                f"Error publishing system event {event} to {topic_name}: {type(e)}: {e}"
+            )
+        finally:
+            queue.task_done()
+
+
+def start_emitter():
+    global _queue
+    _queue = asyncio.Queue(maxsize=settings.EVENTS_EMITTER_QUEUE_SIZE)
+    return [
+        asyncio.ensure_future(_run_emitter(_queue))
+        for _ in range(settings.EVENTS_EMITTER_WORKERS)
+    ]
+
+
+async def stop_emitter(tasks):
+    """
+    Publish the events still queued, within the shutdown timeout, and stop the emitter
+    """
+    global _queue
+    queue, _queue = _queue, None  # New events are published inline from now on
+    if queue is not None and not queue.empty():
+        logger.info(f"Publishing {queue.qsize()} queued system events..")
+        try:
+            await asyncio.wait_for(
+                queue.join(), timeout=settings.EVENTS_EMITTER_SHUTDOWN_TIMEOUT_SEC
+            )
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"{queue.qsize()} system events couldn't be published before shutting down."
             )
-            raise e
-        else:
-            logger.debug(f"System event {event} published successfully.")
-            logger.debug(f"GCP PubSub response: {response}")
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
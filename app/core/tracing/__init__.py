@@ -1,20 +1,58 @@
-from opentelemetry.propagators.cloud_trace_propagator import (
-    CloudTraceFormatPropagator,
-)
-from opentelemetry.propagate import set_global_textmap
-from opentelemetry.instrumentation.aiohttp_client import AioHttpClientInstrumentor
-from opentelemetry.instrumentation.httpx import HTTPXClientInstrumentor
+import reprlib
+from opentelemetry import trace
 from app.core import settings
 from . import config
 from . import pubsub_instrumentation
 
-if settings.TRACING_ENABLED:
-    # Capture requests
-    AioHttpClientInstrumentor().instrument()
-    HTTPXClientInstrumentor().instrument()
-else:
-    AioHttpClientInstrumentor().uninstrument()
-    HTTPXClientInstrumentor().uninstrument()
-# Using the X-Cloud-Trace-Context header
-set_global_textmap(CloudTraceFormatPropagator())
-tracer = config.configure_tracer(name="wpswatch-dispatcher", version="0.1.0")
+SERVICE_NAME = "wpswatch-dispatcher"
+SERVICE_VERSION = "0.1.0"
+
+# Spans are recorded once the tracer provider is set up in configure()
+tracer = trace.get_tracer(SERVICE_NAME, SERVICE_VERSION)
+_is_configured = False
+
+# Bounded repr, so large payloads aren't fully formatted to be truncated afterwards
+_attribute_repr = reprlib.Repr()
+_attribute_repr.maxlevel = 4
+_attribute_repr.maxdict = 20
+_attribute_repr.maxlist = 20
+_attribute_repr.maxstring = 200
+_attribute_repr.maxother = 200
+
+
+def set_bounded_attribute(span, key: str, value):
+    """
+    Set a payload as a span attribute, only if the span is sampled and with a bounded size.
+    Unsampled spans recorded to be kept on errors or when slow are exported without payloads.
+    """
+    if not span.get_span_context().trace_flags.sampled:
+        return
+    span.set_attribute(
+        key, _attribute_repr.repr(value)[: settings.TRACE_MAX_ATTRIBUTE_LENGTH]
+    )
+
+
+def configure():
+    """
+    Set up tracing on startup, deferring the exporter and instrumentation imports
+    """
+    global _is_configured
+    if _is_configured:
+        return
+    from opentelemetry.propagators.cloud_trace_propagator import (
+        CloudTraceFormatPropagator,
+    )
+    from opentelemetry.propagate import set_global_textmap
+    from opentelemetry.instrumentation.aiohttp_client import (
+        AioHttpClientInstrumentor,
+    )
+    from opentelemetry.instrumentation.httpx import HTTPXClientInstrumentor
+
+    if settings.TRACING_ENABLED:
+        # Capture requests
+        AioHttpClientInstrumentor().instrument()
+        HTTPXClientInstrumentor().instrument()
+    # Using the X-Cloud-Trace-Context header
+    set_global_textmap(CloudTraceFormatPropagator())
+    config.configure_tracer(name=SERVICE_NAME, version=SERVICE_VERSION)
+    _is_configured = True
@@ -2,26 +2,125 @@
 from app.core import settings
 from opentelemetry import trace
 from opentelemetry.sdk.resources import Resource
-from opentelemetry.exporter.cloud_trace import CloudTraceSpanExporter
-from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace import TracerProvider, SpanLimits, sampling
 from opentelemetry.sdk.trace.export import BatchSpanProcessor
+from opentelemetry.trace import SpanContext, TraceFlags, StatusCode
+
+
+class RecordUnsampledSampler(sampling.Sampler):
+    """
+    Records the spans dropped by the wrapped sampler without sampling them,
+    so they can still be exported if they end up matching an always-keep rule.
+    """
+
+    def __init__(self, sampler: sampling.Sampler):
+        self._sampler = sampler
+
+    def should_sample(self, parent_context, trace_id, name, *args, **kwargs):
+        result = self._sampler.should_sample(
+            parent_context, trace_id, name, *args, **kwargs
+        )
+        if result.decision == sampling.Decision.DROP:
+            return sampling.SamplingResult(
+                sampling.Decision.RECORD_ONLY, result.attributes, result.trace_state
+            )
+        return result
+
+    def get_description(self):
+        return f"RecordUnsampled{{{self._sampler.get_description()}}}"
+
+
+class _KeptSpan:
+    """
+    Read-only view of an unsampled span, flagged as sampled so it's exported
+    """
+
+    def __init__(self, span):
+        self._span = span
+        context = span.context
+        self.context = SpanContext(
+            trace_id=context.trace_id,
+            span_id=context.span_id,
+            is_remote=context.is_remote,
+            trace_flags=TraceFlags(TraceFlags.SAMPLED),
+            trace_state=context.trace_state,
+        )
+
+    def get_span_context(self):
+        return self.context
+
+    def __getattr__(self, name):
+        return getattr(self._span, name)
+
+
+class KeepErrorsAndSlowSpansProcessor(BatchSpanProcessor):
+    """
+    Exports sampled spans, plus the unsampled ones that failed or were slow.
+    Only the kept spans are exported, not their parents, so their traces are partial.
+    """
+
+    def __init__(self, *args, keep_errors=True, keep_slower_than_ms=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.keep_errors = keep_errors
+        self.keep_slower_than_ns = keep_slower_than_ms * 1_000_000
+
+    def should_keep(self, span) -> bool:
+        if self.keep_errors and span.status.status_code == StatusCode.ERROR:
+            return True
+        if self.keep_slower_than_ns and span.end_time and span.start_time:
+            return span.end_time - span.start_time >= self.keep_slower_than_ns
+        return False
+
+    def on_end(self, span) -> None:
+        if not span.context.trace_flags.sampled and self.should_keep(span):
+            span = _KeptSpan(span)
+        super().on_end(span)
+
+
+def get_sampler() -> sampling.Sampler:
+    if settings.TRACE_SAMPLER == "parent_based_ratio":
+        sampler = sampling.ParentBasedTraceIdRatio(rate=settings.TRACE_SAMPLE_RATIO)
+    elif settings.TRACE_SAMPLER == "ratio":
+        sampler = sampling.TraceIdRatioBased(rate=settings.TRACE_SAMPLE_RATIO)
+    else:
+        sampler = sampling.ALWAYS_ON
+    if settings.TRACE_ALWAYS_KEEP_ERRORS or settings.TRACE_ALWAYS_KEEP_SLOWER_THAN_MS:
+        sampler = RecordUnsampledSampler(sampler)
+    return sampler
 
 
 def configure_tracer(name: str, version: str = ""):
     if settings.TRACING_ENABLED:
+        # Deferred, the Cloud Trace client is slow to import
+        from opentelemetry.exporter.cloud_trace import CloudTraceSpanExporter
+
         resource = Resource.create(
             {
                 "service.name": name,
                 "service.version": version,
             }
         )
-        tracer_provider = TracerProvider(resource=resource)
+        tracer_provider = TracerProvider(
+            resource=resource,
+            sampler=get_sampler(),
+            span_limits=SpanLimits(
+                max_span_attributes=settings.TRACE_MAX_ATTRIBUTES,
+                max_span_attribute_length=settings.TRACE_MAX_ATTRIBUTE_LENGTH,
+            ),
+        )
         cloud_trace_exporter = CloudTraceSpanExporter()
         tracer_provider.add_span_processor(
-            # BatchSpanProcessor buffers spans and sends them in batches in a
-            # background thread. The default parameters are sensible, but can be
-            # tweaked to optimize your performance
-            BatchSpanProcessor(cloud_trace_exporter)
+            # Buffers spans and sends them in batches in a background thread.
+            # Unsampled spans matching an always-keep rule are exported too.
+            KeepErrorsAndSlowSpansProcessor(
+                cloud_trace_exporter,
+                max_queue_size=settings.TRACE_EXPORT_MAX_QUEUE_SIZE,
+                schedule_delay_millis=settings.TRACE_EXPORT_SCHEDULE_DELAY_MS,
+                max_export_batch_size=settings.TRACE_EXPORT_MAX_BATCH_SIZE,
+                export_timeout_millis=settings.TRACE_EXPORT_TIMEOUT_MS,
+                keep_errors=settings.TRACE_ALWAYS_KEEP_ERRORS,
+                keep_slower_than_ms=settings.TRACE_ALWAYS_KEEP_SLOWER_THAN_MS,
+            )
         )
         trace.set_tracer_provider(tracer_provider)
     return trace.get_tracer(name, version)
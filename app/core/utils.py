@@ -1,29 +1,236 @@
 # ToDo: Move base classes or utils into some common package?
+import asyncio
 import base64
+import collections
+import functools
 import json
 import logging
+import time
+from typing import Optional
 import aioredis
+import httpx
 from enum import Enum
+from opentelemetry.metrics import Observation
 from redis import exceptions as redis_exceptions
-from . import settings, errors
+from aioredis.sentinel import Sentinel, SentinelConnectionPool
+from . import settings, errors, metrics
+from .cache_keys import circuit_breaker_key, rate_limiter_key
+from .deadlines import bounded_timeout
 
 
 logger = logging.getLogger(__name__)
 
 
-def get_redis_db():
-    logger.debug(
-        f"Connecting to REDIS DB :{settings.REDIS_DB} at {settings.REDIS_HOST}:{settings.REDIS_PORT}"
-    )
-    return aioredis.from_url(
-        f"redis://{settings.REDIS_HOST}:{settings.REDIS_PORT}/{settings.REDIS_DB}",
+class PoolMetricsMixin:
+    """
+    Keeps track of the connections in use and the callers waiting for one
+    """
+
+    def __init__(self, *args, name: str = "redis", **kwargs):
+        super().__init__(*args, **kwargs)
+        self.name = name
+        self.waiting = 0
+        self._in_use = set()
+
+    @property
+    def in_use(self) -> int:
+        return len(self._in_use)
+
+    async def get_connection(self, command_name, *keys, **options):
+        self.waiting += 1
+        start = time.monotonic()
+        try:
+            connection = await super().get_connection(command_name, *keys, **options)
+        finally:
+            self.waiting -= 1
+            metrics.redis_pool_wait_time.record(
+                (time.monotonic() - start) * 1000, {"pool": self.name}
+            )
+        self._in_use.add(connection)
+        return connection
+
+    async def release(self, connection):
+        self._in_use.discard(connection)
+        await super().release(connection)
+
+
+class MeteredConnectionPool(PoolMetricsMixin, aioredis.BlockingConnectionPool):
+    @property
+    def size(self) -> int:
+        return len(self._connections)
+
+
+class BlockingSentinelConnectionPool(SentinelConnectionPool):
+    """
+    Sentinel pool waiting up to `timeout` for a free connection once all are in use,
+    like BlockingConnectionPool, instead of failing right away with "Too many connections"
+    """
+
+    def __init__(self, *args, timeout: Optional[float] = 20, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def reset(self):
+        super().reset()
+        self._slots = None  # Created on first use, in the running loop
+
+    async def get_connection(self, command_name, *keys, **options):
+        self._checkpid()
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_connections)
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            raise aioredis.ConnectionError("No connection available.")
+        try:
+            return await super().get_connection(command_name, *keys, **options)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    async def release(self, connection):
+        try:
+            await super().release(connection)
+        finally:
+            if self._slots is not None:
+                self._slots.release()
+
+
+class MeteredSentinelConnectionPool(PoolMetricsMixin, BlockingSentinelConnectionPool):
+    @property
+    def size(self) -> int:
+        return self._created_connections
+
+
+def _parse_address(address: str):
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+# Shared pools by response decoding, as it's a connection setting
+_redis_pools = {}
+
+
+def get_redis_pool(decode_responses=True) -> MeteredConnectionPool:
+    if decode_responses in _redis_pools:
+        return _redis_pools[decode_responses]
+    pool_settings = dict(
+        name="text" if decode_responses else "binary",
+        max_connections=settings.REDIS_MAX_CONNECTIONS,
+        socket_keepalive=settings.REDIS_SOCKET_KEEPALIVE,
+        health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL_SEC,
         encoding="utf-8",
-        decode_responses=True,
+        decode_responses=decode_responses,
     )
+    if settings.REDIS_MODE == "standalone":
+        logger.debug(
+            f"Connecting to REDIS DB :{settings.REDIS_DB} at {settings.REDIS_HOST}:{settings.REDIS_PORT}"
+        )
+        pool = MeteredConnectionPool.from_url(
+            f"redis://{settings.REDIS_HOST}:{settings.REDIS_PORT}/{settings.REDIS_DB}",
+            timeout=settings.REDIS_POOL_TIMEOUT_SEC,
+            **pool_settings,
+        )
+    elif settings.REDIS_MODE == "sentinel":
+        logger.debug(
+            f"Connecting to REDIS DB :{settings.REDIS_DB} of {settings.REDIS_SENTINEL_SERVICE_NAME} through sentinels {settings.REDIS_SENTINELS}"
+        )
+        sentinel = Sentinel(
+            [_parse_address(address) for address in settings.REDIS_SENTINELS],
+            socket_keepalive=settings.REDIS_SOCKET_KEEPALIVE,
+        )
+        # Connections follow the master on failover
+        pool = MeteredSentinelConnectionPool(
+            settings.REDIS_SENTINEL_SERVICE_NAME,
+            sentinel,
+            is_master=True,
+            db=settings.REDIS_DB,
+            timeout=settings.REDIS_POOL_TIMEOUT_SEC,
+            **pool_settings,
+        )
+    elif settings.REDIS_MODE == "cluster":
+        # Keys are ready for it (see cache_keys), but aioredis 2.0 has no cluster client
+        raise errors.ConfigurationValidationError(
+            "REDIS_MODE=cluster needs a Redis Cluster client, not available in aioredis 2.0. "
+            "Use standalone or sentinel mode, or a cluster proxy."
+        )
+    else:
+        raise errors.ConfigurationValidationError(
+            f"Unknown REDIS_MODE {settings.REDIS_MODE}. Use standalone, sentinel or cluster."
+        )
+    _redis_pools[decode_responses] = pool
+    return pool
+
+
+async def close_redis_pools():
+    pools = list(_redis_pools.values())
+    _redis_pools.clear()
+    for pool in pools:
+        await pool.disconnect()
+
+
+def _observe_pools(attribute):
+    def callback(options):
+        return [
+            Observation(getattr(pool, attribute), {"pool": pool.name})
+            for pool in _redis_pools.values()
+        ]
+
+    return callback
+
+
+metrics.meter.create_observable_gauge(
+    name="redis.pool.in_use",
+    callbacks=[_observe_pools("in_use")],
+    description="Redis connections in use",
+)
+metrics.meter.create_observable_gauge(
+    name="redis.pool.waiting",
+    callbacks=[_observe_pools("waiting")],
+    description="Callers waiting for a Redis connection",
+)
+metrics.meter.create_observable_gauge(
+    name="redis.pool.size",
+    callbacks=[_observe_pools("size")],
+    description="Redis connections open",
+)
+
+
+def get_redis_db(decode_responses=True):
+    # Clients are cheap, connections come from the shared pool
+    return aioredis.Redis(connection_pool=get_redis_pool(decode_responses))
+
+
+class LazyClient:
+    """
+    Proxy creating the client on first use, so importing the app doesn't open sessions or pools.
+    Closing it (i.e. in the shutdown hook) lets a new client be created on the next use.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._client = None
+
+    @property
+    def is_initialized(self) -> bool:
+        return self._client is not None
+
+    def get_client(self):
+        if self._client is None:
+            self._client = self._factory()
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.get_client(), name)
+
+    async def close(self):
+        if self._client is not None:
+            client, self._client = self._client, None
+            await client.close()
 
 
 _cache_ttl = settings.PORTAL_CONFIG_OBJECT_CACHE_TTL
-redis_client = get_redis_db()
+redis_client = LazyClient(get_redis_db)
 connect_timeout, read_timeout = settings.DEFAULT_REQUESTS_TIMEOUT
 
 
@@ -112,6 +319,7 @@ def find_config_for_action(configurations, action_value):
 class RateLimiterSemaphore:
     def __init__(self, redis_client, url, **kwargs):
         self.url = url
+        self.key = rate_limiter_key(url)
         self.max_requests = kwargs.get("max_requests", settings.MAX_REQUESTS)
         self.max_requests_time_window_sec = kwargs.get(
             "max_requests_time_window_sec", settings.MAX_REQUESTS_TIME_WINDOW_SEC
@@ -133,10 +341,10 @@ class RateLimiterSemaphore:
             - If the number of requests is greater than the limit, raise an exception
         """
         async with self.redis_client.pipeline(transaction=True) as pipe:
-            operations = pipe.incr(self.url)
+            operations = pipe.incr(self.key)
             if auto_release:
                 operations = operations.expire(
-                    self.url, self.max_requests_time_window_sec
+                    self.key, self.max_requests_time_window_sec
                 )
             res = await operations.execute()
         logger.debug(
@@ -152,13 +360,13 @@ class RateLimiterSemaphore:
         Release the semaphore:
             - Decrease the number of requests made in the last time window
         """
-        await self.redis_client.decr(self.url)
+        await self.redis_client.decr(self.key)
 
     async def get_requests_count(self) -> int:
         """
         Get the number of requests made in the last time window
         """
-        count = await self.redis_client.get(self.url)
+        count = await self.redis_client.get(self.key)
         if count:
             return int(count)
         else:
@@ -169,3 +377,466 @@ class RateLimiterSemaphore:
 
     def __repr__(self):
         return self.__str__()
+
+
+# Take a probe slot of a circuit past its recovery timeout, in a single step shared by all
+# the instances: only the first one moves it from open to half-open, and the counters of a
+# circuit already half-open are kept. Returns the state, probes in flight and probes allowed.
+# No slot is taken when the probes in flight returned are 0.
+_TAKE_PROBE_SCRIPT = """
+local circuit = redis.call('HMGET', KEYS[1], 'state', 'opened_at', 'probes', 'successes')
+local state = circuit[1]
+if state == 'open' then
+    if tonumber(ARGV[1]) - tonumber(circuit[2] or '0') < tonumber(ARGV[2]) then
+        return {'open', 0, 0}
+    end
+    redis.call('HSET', KEYS[1], 'state', 'half_open', 'opened_at', ARGV[1], 'probes', 0, 'successes', 0)
+    redis.call('EXPIRE', KEYS[1], ARGV[4])
+    circuit[3] = '0'
+    circuit[4] = '0'
+elseif state ~= 'half_open' then
+    return {'closed', 0, 0}
+end
+local allowed = math.min(1 + tonumber(circuit[4] or '0'), tonumber(ARGV[3]))
+local probes = tonumber(circuit[3] or '0')
+if probes >= allowed then
+    return {'half_open', 0, allowed}
+end
+return {'half_open', redis.call('HINCRBY', KEYS[1], 'probes', 1), allowed}
+"""
+
+# Count a failure, unless another instance opened the circuit already (so its recovery time isn't extended).
+# The circuit opens when the failures reach the threshold or a half-open probe fails.
+# ARGV: now, failure threshold, failure window, TTL of the circuit state. Returns {state, failures, opened}
+_RECORD_FAILURE_SCRIPT = """
+local state = redis.call('HGET', KEYS[1], 'state')
+if state == 'open' then
+    return {'open', 0, 0}
+end
+local failures = 0
+if state ~= 'half_open' then
+    failures = redis.call('HINCRBY', KEYS[1], 'failures', 1)
+    if failures < tonumber(ARGV[2]) then
+        redis.call('EXPIRE', KEYS[1], ARGV[3])
+        return {'closed', failures, 0}
+    end
+end
+redis.call('HSET', KEYS[1], 'state', 'open', 'opened_at', ARGV[1], 'probes', 0, 'successes', 0, 'failures', 0)
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return {'open', failures, 1}
+"""
+
+# Count a success: reset the failures, or free the probe slot and close the circuit once enough probes succeed.
+# A circuit opened or half-opened by another instance meanwhile is left as it is.
+# ARGV: state seen by the caller, success threshold
+_RECORD_SUCCESS_SCRIPT = """
+local state = redis.call('HGET', KEYS[1], 'state')
+if state == 'half_open' and ARGV[1] == 'half_open' then
+    redis.call('HINCRBY', KEYS[1], 'probes', -1)
+    if redis.call('HINCRBY', KEYS[1], 'successes', 1) < tonumber(ARGV[2]) then
+        return 'half_open'
+    end
+elseif state then
+    return state
+end
+redis.call('DEL', KEYS[1])
+return 'closed'
+"""
+
+# Give back a probe slot, if the circuit is still half-open
+_RELEASE_PROBE_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'state') == 'half_open' then
+    return redis.call('HINCRBY', KEYS[1], 'probes', -1)
+end
+return 0
+"""
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker shared by all the dispatcher instances through Redis.
+        - closed: requests go through, consecutive failures are counted
+        - open: requests are rejected until the recovery timeout elapses
+        - half-open: a few probes are let through, one more per successful probe,
+          until enough of them succeed to close the circuit. Any failure opens it again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, redis_client, host, **kwargs):
+        self.host = host
+        self.key = circuit_breaker_key(host)
+        self.enabled = kwargs.get("enabled", settings.CIRCUIT_BREAKER_ENABLED)
+        self.failure_threshold = kwargs.get(
+            "failure_threshold", settings.CIRCUIT_BREAKER_FAILURE_THRESHOLD
+        )
+        self.failure_window_sec = kwargs.get(
+            "failure_window_sec", settings.CIRCUIT_BREAKER_FAILURE_WINDOW_SEC
+        )
+        self.recovery_timeout_sec = kwargs.get(
+            "recovery_timeout_sec", settings.CIRCUIT_BREAKER_RECOVERY_TIMEOUT_SEC
+        )
+        self.half_open_max_probes = kwargs.get(
+            "half_open_max_probes", settings.CIRCUIT_BREAKER_HALF_OPEN_MAX_PROBES
+        )
+        self.success_threshold = kwargs.get(
+            "success_threshold", settings.CIRCUIT_BREAKER_SUCCESS_THRESHOLD
+        )
+        self.redis_client = redis_client
+        self.state = self.CLOSED
+        self.failures = 0
+
+    # Support using this as an async context manager.
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if not self.enabled:
+            return
+        if exc_value is None:
+            await self.record_success()
+        elif self.is_failure(exc_value):
+            await self.record_failure()
+        else:  # Not the destination's fault (i.e. throttled or a download error)
+            await self.release()
+
+    @staticmethod
+    def is_failure(error) -> bool:
+        """
+        Only errors telling that the destination is unreachable or unhealthy count as failures
+        """
+        if isinstance(error, httpx.HTTPStatusError):
+            return error.response.status_code >= 500
+        return isinstance(error, httpx.TransportError)
+
+    async def acquire(self):
+        """
+        Check the circuit before doing any work:
+            - Raise an exception if the circuit is open
+            - Take a probe slot if the circuit is half-open
+        """
+        if not self.enabled:
+            return
+        circuit = await self.redis_client.hgetall(self.key)
+        self.state = circuit.get("state", self.CLOSED)
+        if self.state == self.CLOSED:
+            self.failures = int(circuit.get("failures", 0))
+            return
+        if self.state == self.OPEN:
+            opened_at = float(circuit.get("opened_at", 0))
+            if time.time() - opened_at < self.recovery_timeout_sec:
+                raise errors.CircuitBreakerOpen(
+                    f"Circuit open for {self.host} since {opened_at}. Will retry later."
+                )
+        # Half-open: restore traffic gradually
+        state, probes, allowed_probes = await self.redis_client.eval(
+            _TAKE_PROBE_SCRIPT,
+            1,
+            self.key,
+            time.time(),
+            self.recovery_timeout_sec,
+            self.half_open_max_probes,
+            self.recovery_timeout_sec + self.failure_window_sec,
+        )
+        self.state = state
+        if state == self.CLOSED:  # Closed by another instance meanwhile
+            return
+        if state == self.OPEN:
+            raise errors.CircuitBreakerOpen(
+                f"Circuit opened again for {self.host}. Will retry later."
+            )
+        if not probes:
+            raise errors.CircuitBreakerOpen(
+                f"Circuit half-open for {self.host}: {allowed_probes} probes in flight. Will retry later."
+            )
+        logger.debug(f"{self}: probe {probes}/{allowed_probes} let through")
+
+    async def record_success(self):
+        if self.state == self.CLOSED and not self.failures:
+            return  # Nothing to reset
+        state = await self.redis_client.eval(
+            _RECORD_SUCCESS_SCRIPT,
+            1,
+            self.key,
+            self.state,
+            self.success_threshold,
+        )
+        if self.state == self.HALF_OPEN and state == self.CLOSED:
+            logger.info(f"{self}: circuit closed")
+        self.state = state
+
+    async def record_failure(self):
+        state, failures, opened = await self.redis_client.eval(
+            _RECORD_FAILURE_SCRIPT,
+            1,
+            self.key,
+            time.time(),
+            self.failure_threshold,
+            self.failure_window_sec,
+            self.recovery_timeout_sec + self.failure_window_sec,
+        )
+        if opened and failures:
+            logger.warning(f"{self}: {failures} consecutive failures, circuit opened")
+        elif opened:
+            logger.warning(f"{self}: probe failed, circuit opened again")
+        self.state = state
+        self.failures = failures
+
+    async def release(self):
+        """
+        Give back the probe slot without counting a success or a failure
+        """
+        if self.state == self.HALF_OPEN:
+            await self.redis_client.eval(_RELEASE_PROBE_SCRIPT, 1, self.key)
+
+    def __str__(self):
+        return f"CircuitBreaker<{self.host}>: {self.state}"
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class _BulkheadCompartment:
+    def __init__(self, max_concurrency: int):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.in_use = 0
+        self.queued = 0
+
+
+# Compartments by destination host, local to the process
+_bulkheads = {}
+
+
+class Bulkhead:
+    """
+    Bounded concurrency per destination host, so a slow WPS Watch site can only take
+    its own slots. Once its slots and queue are full, more requests are rejected
+    right away to be retried later, instead of waiting behind the slow ones.
+    """
+
+    def __init__(self, host, **kwargs):
+        self.host = host
+        self.enabled = kwargs.get("enabled", settings.BULKHEAD_ENABLED)
+        self.max_concurrency = kwargs.get(
+            "max_concurrency", settings.BULKHEAD_MAX_CONCURRENCY
+        )
+        self.max_queue = kwargs.get("max_queue", settings.BULKHEAD_MAX_QUEUE)
+        self.max_queue_wait_sec = kwargs.get(
+            "max_queue_wait_sec", settings.BULKHEAD_MAX_QUEUE_WAIT_SEC
+        )
+        self.compartment = None
+
+    # Support using this as an async context manager.
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    async def acquire(self):
+        if not self.enabled:
+            return
+        compartment = _bulkheads.get(self.host)
+        if compartment is None:
+            compartment = _bulkheads[self.host] = _BulkheadCompartment(
+                self.max_concurrency
+            )
+        if compartment.semaphore.locked():
+            if compartment.queued >= self.max_queue:
+                raise errors.BulkheadFull(
+                    f"Bulkhead for {self.host} is full: {compartment.in_use} in progress, {compartment.queued} queued"
+                )
+            compartment.queued += 1
+            try:
+                await asyncio.wait_for(
+                    compartment.semaphore.acquire(),
+                    timeout=bounded_timeout(self.max_queue_wait_sec),
+                )
+            except asyncio.TimeoutError:
+                raise errors.BulkheadFull(
+                    f"Timed out waiting for a slot in the bulkhead for {self.host}"
+                )
+            finally:
+                compartment.queued -= 1
+        else:
+            await compartment.semaphore.acquire()
+        compartment.in_use += 1
+        self.compartment = compartment
+
+    def release(self):
+        if self.compartment is None:
+            return
+        self.compartment.in_use -= 1
+        self.compartment.semaphore.release()
+        self.compartment = None
+
+
+def _observe_bulkheads(attribute):
+    def callback(options):
+        return [
+            Observation(getattr(compartment, attribute), {"host": host})
+            for host, compartment in _bulkheads.items()
+        ]
+
+    return callback
+
+
+metrics.meter.create_observable_gauge(
+    name="bulkhead.in_use",
+    callbacks=[_observe_bulkheads("in_use")],
+    description="Dispatches in progress by destination host",
+)
+metrics.meter.create_observable_gauge(
+    name="bulkhead.queued",
+    callbacks=[_observe_bulkheads("queued")],
+    description="Dispatches waiting for a slot by destination host",
+)
+
+
+@functools.lru_cache(maxsize=None)  # The limit is set when the container starts
+def _cgroup_memory_limit():
+    """
+    Bytes allowed by the container memory limit (cgroup v2 or v1), if there is one
+    """
+    for path in (
+        "/sys/fs/cgroup/memory.max",
+        "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+    ):
+        try:
+            with open(path) as f:
+                limit = f.read().strip()
+        except OSError:
+            continue
+        if limit == "max":
+            return None
+        # cgroup v1 reports a huge number (close to the max int64) when there's no limit
+        return int(limit) if int(limit) < 2**60 else None
+    return None
+
+
+def get_worker_byte_budget(workers: int = 1) -> int:
+    """
+    Share of the instance memory budget for images held by each worker process.
+    Used by app.serve for its workers, and by a process serving alone.
+    """
+    total = settings.BYTE_BUDGET_MAX_BYTES
+    if not total:
+        memory_limit = _cgroup_memory_limit()
+        total = (
+            int(memory_limit * settings.BYTE_BUDGET_MEMORY_FRACTION)
+            if memory_limit
+            else settings.BYTE_BUDGET_NO_LIMIT_MAX_BYTES
+        )
+    return max(total // workers, 1)
+
+
+class _ByteBudgetState:
+    def __init__(self):
+        self.in_use = 0
+        # Reservations waiting for bytes, in arrival order, as [bytes, future]
+        self.waiters = collections.deque()
+
+    @property
+    def waiting(self) -> int:
+        return sum(nbytes for nbytes, _ in self.waiters)
+
+    def wake_up_waiters(self, max_bytes: int):
+        # First come first served, so big files aren't starved by small ones
+        while self.waiters:
+            nbytes, future = self.waiters[0]
+            if future.done():  # Gave up waiting
+                self.waiters.popleft()
+                continue
+            if self.in_use + nbytes > max_bytes:
+                break
+            self.waiters.popleft()
+            self.in_use += nbytes
+            future.set_result(None)
+
+
+# Bytes of images held in memory, shared by all the dispatches of the process
+_byte_budget = _ByteBudgetState()
+
+
+class ByteBudget:
+    """
+    Bound the bytes of images downloaded and being uploaded at the same time in the process,
+    so a burst of big files waits for memory to be freed instead of running out of it.
+    Reservations wait their turn for a while and are rejected to be retried later
+    once the wait is over. A file bigger than the whole budget is sent alone.
+    """
+
+    def __init__(self, nbytes: int, **kwargs):
+        self.enabled = kwargs.get("enabled", settings.BYTE_BUDGET_ENABLED)
+        self.max_bytes = kwargs.get(
+            "max_bytes",
+            settings.BYTE_BUDGET_WORKER_MAX_BYTES or get_worker_byte_budget(),
+        )
+        self.max_wait_sec = kwargs.get(
+            "max_wait_sec", settings.BYTE_BUDGET_MAX_WAIT_SEC
+        )
+        self.nbytes = min(max(nbytes, 0), self.max_bytes)
+        self.reserved = 0
+
+    # Support using this as an async context manager.
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    async def acquire(self):
+        if not self.enabled:
+            return
+        budget = _byte_budget
+        if not budget.waiters and budget.in_use + self.nbytes <= self.max_bytes:
+            budget.in_use += self.nbytes
+            self.reserved = self.nbytes
+            return
+        timeout = bounded_timeout(self.max_wait_sec)
+        if timeout <= 0:
+            raise errors.ByteBudgetExceeded(
+                f"No memory budget for {self.nbytes} bytes: {budget.in_use} bytes in use"
+            )
+        future = asyncio.get_running_loop().create_future()
+        budget.waiters.append([self.nbytes, future])
+        try:
+            await asyncio.wait_for(future, timeout=timeout)
+        except asyncio.TimeoutError:
+            raise errors.ByteBudgetExceeded(
+                f"Timed out waiting for a memory budget of {self.nbytes} bytes: {budget.in_use} bytes in use"
+            )
+        except asyncio.CancelledError as e:
+            if future.done() and not future.cancelled():  # Granted meanwhile
+                budget.in_use -= self.nbytes
+            raise e
+        finally:
+            # Let the ones behind through if this one was first in line
+            budget.wake_up_waiters(self.max_bytes)
+        self.reserved = self.nbytes
+
+    def release(self):
+        if not self.reserved:
+            return
+        _byte_budget.in_use -= self.reserved
+        self.reserved = 0
+        _byte_budget.wake_up_waiters(self.max_bytes)
+
+
+metrics.meter.create_observable_gauge(
+    name="byte_budget.in_use",
+    callbacks=[lambda options: [Observation(_byte_budget.in_use)]],
+    unit="By",
+    description="Bytes of images held in memory by the dispatches in progress",
+)
+metrics.meter.create_observable_gauge(
+    name="byte_budget.waiting",
+    callbacks=[lambda options: [Observation(_byte_budget.waiting)]],
+    unit="By",
+    description="Bytes of images waiting for memory to be freed before being downloaded",
+)
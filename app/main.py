@@ -8,8 +8,23 @@ from fastapi.exceptions import RequestValidationError
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from app.services.process_messages import process_request
-from app.services import dispatchers
-from app.core import utils, gundi
+from app.services import dispatchers, event_handlers, warmup
+from app.core import (
+    utils,
+    gundi,
+    deadlines,
+    tracing,
+    system_events,
+    metrics,
+    profiling,
+    loop_monitor,
+)
+from app.core.errors import (
+    CircuitBreakerOpen,
+    ClientDisconnected,
+    DeadlineExceeded,
+    TooManyRequests,
+)
 
 # For running behind a proxy, we'll want to configure the root path for OpenAPI browser.
 root_path = os.environ.get("ROOT_PATH", "")
@@ -18,11 +33,29 @@ root_path = os.environ.get("ROOT_PATH", "")
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup Hook
+    tracing.configure()
+    metrics.configure()
+    loop_monitor_task = loop_monitor.start_loop_monitor()
+    # Clients are created on first use, the warm-up gets the most used ones ready
+    warmup_task = warmup.start_warmup()
+    # Events that couldn't be published while handling messages are replayed in the background
+    spool_drainer_task = system_events.start_spool_drainer()
+    emitter_tasks = system_events.start_emitter()
+    invalidation_listener_task = gundi.start_invalidation_listener()
     yield
     # Shotdown Hook
+    await warmup.stop_warmup(warmup_task)
+    await loop_monitor.stop_loop_monitor(loop_monitor_task)
+    await gundi.stop_invalidation_listener(invalidation_listener_task)
+    await system_events.stop_emitter(emitter_tasks)
+    await system_events.stop_spool_drainer(spool_drainer_task)
     await gundi.portal_client.close()
     await utils.redis_client.close()
+    await gundi._cache_db.close()
+    await event_handlers._cache_db.close()
+    await utils.close_redis_pools()
     await dispatchers.gcp_storage.close()
+    await dispatchers.close_wpswatch_clients()
 
 
 app = FastAPI(
@@ -56,6 +89,11 @@ logger = logging.getLogger(__name__)
 def health_check(
     request: Request,
 ):
+    if not warmup.is_ready():
+        return JSONResponse(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            content={"status": "warming_up"},
+        )
     return {"status": "healthy"}
 
 
@@ -69,7 +107,36 @@ async def process_cloud_event(
     body = await request.body()
     headers = request.headers
     print(f"Message Received.\n RAW body: {body}\n headers: {headers}")
-    return await process_request(request=request)
+    deadlines.start_deadline()
+    try:
+        async with profiling.profile_request(request=request, body=body):
+            return await deadlines.cancel_on_disconnect(
+                request=request, awaitable=process_request(request=request)
+            )
+    except ClientDisconnected as e:
+        logger.warning(f"Message processing cancelled: {e}")
+        # Nobody is waiting for this response. The message will be redelivered.
+        return JSONResponse(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            content={"status": "cancelled", "reason": str(e)},
+        )
+    except DeadlineExceeded as e:
+        logger.warning(f"Message processing stopped: {e}")
+        # Out of time for this attempt. The message will be redelivered.
+        return JSONResponse(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            content={"status": "deadline_exceeded", "reason": str(e)},
+        )
+    except TooManyRequests as e:  # Rate limited, or no capacity left (i.e. bulkhead full)
+        return JSONResponse(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            content={"status": "throttled", "reason": str(e)},
+        )
+    except CircuitBreakerOpen as e:  # The message will be redelivered
+        return JSONResponse(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            content={"status": "circuit_open", "reason": str(e)},
+        )
 
 
 @app.exception_handler(RequestValidationError)
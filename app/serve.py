@@ -0,0 +1,78 @@
+"""
+Serve the dispatcher with uvicorn, on uvloop and httptools, with one worker process per available CPU.
+
+Each worker imports the app and runs its lifespan on its own, so Redis pools, the GCS and portal
+clients and the WPS Watch connections are created and closed per process.
+
+Usage:
+    python -m app.serve
+"""
+import logging
+import math
+import os
+
+import uvicorn
+from app.core import settings
+from app.core.utils import get_worker_byte_budget
+
+
+logger = logging.getLogger(__name__)
+
+
+def _cgroup_cpu_limit():
+    """
+    CPUs allowed by the container CPU quota (cgroup v2 or v1), if there is one
+    """
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+    except (OSError, ValueError):
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                quota = f.read().strip()
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = f.read().strip()
+        except OSError:
+            return None
+    if quota in ("max", "-1"):
+        return None
+    return max(math.ceil(int(quota) / int(period)), 1)
+
+
+def available_cpus() -> int:
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # Not available on macOS
+        cpus = os.cpu_count() or 1
+    limit = _cgroup_cpu_limit()
+    return min(cpus, limit) if limit else cpus
+
+
+def get_worker_count() -> int:
+    if settings.SERVER_WORKERS > 0:
+        return settings.SERVER_WORKERS
+    return max(min(available_cpus(), settings.SERVER_MAX_WORKERS), 1)
+
+
+def main():
+    workers = get_worker_count()
+    byte_budget = get_worker_byte_budget(workers)
+    # Workers are spawned and read their settings from the environment
+    os.environ["BYTE_BUDGET_WORKER_MAX_BYTES"] = str(byte_budget)
+    logger.info(
+        f"Serving with {workers} worker(s), {settings.SERVER_LOOP} loop and {settings.SERVER_HTTP} HTTP parser, "
+        f"and a budget of {byte_budget} bytes of images per worker"
+    )
+    uvicorn.run(
+        "app.main:app",
+        host=settings.SERVER_HOST,
+        port=settings.SERVER_PORT,
+        workers=workers,
+        loop=settings.SERVER_LOOP,
+        http=settings.SERVER_HTTP,
+        log_config=None,  # Keep the logging set up in settings
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import asyncio
+import contextvars
+import logging
+from typing import Awaitable, Callable, Dict, Hashable, List
+from app.core import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class _Batch:
+    def __init__(self):
+        self.items = []
+        self.future = asyncio.get_running_loop().create_future()
+        # The upload runs with the deadline of the first message of the batch
+        self.context = contextvars.copy_context()
+        self.timer = None
+
+
+class AttachmentBatcher:
+    """
+    Collect the attachments submitted under the same key (i.e. destination and related event)
+    and send them together once the batch is full or the first one has waited long enough.
+    Every submitter gets the result, or the error, of the shared upload.
+    """
+
+    def __init__(self, max_wait: float = None, max_size: int = None):
+        self._max_wait = max_wait
+        self._max_size = max_size
+        self._batches: Dict[Hashable, _Batch] = {}
+
+    @property
+    def max_wait(self) -> float:
+        if self._max_wait is None:
+            return settings.ATTACHMENT_BATCH_MAX_WAIT_SEC
+        return self._max_wait
+
+    @property
+    def max_size(self) -> int:
+        return self._max_size or settings.ATTACHMENT_BATCH_MAX_SIZE
+
+    async def submit(self, key: Hashable, item, send: Callable[[List], Awaitable]):
+        """
+        Add an item to the batch of its key. The send function of the first item is used.
+        """
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = self._batches[key] = _Batch()
+            batch.timer = asyncio.get_running_loop().call_later(
+                self.max_wait, self._flush, key, send
+            )
+        batch.items.append(item)
+        if len(batch.items) >= self.max_size:
+            self._flush(key, send)
+        # A message cancelled while waiting doesn't cancel the upload of the others
+        return await asyncio.shield(batch.future)
+
+    def _flush(self, key: Hashable, send: Callable[[List], Awaitable]):
+        batch = self._batches.pop(key, None)
+        if batch is None:
+            return
+        batch.timer.cancel()
+        logger.debug(f"Sending a batch of {len(batch.items)} attachments for {key}")
+        task = batch.context.run(
+            asyncio.get_running_loop().create_task, send(batch.items)
+        )
+        task.add_done_callback(lambda t: self._set_result(batch.future, t))
+
+    @staticmethod
+    def _set_result(future: asyncio.Future, task: asyncio.Task):
+        if future.cancelled():
+            return
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+
+attachment_batcher = AttachmentBatcher()
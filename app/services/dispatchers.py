@@ -1,17 +1,41 @@
+import asyncio
+import hashlib
 import mimetypes
 import os
+import time
+from typing import List, NamedTuple
 from unittest.mock import AsyncMock
 
 import httpx
 import logging
-from app.core import settings
+from app.core import cache_keys, settings
+from app.core.deadlines import bounded_timeout, run_with_deadline
+from app.core.errors import DeadlineExceeded, DuplicateImage
 from urllib.parse import urlparse
 from gundi_core import schemas
-from gcloud.aio.storage import Storage
-from app.core.utils import RateLimiterSemaphore, redis_client, find_config_for_action
+from app.core.utils import (
+    Bulkhead,
+    ByteBudget,
+    CircuitBreaker,
+    LazyClient,
+    RateLimiterSemaphore,
+    redis_client,
+    find_config_for_action,
+)
+
+
+def sha256_digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def get_storage_client():
+    from gcloud.aio.storage import Storage  # Deferred, it's slow to import
+
+    return Storage()
+
 
 if settings.GCP_ENVIRONMENT_ENABLED:
-    gcp_storage = Storage()
+    gcp_storage = LazyClient(get_storage_client)
 else:
     gcp_storage = AsyncMock()  # Mock for CI/Test environment
 
@@ -20,6 +44,202 @@ logger = logging.getLogger(__name__)
 
 
 DEFAULT_TIMEOUT = (3.1, 20)
+GCS_TIMEOUT = 10
+
+
+class ImagesSent(NamedTuple):
+    """
+    Response of an image upload and the images left out of it, sent to the camera already
+    """
+
+    response: httpx.Response
+    duplicates: List[str]
+
+
+# Shared HTTP clients for WPS Watch, by protocol (True for HTTP/2)
+_wpswatch_clients = {}
+# Sites where HTTP/2 failed, reached through HTTP/1.1 until the (monotonic) time given
+_http1_only_hosts = {}
+
+
+def get_wpswatch_client(http2=None) -> httpx.AsyncClient:
+    """
+    Get the HTTP client used to upload files to WPS Watch.
+    Connections are pooled across messages and with HTTP/2 concurrent uploads
+    to one site are multiplexed over a single connection.
+    """
+    if http2 is None:
+        http2 = settings.WPSWATCH_HTTP2_ENABLED
+    client = _wpswatch_clients.get(http2)
+    if client is None or client.is_closed:
+        limits = httpx.Limits(
+            max_connections=settings.WPSWATCH_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.WPSWATCH_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=settings.WPSWATCH_KEEPALIVE_EXPIRY_SEC,
+        )
+        try:
+            client = httpx.AsyncClient(http2=http2, limits=limits)
+        except ImportError:  # The h2 package is needed for HTTP/2
+            logger.warning("HTTP/2 is not available. Falling back to HTTP/1.1")
+            client = get_wpswatch_client(http2=False)
+        _wpswatch_clients[http2] = client
+    return client
+
+
+async def close_wpswatch_clients():
+    for client in set(_wpswatch_clients.values()):
+        await client.aclose()
+    _wpswatch_clients.clear()
+
+
+# Sorted sets (by last use) read on startup to know what to warm up
+ACTIVE_DESTINATIONS_KEY = cache_keys.ACTIVE_DESTINATIONS_KEY
+UPLOAD_HOSTS_KEY = cache_keys.UPLOAD_HOSTS_KEY
+
+
+async def track_activity(upload_url: str, destination_id=None):
+    """
+    Keep the recently used destinations and WPS Watch sites up to date (best effort)
+    """
+    parsed_url = urlparse(upload_url)
+    now = time.time()
+    forget_before = now - settings.WARMUP_ACTIVITY_WINDOW_SEC
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.zadd(
+                UPLOAD_HOSTS_KEY, {f"{parsed_url.scheme}://{parsed_url.hostname}": now}
+            )
+            pipe.zremrangebyscore(UPLOAD_HOSTS_KEY, 0, forget_before)
+            if destination_id:
+                pipe.zadd(ACTIVE_DESTINATIONS_KEY, {str(destination_id): now})
+                pipe.zremrangebyscore(ACTIVE_DESTINATIONS_KEY, 0, forget_before)
+            await pipe.execute()
+    except Exception as e:
+        logger.warning(f"Error tracking activity for {upload_url}: {type(e)}: {e}")
+
+
+UPLOAD_TIMEOUT_OPTIONS = {
+    "upload_connect_timeout_sec": "UPLOAD_CONNECT_TIMEOUT_SEC",
+    "upload_response_timeout_sec": "UPLOAD_RESPONSE_TIMEOUT_SEC",
+    "upload_min_throughput_kbps": "UPLOAD_MIN_THROUGHPUT_KBPS",
+    "upload_stall_timeout_sec": "UPLOAD_STALL_TIMEOUT_SEC",
+}
+
+
+def get_upload_timeout(size: int, overrides: dict = None) -> httpx.Timeout:
+    """
+    Timeouts to upload `size` bytes, bounded by the message deadline:
+        - write: time a write can go without progress before the upload is stalled
+        - read: time for the response, plus the time to send the file at the minimum
+          throughput, as it can still be on its way from the socket buffers
+    """
+    options = {
+        key: getattr(settings, name) for key, name in UPLOAD_TIMEOUT_OPTIONS.items()
+    }
+    for key, value in (overrides or {}).items():
+        if key not in options:
+            continue
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            number = None
+        if number is None or not number > 0:  # Also rules out NaN
+            logger.warning(f"Ignoring invalid {key} in the destination config: {value}")
+            continue
+        options[key] = number
+    transfer_time = size / (options["upload_min_throughput_kbps"] * 1024)
+    return httpx.Timeout(
+        connect=bounded_timeout(options["upload_connect_timeout_sec"]),
+        read=bounded_timeout(options["upload_response_timeout_sec"] + transfer_time),
+        write=bounded_timeout(options["upload_stall_timeout_sec"]),
+        pool=bounded_timeout(options["upload_connect_timeout_sec"]),
+    )
+
+
+async def get_object_size(file_path: str) -> int:
+    """
+    Size of a file in cloud storage, from its metadata, without downloading it
+    """
+    if not settings.BYTE_BUDGET_ENABLED:
+        return 0  # Only needed for the memory budget
+    try:
+        metadata = await run_with_deadline(
+            gcp_storage.download_metadata(
+                bucket=settings.BUCKET_NAME,
+                object_name=file_path,
+                timeout=bounded_timeout(GCS_TIMEOUT),
+            ),
+            stage="file size check",
+        )
+        return int(metadata["size"])
+    except DeadlineExceeded as e:
+        raise e
+    except Exception as e:
+        logger.warning(
+            f"Error reading the size of '{file_path}' from cloud storage: {type(e)}: {e}"
+        )
+        return settings.BYTE_BUDGET_UNKNOWN_SIZE_BYTES
+
+
+class _TrackedStream(httpx.AsyncByteStream):
+    """
+    Request body telling whether sending it has started
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.started = False
+
+    async def __aiter__(self):
+        self.started = True
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self):
+        await self.stream.aclose()
+
+
+def _use_http2(host) -> bool:
+    if not settings.WPSWATCH_HTTP2_ENABLED:
+        return False
+    http1_until = _http1_only_hosts.get(host)
+    if http1_until is None:
+        return True
+    if time.monotonic() < http1_until:
+        return False
+    del _http1_only_hosts[host]  # Give HTTP/2 another chance
+    return True
+
+
+async def wpswatch_upload(url, **kwargs) -> httpx.Response:
+    """
+    Post to a WPS Watch site through the shared client.
+    Sites not supporting HTTP/2 get HTTP/1.1 through ALPN, and sites failing
+    with HTTP/2 after the negotiation are kept on HTTP/1.1 for a while.
+    Uploads aren't idempotent, so they are only retried if the body wasn't sent.
+    """
+    host = urlparse(url).hostname
+    http2 = _use_http2(host)
+    client = get_wpswatch_client(http2=http2)
+    request = client.build_request("POST", url, **kwargs)
+    request.stream = body = _TrackedStream(request.stream)
+    try:
+        return await client.send(request)
+    except httpx.WriteTimeout as e:
+        logger.warning(f"Upload to {host} stalled, no data was sent in time: {e}")
+        raise e
+    except httpx.RemoteProtocolError as e:
+        if not http2:
+            raise e
+        logger.warning(
+            f"HTTP/2 failed for {host}: {e}. Falling back to HTTP/1.1 for {settings.WPSWATCH_HTTP1_FALLBACK_SEC}s"
+        )
+        _http1_only_hosts[host] = (
+            time.monotonic() + settings.WPSWATCH_HTTP1_FALLBACK_SEC
+        )
+        if body.started:  # Might have been received, it's up to the message retries
+            raise e
+        return await get_wpswatch_client(http2=False).post(url, **kwargs)
 
 
 ########################################################################################
@@ -34,14 +254,24 @@ class WPSWatchCameraTrapDispatcher:
     async def send(self, camera_trap_payload: dict):
         try:
             file_name = camera_trap_payload.get("Attachment1")
-            downloaded_file = await gcp_storage.download(
-                bucket=settings.BUCKET_NAME, object_name=file_name
-            )
-            file_data = self.get_file_data(file_name, downloaded_file)
-            async with RateLimiterSemaphore(
-                redis_client=redis_client, url=str(self.config.endpoint)
-            ):
-                result = await self.wpswatch_post(camera_trap_payload, file_data)
+            host = urlparse(str(self.config.endpoint)).hostname
+            # Reject early if the WPS Watch site is busy or known to be down
+            async with Bulkhead(host=host), CircuitBreaker(
+                redis_client=redis_client, host=host
+            ), ByteBudget(nbytes=await get_object_size(file_name)):
+                downloaded_file = await run_with_deadline(
+                    gcp_storage.download(
+                        bucket=settings.BUCKET_NAME,
+                        object_name=file_name,
+                        timeout=bounded_timeout(GCS_TIMEOUT),
+                    ),
+                    stage="file download",
+                )
+                file_data = self.get_file_data(file_name, downloaded_file)
+                async with RateLimiterSemaphore(
+                    redis_client=redis_client, url=str(self.config.endpoint)
+                ):
+                    result = await self.wpswatch_post(camera_trap_payload, file_data)
         except Exception as e:
             logger.exception(f"Error sending data to WPS Watch {e}")
             raise e
@@ -67,19 +297,25 @@ class WPSWatchCameraTrapDispatcher:
 
         body = camera_trap_payload
         try:
-            connect_timeout, read_timeout = settings.DEFAULT_REQUESTS_TIMEOUT
-            timeout_settings = httpx.Timeout(read_timeout, connect=connect_timeout)
-            async with httpx.AsyncClient(timeout=timeout_settings) as client:
-                response = await client.post(
+            timeout_settings = get_upload_timeout(
+                size=len(file_data[1]) if file_data else 0,
+                overrides=self.config.additional,
+            )
+            response = await run_with_deadline(
+                wpswatch_upload(
                     sanitized_endpoint,
                     data=body,
                     headers=headers,
                     files=files,
-                )
+                    timeout=timeout_settings,
+                ),
+                stage="upload to WPS Watch",
+            )
             response.raise_for_status()
         except httpx.HTTPError as e:
             logger.exception(f"Error occurred posting to WPS Watch {e}", extra=body)
             raise e  # Raise so it's retried
+        await track_activity(upload_url=sanitized_endpoint)
         return response
 
     def get_file_data(self, file_name, file):
@@ -102,7 +338,7 @@ class WPSWatchImageDispatcher:
     def __init__(self, integration):
         self.integration = integration
 
-    async def _wpswatch_post(self, request_data, file_name, file_data):
+    async def _wpswatch_post(self, request_data, attachments):
         # Look for the configuration of the authentication action
         configurations = self.integration.configurations
         integration_action_config = find_config_for_action(
@@ -121,28 +357,55 @@ class WPSWatchImageDispatcher:
         headers = {
             "Wps-Api-Key": api_key,
         }
-        files = {"Attachment1": (file_name, file_data)}
+        # Images are sent as Attachment1..N, as (file name, data)
+        files = {
+            f"Attachment{i}": attachment
+            for i, attachment in enumerate(attachments, start=1)
+        }
         parsed_url = urlparse(self.integration.base_url)
         sanitized_endpoint = f"{parsed_url.scheme}://{parsed_url.hostname}/api/Upload"
+        # Timeouts can be tuned per destination in the push config
+        integration_push_config = find_config_for_action(
+            configurations=configurations,
+            action_value=schemas.v2.WPSWatchActions.PUSH_EVENTS.value,
+        )
+        timeout_overrides = (
+            integration_push_config.data if integration_push_config else {}
+        )
         try:
-            connect_timeout, read_timeout = settings.DEFAULT_REQUESTS_TIMEOUT
-            timeout_settings = httpx.Timeout(read_timeout, connect=connect_timeout)
-            async with httpx.AsyncClient(timeout=timeout_settings) as client:
-                response = await client.post(
+            timeout_settings = get_upload_timeout(
+                size=sum(len(data) for _, data in attachments),
+                overrides=timeout_overrides,
+            )
+            response = await run_with_deadline(
+                wpswatch_upload(
                     sanitized_endpoint,
                     data=request_data,
                     headers=headers,
                     files=files,
-                )
+                    timeout=timeout_settings,
+                ),
+                stage="upload to WPS Watch",
+            )
             response.raise_for_status()
         except httpx.HTTPError as e:
             logger.exception(
                 f"Error occurred posting to WPS Watch Site {sanitized_endpoint} \n {type(e)}: {e}"
             )
             raise e  # Raise so it's retried
+        await track_activity(
+            upload_url=sanitized_endpoint, destination_id=self.integration.id
+        )
         return response
 
     async def send(self, image: schemas.v2.WPSWatchImage, **kwargs):
+        return await self.send_many(images=[image], **kwargs)
+
+    async def send_many(self, images: list, **kwargs) -> ImagesSent:
+        """
+        Send images of the same event in a single upload.
+        Images sent to the camera already are left out, DuplicateImage is raised if all of them are.
+        """
         related_event = kwargs.get("related_event")
         if not related_event:
             raise ValueError("related_observation is required")
@@ -150,10 +413,27 @@ class WPSWatchImageDispatcher:
         if not camera_id:
             raise ValueError("camera_id is required")
 
+        host = urlparse(self.integration.base_url).hostname
+        # Reject early if the WPS Watch site is busy or known to be down
+        async with Bulkhead(host=host), CircuitBreaker(
+            redis_client=redis_client, host=host
+        ):
+            # Wait for memory to hold the images before downloading them
+            sizes = await asyncio.gather(
+                *[get_object_size(image.file_path) for image in images]
+            )
+            async with ByteBudget(nbytes=sum(sizes)):
+                return await self._send(images=images, camera_id=camera_id)
+
+    async def _download(self, file_path: str):
         try:  # Download the Image from GCP
-            file_path = image.file_path
-            downloaded_file = await gcp_storage.download(
-                bucket=settings.BUCKET_NAME, object_name=file_path
+            return await run_with_deadline(
+                gcp_storage.download(
+                    bucket=settings.BUCKET_NAME,
+                    object_name=file_path,
+                    timeout=bounded_timeout(GCS_TIMEOUT),
+                ),
+                stage="file download",
             )
         except Exception as e:
             logger.exception(
@@ -161,6 +441,90 @@ class WPSWatchImageDispatcher:
             )
             raise e
 
+    async def _skip_duplicates(
+        self, file_paths: list, files: list, camera_id: str, claimed_keys: list
+    ):
+        """
+        Claim the content hash of each image for the camera, leaving out the images
+        sent to it already (best effort, images are sent if Redis fails).
+        The keys claimed are added to claimed_keys as they are set.
+        Returns the new images and the paths of the duplicates.
+        """
+        loop = asyncio.get_running_loop()
+        # hashlib releases the GIL, so big images are hashed in parallel off the loop
+        digests = await asyncio.gather(
+            *[loop.run_in_executor(None, sha256_digest, file) for file in files]
+        )
+        new_file_paths, new_files, duplicates = [], [], []
+        for file_path, file, digest in zip(file_paths, files, digests):
+            key = cache_keys.image_hash_key(self.integration.id, camera_id, digest)
+            try:
+                is_new = await redis_client.set(
+                    key, file_path, nx=True, ex=settings.IMAGE_DEDUP_TTL_SEC
+                )
+            except Exception as e:
+                logger.warning(f"Error checking if {file_path} is a duplicate: {e}")
+                is_new = True
+            else:
+                if is_new:
+                    claimed_keys.append(key)
+            if is_new:
+                new_file_paths.append(file_path)
+                new_files.append(file)
+            else:
+                duplicates.append(file_path)
+                logger.info(
+                    f"File {file_path} skipped. The same image was sent to camera {camera_id} already."
+                )
+        if not new_files:
+            raise DuplicateImage(
+                f"Image(s) {', '.join(file_paths)} sent to camera {camera_id} already"
+            )
+        return new_file_paths, new_files, duplicates
+
+    @staticmethod
+    async def _release_claims(claimed_keys: list):
+        try:  # Shielded, so it completes even if the dispatch is cancelled again
+            await asyncio.shield(redis_client.delete(*claimed_keys))
+        except Exception as e:
+            logger.warning(f"Error releasing image hashes: {e}")
+
+    async def _send(self, images: list, camera_id: str):
+        file_paths = [image.file_path for image in images]
+        downloaded_files = await asyncio.gather(
+            *[self._download(file_path) for file_path in file_paths]
+        )
+        claimed_keys = []
+        duplicates = []
+        delivered = False
+        try:
+            if settings.IMAGE_DEDUP_ENABLED:
+                file_paths, downloaded_files, duplicates = await self._skip_duplicates(
+                    file_paths=file_paths,
+                    files=downloaded_files,
+                    camera_id=camera_id,
+                    claimed_keys=claimed_keys,
+                )
+            response = await self._upload(
+                file_paths=file_paths, files=downloaded_files, camera_id=camera_id
+            )
+            delivered = True
+        finally:
+            # Released on errors and cancellations too (i.e. the push client disconnected),
+            # so the redelivered message isn't taken as a duplicate
+            if claimed_keys and not delivered:
+                await self._release_claims(claimed_keys)
+        for file_path in file_paths:
+            logger.info(f"File {file_path} delivered to WPS Watch with success.")
+            # Remove the file from GCP after delivering it to WPS Watch
+            if settings.DELETE_FILES_AFTER_DELIVERY:
+                await gcp_storage.delete(
+                    bucket=settings.BUCKET_NAME, object_name=file_path
+                )
+                logger.debug(f"File {file_path} deleted from GCP.")
+        return ImagesSent(response=response, duplicates=duplicates)
+
+    async def _upload(self, file_paths: list, files: list, camera_id: str):
         # Get the upload domain
         configurations = self.integration.configurations
         integration_push_config = find_config_for_action(
@@ -182,24 +546,16 @@ class WPSWatchImageDispatcher:
                     "From": "gundiservice.org",
                     "To": f"{camera_id}@{wpswatch_upload_domain}",
                 }
-                file_name = os.path.basename(file_path)
-                result = await self._wpswatch_post(
-                    request_data=request_data,
-                    file_name=file_name,
-                    file_data=downloaded_file,
+                attachments = [
+                    (os.path.basename(file_path), file)
+                    for file_path, file in zip(file_paths, files)
+                ]
+                return await self._wpswatch_post(
+                    request_data=request_data, attachments=attachments
                 )
         except Exception as e:
             logger.exception(f"Error sending data to WPS Watch {e}")
             raise e
-        else:
-            logger.info(f"File {file_path} delivered to WPS Watch with success.")
-            # Remove the file from GCP after delivering it to WPS Watch
-            if settings.DELETE_FILES_AFTER_DELIVERY:
-                await gcp_storage.delete(
-                    bucket=settings.BUCKET_NAME, object_name=file_path
-                )
-                logger.debug(f"File {file_path} deleted from GCP.")
-            return result
 
 
 dispatcher_cls_by_type = {
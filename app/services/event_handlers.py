@@ -2,26 +2,33 @@ import logging
 import backoff
 import httpx
 from datetime import datetime, timezone
+from functools import partial
 from redis import exceptions as redis_exceptions
 from gundi_core.events.transformers import (
     EventTransformedWPSWatch,
     AttachmentTransformedWPSWatch,
 )
 from app.core import tracing, settings
-from app.core.errors import ReferenceDataError
+from app.core.errors import DuplicateImage, ReferenceDataError
 from app.core.utils import (
     is_null,
     get_redis_db,
+    LazyClient,
 )
-from app.core.system_events import publish_event
+from app.core.cache_keys import image_metadata_key
+from app.core.serialization import pack_model, unpack_model, versioned_key
+from app.core.system_events import emit_event
+from app.core.deadlines import get_remaining
 from app.core.gundi import get_integration_details
 from gundi_core.schemas import v2 as gundi_schemas_v2
 from gundi_core import events as system_events
 from opentelemetry.trace import SpanKind
 from .dispatchers import WPSWatchImageDispatcher
+from .attachment_batcher import attachment_batcher
 
 
-_cache_db = get_redis_db()
+# Image metadata is cached in a compact binary format, so this client doesn't decode responses
+_cache_db = LazyClient(partial(get_redis_db, decode_responses=False))
 
 
 logger = logging.getLogger(__name__)
@@ -42,7 +49,12 @@ async def get_destination_integration(destination_id):
     return destination_integration
 
 
-@backoff.on_exception(backoff.expo, (redis_exceptions.RedisError,), max_tries=5)
+@backoff.on_exception(
+    backoff.expo,
+    (redis_exceptions.RedisError,),
+    max_tries=5,
+    max_time=get_remaining,
+)
 async def get_image_metadata_from_cache(
     gundi_id, destination_id
 ) -> gundi_schemas_v2.WPSWatchImageMetadata:
@@ -50,11 +62,14 @@ async def get_image_metadata_from_cache(
     try:
         if not gundi_id or not destination_id:
             raise ValueError("gundi_id and destination_id must be valid")
-        key = f"wps_image_metadata.{gundi_id}.{destination_id}"
-        cached_data = await _cache_db.get(name=key)
-        if not cached_data:
-            return None
-        return gundi_schemas_v2.WPSWatchImageMetadata.parse_raw(cached_data)
+        key = image_metadata_key(gundi_id, destination_id)
+        cached_data = await _cache_db.get(name=versioned_key(key))
+        if not cached_data and settings.IMAGE_METADATA_LEGACY_FORMAT_ENABLED:
+            # Cached as JSON before the deploy, or by an instance of the previous version
+            legacy_data = await _cache_db.get(name=key)
+            if legacy_data:
+                return gundi_schemas_v2.WPSWatchImageMetadata.parse_raw(legacy_data)
+        return unpack_model(gundi_schemas_v2.WPSWatchImageMetadata, cached_data)
     except redis_exceptions.RedisError as e:
         logger.warning(
             f"ConnectionError while getting image metadata from cache for {gundi_id} and {destination_id}: {type(e)}: {e}",
@@ -67,7 +82,12 @@ async def get_image_metadata_from_cache(
         raise e
 
 
-@backoff.on_exception(backoff.expo, (redis_exceptions.RedisError,), max_tries=5)
+@backoff.on_exception(
+    backoff.expo,
+    (redis_exceptions.RedisError,),
+    max_tries=5,
+    max_time=get_remaining,
+)
 async def cache_image_metadata(
     data: gundi_schemas_v2.WPSWatchImageMetadata, gundi_id, destination_id: str
 ):
@@ -75,11 +95,18 @@ async def cache_image_metadata(
         if not gundi_id or not destination_id:
             raise ValueError("gundi_id and destination_id must be valid")
 
-        key = f"wps_image_metadata.{gundi_id}.{destination_id}"
+        key = image_metadata_key(gundi_id, destination_id)
+        if settings.IMAGE_METADATA_LEGACY_FORMAT_ENABLED:
+            # Readable by the instances of the previous version during a rollout
+            await _cache_db.setex(
+                name=key,
+                time=settings.IMAGE_METADATA_CACHE_TTL,
+                value=data.json(),
+            )
         await _cache_db.setex(
-            name=key,
+            name=versioned_key(key),
             time=settings.IMAGE_METADATA_CACHE_TTL,
-            value=data.json(),
+            value=pack_model(data),
         )
     except redis_exceptions.RedisError as e:
         logger.warning(
@@ -110,6 +137,23 @@ async def get_related_event(event_id, destination_id):
     return related_observation
 
 
+async def emit_duplicate_image_log(attributes: dict):
+    gundi_id = attributes.get("gundi_id")
+    await emit_event(
+        event=system_events.DispatcherCustomLog(
+            payload=gundi_schemas_v2.CustomDispatcherLog(
+                gundi_id=gundi_id,
+                related_to=attributes.get("related_to"),
+                data_provider_id=attributes.get("data_provider_id"),
+                destination_id=attributes.get("destination_id"),
+                title=f"Observation {gundi_id} skipped, the same image was sent to the camera already",
+                level=gundi_schemas_v2.LogLevel.INFO,
+            )
+        ),
+        topic_name=settings.DISPATCHER_EVENTS_TOPIC,
+    )
+
+
 async def dispatch_image(
     integration: gundi_schemas_v2.Integration,
     image: gundi_schemas_v2.WPSWatchImage,
@@ -125,7 +169,20 @@ async def dispatch_image(
     ) as current_span:
         try:
             dispatcher = WPSWatchImageDispatcher(integration=integration)
-            result = await dispatcher.send(image=image, related_event=related_event)
+            if settings.ATTACHMENT_BATCHING_ENABLED and not is_null(related_to):
+                # Sent in one upload with other attachments of the same event
+                result = await attachment_batcher.submit(
+                    key=(str(destination_id), str(related_to)),
+                    item=image,
+                    send=partial(dispatcher.send_many, related_event=related_event),
+                )
+            else:
+                result = await dispatcher.send(image=image, related_event=related_event)
+        except DuplicateImage as e:
+            logger.info(f"Observation {gundi_id} not dispatched: {e}")
+            current_span.set_attribute("is_duplicate", True)
+            await emit_duplicate_image_log(attributes=attributes)
+            return {"status": "duplicate"}
         except Exception as e:
             with tracing.tracer.start_as_current_span(
                 "wpswatch_dispatcher.error_dispatching_observation",
@@ -135,7 +192,7 @@ async def dispatch_image(
                 logger.exception(error_msg)
                 error_span.set_attribute("error", error_msg)
                 # Emit events for the portal and other interested services (EDA)
-                await publish_event(
+                await emit_event(
                     event=system_events.ObservationDeliveryFailed(
                         payload=gundi_schemas_v2.DispatchedObservation(
                             gundi_id=gundi_id,
@@ -151,8 +208,15 @@ async def dispatch_image(
                 # Raise so it can be retried by GCP
                 raise e
         else:
+            if image.file_path in result.duplicates:  # Left out of a batch upload
+                logger.info(
+                    f"Observation {gundi_id} not dispatched: image {image.file_path} sent to the camera already"
+                )
+                current_span.set_attribute("is_duplicate", True)
+                await emit_duplicate_image_log(attributes=attributes)
+                return {"status": "duplicate"}
             logger.debug(
-                f"Observation {gundi_id} delivered with success. WPS response: {result}"
+                f"Observation {gundi_id} delivered with success. WPS response: {result.response}"
             )
             current_span.set_attribute("is_dispatched_successfully", True)
             current_span.set_attribute("destination_id", str(destination_id))
@@ -168,7 +232,7 @@ async def dispatch_image(
                 destination_id=destination_id,
                 delivered_at=datetime.now(timezone.utc),  # UTC
             )
-            await publish_event(
+            await emit_event(
                 event=system_events.ObservationDelivered(
                     payload=dispatched_observation
                 ),
@@ -182,7 +246,7 @@ async def handle_wpswatch_event(event: EventTransformedWPSWatch, attributes: dic
     with tracing.tracer.start_as_current_span(
         "wpswatch_dispatcher.handle_wpswatch_event", kind=SpanKind.CONSUMER
     ) as current_span:
-        current_span.set_attribute("payload", repr(event.payload))
+        tracing.set_bounded_attribute(current_span, "payload", event.payload)
         gundi_id = attributes.get("gundi_id")
         related_to = attributes.get("related_to")
         data_provider_id = attributes.get("data_provider_id")
@@ -193,7 +257,7 @@ async def handle_wpswatch_event(event: EventTransformedWPSWatch, attributes: dic
             )
         except Exception as e:
             logger.error(f"Error caching image metadata: {type(e)}: {e}")
-            await publish_event(
+            await emit_event(
                 event=system_events.ObservationDeliveryFailed(
                     payload=gundi_schemas_v2.DispatchedObservation(
                         gundi_id=gundi_id,
@@ -212,7 +276,7 @@ async def handle_wpswatch_event(event: EventTransformedWPSWatch, attributes: dic
             current_span.add_event(
                 name="wpswatch_dispatcher.transformed_observation_buffered"
             )
-            await publish_event(
+            await emit_event(
                 event=system_events.DispatcherCustomLog(
                     payload=gundi_schemas_v2.CustomDispatcherLog(
                         gundi_id=gundi_id,
@@ -235,7 +299,7 @@ async def handle_wpswatch_attachment(
     with tracing.tracer.start_as_current_span(
         "wpswatch_dispatcher.handle_wpswatch_attachment", kind=SpanKind.CONSUMER
     ) as current_span:
-        current_span.set_attribute("payload", repr(event.payload))
+        tracing.set_bounded_attribute(current_span, "payload", event.payload)
         destination_id = attributes.get("destination_id")
         current_span.set_attribute("destination_id", destination_id)
         destination_integration = await get_destination_integration(
@@ -14,8 +14,14 @@ from app.core.gundi import (
     get_outbound_config_detail,
     get_inbound_integration_detail,
 )
-from app.core.errors import DispatcherException, ReferenceDataError, TooManyRequests
+from app.core.errors import (
+    DispatcherException,
+    ReferenceDataError,
+    TooManyRequests,
+    CircuitBreakerOpen,
+)
 from app.core import tracing
+from app.core.deadlines import MIN_TIMEOUT_SEC, bounded_timeout, check_deadline
 from . import dispatchers
 from .event_handlers import event_handlers, event_schemas
 
@@ -45,9 +51,11 @@ async def send_observation_to_dead_letter_topic(transformed_observation, attribu
 
         print(f"Forwarding observation to dead letter topic: {transformed_observation}")
         # Publish to another PubSub topic
+        check_deadline(stage="publishing to the dead letter topic")
         connect_timeout, read_timeout = settings.DEFAULT_REQUESTS_TIMEOUT
         timeout_settings = aiohttp.ClientTimeout(
-            sock_connect=connect_timeout, sock_read=read_timeout
+            sock_connect=bounded_timeout(connect_timeout, minimum=MIN_TIMEOUT_SEC),
+            sock_read=bounded_timeout(read_timeout, minimum=MIN_TIMEOUT_SEC),
         )
         async with aiohttp.ClientSession(
             raise_for_status=True, timeout=timeout_settings
@@ -189,7 +197,9 @@ async def process_transformed_observation_v1(transformed_message, attributes):
                 ExtraKeys.RelatedTo: related_to,
             },
         )
-        current_span.set_attribute("transformed_message", str(transformed_message))
+        tracing.set_bounded_attribute(
+            current_span, "transformed_message", transformed_message
+        )
         current_span.set_attribute("environment", settings.TRACE_ENVIRONMENT)
         current_span.set_attribute("service", "cdip-routing")
 
@@ -243,7 +253,7 @@ async def process_transformed_observation_v1(transformed_message, attributes):
                 subspan.set_attribute("error", error_msg)
                 # Raise the exception so the message is retried later by GCP
                 raise e
-            except TooManyRequests as e:
+            except (TooManyRequests, CircuitBreakerOpen) as e:
                 error_msg = f"Throttling request {gundi_id}: {e}"
                 logger.exception(
                     error_msg,
@@ -302,7 +312,7 @@ async def process_transformer_event_v2(raw_event, attributes):
         current_span.add_event(
             name="wpswatch_dispatcher.transformed_observation_received_at_dispatcher"
         )
-        current_span.set_attribute("transformed_message", str(raw_event))
+        tracing.set_bounded_attribute(current_span, "transformed_message", raw_event)
         current_span.set_attribute("environment", settings.TRACE_ENVIRONMENT)
         current_span.set_attribute("service", "er-dispatcher")
         logger.debug(
@@ -0,0 +1,105 @@
+import asyncio
+import logging
+from enum import Enum
+from app.core import settings, utils, gundi
+from . import dispatchers, event_handlers
+
+
+logger = logging.getLogger(__name__)
+
+
+class WarmupStatus(str, Enum):
+    PENDING = "pending"
+    DONE = "done"
+    TIMED_OUT = "timed_out"
+    FAILED = "failed"
+
+
+status = WarmupStatus.PENDING
+
+
+def is_ready() -> bool:
+    return status != WarmupStatus.PENDING
+
+
+async def open_redis_connections():
+    # Concurrent pings take a connection each, so they are all kept in the pool
+    for client in (utils.redis_client, gundi._cache_db, event_handlers._cache_db):
+        await asyncio.gather(
+            *[client.ping() for _ in range(settings.WARMUP_REDIS_CONNECTIONS)]
+        )
+
+
+async def open_upload_host_connections():
+    hosts = await utils.redis_client.zrevrange(
+        dispatchers.UPLOAD_HOSTS_KEY, 0, settings.WARMUP_MAX_UPLOAD_HOSTS - 1
+    )
+    client = dispatchers.get_wpswatch_client()
+    # Any response will do, the point is having the connection (DNS, TLS) ready
+    results = await asyncio.gather(
+        *[client.head(host) for host in hosts], return_exceptions=True
+    )
+    for host, result in zip(hosts, results):
+        if isinstance(result, Exception):
+            logger.warning(f"Warm-up: Error connecting to {host}: {result}")
+    logger.debug(f"Warm-up: connections open to {len(hosts)} WPS Watch sites")
+
+
+async def preload_integration_details():
+    destination_ids = await utils.redis_client.zrevrange(
+        dispatchers.ACTIVE_DESTINATIONS_KEY, 0, settings.WARMUP_MAX_DESTINATIONS - 1
+    )
+    results = await asyncio.gather(
+        *[gundi.get_integration_details(integration_id=i) for i in destination_ids],
+        return_exceptions=True,
+    )
+    for destination_id, result in zip(destination_ids, results):
+        if isinstance(result, Exception):
+            logger.warning(
+                f"Warm-up: Error loading details for destination {destination_id}: {result}"
+            )
+    logger.debug(f"Warm-up: details loaded for {len(destination_ids)} destinations")
+
+
+async def _warm_up():
+    await open_redis_connections()
+    await asyncio.gather(
+        open_upload_host_connections(),
+        preload_integration_details(),
+    )
+
+
+def start_warmup():
+    global status
+    if not settings.WARMUP_ENABLED:
+        status = WarmupStatus.DONE
+        return None
+    status = WarmupStatus.PENDING
+    return asyncio.ensure_future(warm_up())
+
+
+async def stop_warmup(task):
+    if task and not task.done():
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+async def warm_up():
+    """
+    Get connections and hot configuration ready before the first messages arrive.
+    The instance is reported as ready when this finishes or times out.
+    """
+    global status
+    try:
+        await asyncio.wait_for(_warm_up(), timeout=settings.WARMUP_TIMEOUT_SEC)
+    except asyncio.TimeoutError:
+        logger.warning(
+            f"Warm-up didn't finish in {settings.WARMUP_TIMEOUT_SEC} seconds. Continuing."
+        )
+        status = WarmupStatus.TIMED_OUT
+    except Exception as e:
+        logger.warning(f"Warm-up failed: {type(e)}: {e}. Continuing.")
+        status = WarmupStatus.FAILED
+    else:
+        logger.info("Warm-up finished.")
+        status = WarmupStatus.DONE
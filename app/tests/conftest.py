@@ -1,4 +1,5 @@
 import datetime
+import time
 from unittest.mock import AsyncMock, patch
 
 import pytest
@@ -6,6 +7,7 @@ import asyncio
 import gundi_core.schemas.v2 as schemas_v2
 from gcloud.aio import pubsub
 from app.core import settings
+from app.core.serialization import pack
 
 
 def async_return(result):
@@ -14,6 +16,14 @@ def async_return(result):
     return f
 
 
+@pytest.fixture(autouse=True)
+def config_invalidations(mocker):
+    """
+    Invalidations seen by the process, reset so they don't leak between tests
+    """
+    return mocker.patch("app.core.gundi._invalidations", {})
+
+
 @pytest.fixture
 def mock_redis(mocker):
     mock_cache = mocker.MagicMock()
@@ -27,12 +37,20 @@ def mock_redis(mocker):
     mock_cache.__aexit__.return_value = None
     mock_cache.close.return_value = async_return(None)
     mock_cache.pipeline.return_value = mock_cache
+    mock_cache.hgetall.return_value = async_return({})
+    mock_cache.hincrby.return_value = mock_cache
+    mock_cache.hset.return_value = mock_cache
+    # Circuit breaker scripts: a failure counted, the circuit still closed
+    mock_cache.eval.return_value = async_return(["closed", 1, 0])
+    mock_cache.delete.return_value = async_return(None)
+    mock_cache.ping.return_value = async_return(True)
+    mock_cache.zrevrange.return_value = async_return([])
     return mock_cache
 
 
 @pytest.fixture
 def cached_event():
-    return '{"camera_id": "gunditest"}'
+    return pack({"camera_id": "gunditest"})
 
 
 @pytest.fixture
@@ -48,6 +66,14 @@ def mock_redis_with_cached_event(mocker, cached_event):
     mock_cache.__aexit__.return_value = None
     mock_cache.close.return_value = async_return(None)
     mock_cache.pipeline.return_value = mock_cache
+    mock_cache.hgetall.return_value = async_return({})
+    mock_cache.hincrby.return_value = mock_cache
+    mock_cache.hset.return_value = mock_cache
+    # Circuit breaker scripts: a failure counted, the circuit still closed
+    mock_cache.eval.return_value = async_return(["closed", 1, 0])
+    mock_cache.delete.return_value = async_return(None)
+    mock_cache.ping.return_value = async_return(True)
+    mock_cache.zrevrange.return_value = async_return([])
     return mock_cache
 
 
@@ -59,6 +85,24 @@ def mock_redis_with_rate_limit_exceeded(mock_redis):
     return mock_redis
 
 
+@pytest.fixture
+def mock_redis_with_circuit_open(mock_redis):
+    mock_redis.hgetall.return_value = async_return(
+        {"state": "open", "opened_at": str(time.time())}
+    )
+    return mock_redis
+
+
+@pytest.fixture
+def mock_redis_with_circuit_half_open(mock_redis):
+    mock_redis.hgetall.return_value = async_return(
+        {"state": "half_open", "probes": "1", "successes": "0"}
+    )
+    # No probe slot left
+    mock_redis.eval.return_value = async_return(["half_open", 0, 1])
+    return mock_redis
+
+
 @pytest.fixture
 def observation_delivered_pubsub_message():
     return pubsub.PubsubMessage(
@@ -422,6 +466,9 @@ def mock_cloud_storage_client(
 ):
     mock_client = mocker.MagicMock()
     mock_client.download.return_value = async_return(attachment_file_blob)
+    mock_client.download_metadata.return_value = async_return(
+        {"size": str(len(attachment_file_blob))}
+    )
     mock_client.delete.return_value = async_return(None)
     mock_client.__aenter__.return_value = mock_client
     mock_client.__aexit__.return_value = None
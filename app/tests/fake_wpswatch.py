@@ -0,0 +1,250 @@
+"""
+Fake WPS Watch site to test uploads under realistic and faulty conditions.
+
+It serves `/api/Upload` as an ASGI app, validating the `Wps-Api-Key` header and the multipart
+`From`/`To`/`Attachment1` fields, and can add latency, limit the upload bandwidth, answer with
+429s or 5xx errors and reset connections. Counters of what it received are served at `/_stats`.
+
+In tests, route the WPS Watch client through `FakeWPSWatch.transport()`. For benchmarks, run it
+as a server:
+    python -m app.tests.fake_wpswatch --port 8282 --latency lognormal:0.2:0.5 \\
+        --bandwidth-kbps 512 --rate-429 0.05 --rate-5xx 0.01 --reset-rate 0.01
+"""
+import argparse
+import asyncio
+import collections
+import json
+import random
+import re
+import socket
+import struct
+
+import httpx
+
+UPLOAD_PATH = "/api/Upload"
+STATS_PATH = "/_stats"
+SERVER_ERRORS = (500, 502, 503)
+
+
+def parse_latency(spec: str):
+    """
+    Latency distribution in seconds from a spec like constant:0.05, uniform:0.02:0.5,
+    exponential:0.1 (mean) or lognormal:0.2:0.5 (median, sigma)
+    """
+    kind, *params = spec.split(":")
+    params = [float(p) for p in params]
+    if kind == "constant":
+        return lambda: params[0]
+    if kind == "uniform":
+        return lambda: random.uniform(*params)
+    if kind == "exponential":
+        return lambda: random.expovariate(1 / params[0])
+    if kind == "lognormal":
+        median, sigma = params
+        return lambda: median * random.lognormvariate(0, sigma)
+    raise ValueError(f"Unknown latency distribution '{kind}'")
+
+
+def parse_multipart(content_type: str, body: bytes) -> dict:
+    """
+    Map the form field names to their (filename, content) in a multipart/form-data body
+    """
+    match = re.search(r'boundary="?([^";]+)"?', content_type)
+    if not content_type.startswith("multipart/form-data") or not match:
+        raise ValueError(f"Not a multipart/form-data body: {content_type}")
+    delimiter = b"--" + match.group(1).encode()
+    fields = {}
+    for part in body.split(delimiter)[1:-1]:
+        headers, _, content = part[2:].partition(b"\r\n\r\n")
+        disposition = re.search(
+            rb'content-disposition: *form-data; *name="([^"]*)"(?:; *filename="([^"]*)")?',
+            headers,
+            re.IGNORECASE,
+        )
+        if not disposition:
+            raise ValueError("Multipart part without a form-data disposition")
+        name, filename = disposition.groups()
+        fields[name.decode()] = (
+            filename.decode() if filename is not None else None,
+            content[:-2],  # Without the CRLF before the next delimiter
+        )
+    return fields
+
+
+class ConnectionReset(Exception):
+    pass
+
+
+class FakeWPSWatch:
+    def __init__(
+        self,
+        api_keys=None,
+        latency=None,
+        bandwidth_bytes_per_sec=None,
+        rate_429=0.0,
+        rate_5xx=0.0,
+        reset_rate=0.0,
+        retry_after_sec=1,
+    ):
+        self.api_keys = set(api_keys) if api_keys else None  # None accepts any key
+        self.latency = latency or (lambda: 0)
+        self.bandwidth_bytes_per_sec = bandwidth_bytes_per_sec
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.reset_rate = reset_rate
+        self.retry_after_sec = retry_after_sec
+        self.counters = collections.Counter()
+        self.uploads_by_camera = collections.Counter()
+        self.in_flight = 0
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "in_flight": self.in_flight,
+            "uploads_by_camera": dict(self.uploads_by_camera),
+        }
+
+    def transport(self) -> httpx.AsyncBaseTransport:
+        return _ResettingASGITransport(app=self)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+        if scope["path"] == STATS_PATH:
+            return await self._respond(send, 200, self.stats())
+        if scope["path"] != UPLOAD_PATH or scope["method"] != "POST":
+            return await self._respond(send, 404, {"error": "Not found"})
+        self.in_flight += 1
+        self.counters["max_in_flight"] = max(
+            self.counters["max_in_flight"], self.in_flight
+        )
+        try:
+            await self._upload(scope, receive, send)
+        finally:
+            self.in_flight -= 1
+
+    async def _upload(self, scope, receive, send):
+        self.counters["requests"] += 1
+        headers = {k.decode().lower(): v.decode() for k, v in scope["headers"]}
+        reset_at = None
+        if random.random() < self.reset_rate:  # Somewhere through the upload
+            reset_at = random.randint(0, int(headers.get("content-length", 0)))
+        body = bytearray()
+        more_body = True
+        while more_body:
+            message = await receive()
+            chunk = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            body.extend(chunk)
+            if self.bandwidth_bytes_per_sec:
+                await asyncio.sleep(len(chunk) / self.bandwidth_bytes_per_sec)
+            if reset_at is not None and len(body) >= reset_at:
+                self.counters["resets"] += 1
+                return self._reset_connection(receive)
+        self.counters["bytes_received"] += len(body)
+
+        if (
+            self.api_keys is not None
+            and headers.get("wps-api-key") not in self.api_keys
+        ):
+            self.counters["unauthorized"] += 1
+            return await self._respond(send, 401, {"error": "Invalid API key"})
+        try:
+            fields = parse_multipart(headers.get("content-type", ""), bytes(body))
+            missing = {"From", "To", "Attachment1"} - set(fields)
+            if missing:
+                raise ValueError(f"Missing fields: {', '.join(sorted(missing))}")
+            filename, attachment = fields["Attachment1"]
+            if not filename or not attachment:
+                raise ValueError("Attachment1 must be a non-empty file")
+            to = fields["To"][1].decode()
+        except ValueError as e:
+            self.counters["bad_requests"] += 1
+            return await self._respond(send, 400, {"error": f"Invalid upload: {e}"})
+
+        await asyncio.sleep(self.latency())
+        fault = random.random()
+        if fault < self.rate_429:
+            self.counters["throttled"] += 1
+            return await self._respond(
+                send,
+                429,
+                {"error": "Too many requests"},
+                headers=[(b"retry-after", str(self.retry_after_sec).encode())],
+            )
+        if fault < self.rate_429 + self.rate_5xx:
+            self.counters["server_errors"] += 1
+            return await self._respond(
+                send, random.choice(SERVER_ERRORS), {"error": "Server error"}
+            )
+        self.counters["uploads"] += 1
+        self.counters["attachments"] += sum(
+            1 for name in fields if name.startswith("Attachment")
+        )
+        self.uploads_by_camera[to.split("@")[0]] += 1
+        return await self._respond(send, 200, {"status": "ok"})
+
+    @staticmethod
+    def _reset_connection(receive):
+        # Servers like uvicorn bind receive() to the request cycle holding the transport
+        transport = getattr(getattr(receive, "__self__", None), "transport", None)
+        if transport is not None:
+            sock = transport.get_extra_info("socket")
+            if sock is not None:  # Close with a RST instead of a FIN
+                sock.setsockopt(
+                    socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0)
+                )
+            transport.abort()
+            return
+        raise ConnectionReset("Connection reset by the fake WPS Watch site")
+
+    @staticmethod
+    async def _respond(send, status, content, headers=None):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [(b"content-type", b"application/json")] + (headers or []),
+            }
+        )
+        await send({"type": "http.response.body", "body": json.dumps(content).encode()})
+
+
+class _ResettingASGITransport(httpx.ASGITransport):
+    """
+    Resets reach the client as the network errors they would cause
+    """
+
+    async def handle_async_request(self, request):
+        try:
+            return await super().handle_async_request(request)
+        except ConnectionReset as e:
+            raise httpx.ReadError(str(e), request=request)
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8282)
+    parser.add_argument("--api-key", action="append", dest="api_keys")
+    parser.add_argument("--latency", default="constant:0", help="e.g. uniform:0.02:0.5")
+    parser.add_argument("--bandwidth-kbps", type=float)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--rate-5xx", type=float, default=0.0)
+    parser.add_argument("--reset-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    app = FakeWPSWatch(
+        api_keys=args.api_keys,
+        latency=parse_latency(args.latency),
+        bandwidth_bytes_per_sec=args.bandwidth_kbps and args.bandwidth_kbps * 1024,
+        rate_429=args.rate_429,
+        rate_5xx=args.rate_5xx,
+        reset_rate=args.reset_rate,
+    )
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
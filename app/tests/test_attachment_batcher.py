@@ -0,0 +1,34 @@
+import asyncio
+import pytest
+from app.services.attachment_batcher import AttachmentBatcher
+
+
+@pytest.mark.asyncio
+async def test_attachments_of_an_event_are_sent_together(mocker):
+    send = mocker.AsyncMock(return_value="uploaded")
+    batcher = AttachmentBatcher(max_wait=0.05, max_size=5)
+    results = await asyncio.gather(
+        batcher.submit(key=("destination", "event-1"), item="image-1", send=send),
+        batcher.submit(key=("destination", "event-1"), item="image-2", send=send),
+        batcher.submit(key=("destination", "event-2"), item="image-3", send=send),
+    )
+    assert results == ["uploaded", "uploaded", "uploaded"]
+    assert send.call_count == 2
+    send.assert_any_call(["image-1", "image-2"])
+    send.assert_any_call(["image-3"])
+
+
+@pytest.mark.asyncio
+async def test_full_batch_is_sent_without_waiting_and_errors_reach_all(mocker):
+    send = mocker.AsyncMock(side_effect=ValueError("Upload failed"))
+    batcher = AttachmentBatcher(max_wait=60, max_size=2)
+    results = await asyncio.wait_for(
+        asyncio.gather(
+            batcher.submit(key="event", item="image-1", send=send),
+            batcher.submit(key="event", item="image-2", send=send),
+            return_exceptions=True,
+        ),
+        timeout=1,
+    )
+    assert all(isinstance(result, ValueError) for result in results)
+    send.assert_called_once_with(["image-1", "image-2"])
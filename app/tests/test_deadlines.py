@@ -0,0 +1,74 @@
+import asyncio
+import pytest
+from fastapi.testclient import TestClient
+from app import main
+from app.core import deadlines, settings
+from app.core.errors import DeadlineExceeded, ClientDisconnected
+from app.services import process_messages
+
+
+@pytest.mark.asyncio
+async def test_stage_is_cancelled_when_deadline_is_reached():
+    cancelled = asyncio.Event()
+
+    async def slow_upload():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    deadlines.start_deadline(seconds=0.1)
+    with pytest.raises(DeadlineExceeded):
+        await deadlines.run_with_deadline(slow_upload(), stage="upload")
+    assert cancelled.is_set()
+    # Later stages are not started
+    assert deadlines.bounded_timeout(20) == 0
+    with pytest.raises(DeadlineExceeded):
+        deadlines.check_deadline(stage="publishing")
+
+
+@pytest.mark.asyncio
+async def test_dead_letter_publish_is_not_started_past_the_deadline(mocker):
+    session = mocker.patch.object(process_messages.aiohttp, "ClientSession")
+    deadlines.start_deadline(seconds=0)
+    with pytest.raises(DeadlineExceeded):
+        await process_messages.send_observation_to_dead_letter_topic(
+            {"id": "123"}, {"gundi_version": "v1"}
+        )
+    session.assert_not_called()
+    # aiohttp would read a timeout of 0 as no timeout
+    assert deadlines.bounded_timeout(20, minimum=deadlines.MIN_TIMEOUT_SEC) > 0
+
+
+def test_message_is_redelivered_when_the_deadline_is_exceeded(mocker):
+    mocker.patch.object(
+        main,
+        "process_request",
+        side_effect=DeadlineExceeded("Deadline exceeded before upload to WPS Watch"),
+    )
+    response = TestClient(main.app).post("/", json={"message": {}})
+    assert response.status_code == 504
+    assert response.json()["status"] == "deadline_exceeded"
+
+
+@pytest.mark.asyncio
+async def test_processing_is_cancelled_when_client_disconnects(mocker):
+    mocker.patch.object(settings, "DISCONNECT_POLL_INTERVAL_SEC", 0.05)
+    request = mocker.MagicMock()
+    request.is_disconnected = mocker.AsyncMock(return_value=True)
+    cancelled = asyncio.Event()
+
+    async def process_request():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    deadlines.start_deadline(seconds=30)
+    with pytest.raises(ClientDisconnected):
+        await deadlines.cancel_on_disconnect(
+            request=request, awaitable=process_request()
+        )
+    assert cancelled.is_set()
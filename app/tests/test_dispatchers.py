@@ -0,0 +1,302 @@
+import asyncio
+import pytest
+import respx
+import httpx
+from app.core import settings
+from app.services import dispatchers, event_handlers
+from app.core.errors import DuplicateImage
+from app.tests.conftest import async_return
+from app.tests.fake_wpswatch import FakeWPSWatch
+from gundi_core import events as system_events
+from gundi_core.schemas import v2 as schemas_v2
+
+
+class RefusingTransport(httpx.AsyncBaseTransport):
+    """
+    Fails like an HTTP/2 stream refused by the site, before the body is sent
+    """
+
+    def __init__(self):
+        self.requests = 0
+
+    async def handle_async_request(self, request):
+        self.requests += 1
+        raise httpx.RemoteProtocolError("REFUSED_STREAM")
+
+
+@pytest.mark.asyncio
+async def test_wpswatch_upload_falls_back_to_http1_when_http2_fails(mocker):
+    mocker.patch.object(settings, "WPSWATCH_HTTP2_ENABLED", True)
+    mocker.patch.object(dispatchers, "_http1_only_hosts", {})
+    http2_transport = RefusingTransport()
+    http1_transport = httpx.MockTransport(lambda request: httpx.Response(200))
+    mocker.patch.object(
+        dispatchers,
+        "_wpswatch_clients",
+        {
+            True: httpx.AsyncClient(transport=http2_transport),
+            False: httpx.AsyncClient(transport=http1_transport),
+        },
+    )
+    response = await dispatchers.wpswatch_upload(
+        "https://wpswatch-api.test.com/api/Upload",
+        data={"From": "gundiservice.org", "To": "gunditest@upload.wpswatch.org"},
+        files={"Attachment1": ("elephant.jpg", b"image bytes")},
+    )
+    await dispatchers.close_wpswatch_clients()
+    assert response.status_code == httpx.codes.OK
+    assert http2_transport.requests == 1
+    # Next uploads to this site use HTTP/1.1 straight away
+    assert "wpswatch-api.test.com" in dispatchers._http1_only_hosts
+
+
+@pytest.mark.asyncio
+async def test_wpswatch_upload_is_not_sent_again_if_the_body_was_sent(mocker):
+    mocker.patch.object(settings, "WPSWATCH_HTTP2_ENABLED", True)
+    mocker.patch.object(dispatchers, "_http1_only_hosts", {})
+
+    async def fail_after_receiving_the_body(request):
+        await request.aread()
+        raise httpx.RemoteProtocolError("PROTOCOL_ERROR")
+
+    async with respx.mock(base_url="https://wpswatch-api.test.com") as respx_mock:
+        route = respx_mock.post("api/Upload", name="upload_file")
+        route.side_effect = fail_after_receiving_the_body
+        with pytest.raises(httpx.RemoteProtocolError):
+            await dispatchers.wpswatch_upload(
+                "https://wpswatch-api.test.com/api/Upload",
+                data={
+                    "From": "gundiservice.org",
+                    "To": "gunditest@upload.wpswatch.org",
+                },
+                files={"Attachment1": ("elephant.jpg", b"image bytes")},
+            )
+    await dispatchers.close_wpswatch_clients()
+    # The image might have been received, the message retries decide
+    assert route.call_count == 1
+    # HTTP/2 is tried again once the fallback expires
+    dispatchers._http1_only_hosts["wpswatch-api.test.com"] = 0
+    assert dispatchers._use_http2("wpswatch-api.test.com")
+
+
+@pytest.fixture
+def fake_wpswatch(mocker):
+    fake = FakeWPSWatch(api_keys=["test-api-key"])
+    mocker.patch.object(settings, "WPSWATCH_HTTP2_ENABLED", False)
+    mocker.patch.object(
+        dispatchers,
+        "_wpswatch_clients",
+        {False: httpx.AsyncClient(transport=fake.transport())},
+    )
+    return fake
+
+
+async def upload_to_fake(api_key="test-api-key"):
+    return await dispatchers.wpswatch_upload(
+        "https://wpswatch-api.test.com/api/Upload",
+        data={"From": "gundiservice.org", "To": "gunditest@upload.wpswatch.org"},
+        headers={"Wps-Api-Key": api_key},
+        files={"Attachment1": ("elephant.jpg", b"image bytes")},
+    )
+
+
+@pytest.mark.asyncio
+async def test_fake_wpswatch_validates_uploads(fake_wpswatch):
+    response = await upload_to_fake()
+    assert response.status_code == httpx.codes.OK
+    response = await upload_to_fake(api_key="wrong-key")
+    assert response.status_code == httpx.codes.UNAUTHORIZED
+    await dispatchers.close_wpswatch_clients()
+    assert fake_wpswatch.counters["requests"] == 2
+    assert fake_wpswatch.counters["uploads"] == 1
+    assert fake_wpswatch.counters["unauthorized"] == 1
+    assert fake_wpswatch.uploads_by_camera == {"gunditest": 1}
+
+
+@pytest.mark.asyncio
+async def test_fake_wpswatch_injects_faults(fake_wpswatch):
+    fake_wpswatch.rate_429 = 1.0
+    response = await upload_to_fake()
+    assert response.status_code == httpx.codes.TOO_MANY_REQUESTS
+    fake_wpswatch.reset_rate = 1.0
+    with pytest.raises(httpx.ReadError):
+        await upload_to_fake()
+    await dispatchers.close_wpswatch_clients()
+    assert fake_wpswatch.counters["throttled"] == 1
+    assert fake_wpswatch.counters["resets"] == 1
+
+
+@pytest.mark.asyncio
+async def test_images_of_an_event_are_sent_in_one_upload(
+    mocker,
+    mock_redis,
+    mock_cloud_storage_client,
+    destination_integration_v2,
+    fake_wpswatch,
+):
+    mocker.patch("app.services.dispatchers.redis_client", mock_redis)
+    mocker.patch("app.services.dispatchers.gcp_storage", mock_cloud_storage_client)
+    fake_wpswatch.api_keys = None
+    dispatcher = dispatchers.WPSWatchImageDispatcher(
+        integration=destination_integration_v2
+    )
+    result = await dispatcher.send_many(
+        images=[
+            schemas_v2.WPSWatchImage(file_path="attachments/elephant.jpg"),
+            schemas_v2.WPSWatchImage(file_path="attachments/elephant-calf.jpg"),
+        ],
+        related_event=schemas_v2.WPSWatchImageMetadata(camera_id="gunditest"),
+    )
+    await dispatchers.close_wpswatch_clients()
+    assert result.response.status_code == httpx.codes.OK
+    assert result.duplicates == []
+    assert fake_wpswatch.counters["uploads"] == 1
+    assert fake_wpswatch.counters["attachments"] == 2
+    assert mock_cloud_storage_client.download.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_duplicate_images_are_not_uploaded_again(
+    mocker,
+    mock_redis,
+    mock_cloud_storage_client,
+    destination_integration_v2,
+    fake_wpswatch,
+):
+    mocker.patch.object(settings, "IMAGE_DEDUP_ENABLED", True)
+    # The content hash is claimed the first time only
+    mock_redis.set.side_effect = [async_return(True), async_return(None)]
+    mocker.patch("app.services.dispatchers.redis_client", mock_redis)
+    mocker.patch("app.services.dispatchers.gcp_storage", mock_cloud_storage_client)
+    fake_wpswatch.api_keys = None
+    dispatcher = dispatchers.WPSWatchImageDispatcher(
+        integration=destination_integration_v2
+    )
+    related_event = schemas_v2.WPSWatchImageMetadata(camera_id="gunditest")
+    await dispatcher.send(
+        image=schemas_v2.WPSWatchImage(file_path="attachments/elephant.jpg"),
+        related_event=related_event,
+    )
+    with pytest.raises(DuplicateImage):
+        await dispatcher.send(
+            image=schemas_v2.WPSWatchImage(file_path="attachments/elephant-copy.jpg"),
+            related_event=related_event,
+        )
+    await dispatchers.close_wpswatch_clients()
+    assert fake_wpswatch.counters["uploads"] == 1
+    first_key, second_key = [c.args[0] for c in mock_redis.set.call_args_list]
+    assert first_key == second_key
+
+
+@pytest.mark.asyncio
+async def test_duplicates_left_out_of_a_batch_are_reported(
+    mocker,
+    mock_redis,
+    mock_cloud_storage_client,
+    destination_integration_v2,
+    fake_wpswatch,
+):
+    mocker.patch.object(settings, "IMAGE_DEDUP_ENABLED", True)
+    mocker.patch.object(settings, "ATTACHMENT_BATCHING_ENABLED", True)
+    mocker.patch.object(settings, "ATTACHMENT_BATCH_MAX_SIZE", 2)
+    # The second image was sent to the camera already
+    mock_redis.set.side_effect = [async_return(True), async_return(None)]
+    mocker.patch("app.services.dispatchers.redis_client", mock_redis)
+    mocker.patch("app.services.dispatchers.gcp_storage", mock_cloud_storage_client)
+    emit_event = mocker.patch.object(event_handlers, "emit_event")
+    emit_event.return_value = async_return(None)
+    fake_wpswatch.api_keys = None
+    related_event = schemas_v2.WPSWatchImageMetadata(camera_id="gunditest")
+    attributes = {
+        "related_to": "5b793d17-cd79-49c8-abaa-712cb40f2b54",
+        "data_provider_id": "ddd0946d-15b0-4308-b93d-e0470b6d33b6",
+        "destination_id": str(destination_integration_v2.id),
+    }
+    new, duplicate = await asyncio.gather(
+        event_handlers.dispatch_image(
+            integration=destination_integration_v2,
+            image=schemas_v2.WPSWatchImage(file_path="attachments/elephant.jpg"),
+            related_event=related_event,
+            attributes={**attributes, "gundi_id": "new"},
+        ),
+        event_handlers.dispatch_image(
+            integration=destination_integration_v2,
+            image=schemas_v2.WPSWatchImage(file_path="attachments/elephant-copy.jpg"),
+            related_event=related_event,
+            attributes={**attributes, "gundi_id": "duplicate"},
+        ),
+    )
+    await dispatchers.close_wpswatch_clients()
+    assert fake_wpswatch.counters["uploads"] == 1
+    assert fake_wpswatch.counters["attachments"] == 1
+    assert duplicate == {"status": "duplicate"}
+    events = {
+        str(c.kwargs["event"].payload.gundi_id): type(c.kwargs["event"])
+        for c in emit_event.call_args_list
+    }
+    assert events == {
+        "new": system_events.ObservationDelivered,
+        "duplicate": system_events.DispatcherCustomLog,
+    }
+
+
+def test_upload_timeouts_scale_with_size_and_destination_overrides(mocker):
+    mocker.patch.object(settings, "UPLOAD_RESPONSE_TIMEOUT_SEC", 10.0)
+    mocker.patch.object(settings, "UPLOAD_MIN_THROUGHPUT_KBPS", 100.0)
+    mocker.patch.object(settings, "UPLOAD_STALL_TIMEOUT_SEC", 5.0)
+    small = dispatchers.get_upload_timeout(size=100 * 1024)
+    video = dispatchers.get_upload_timeout(size=50 * 1024 * 1024)
+    assert small.read == pytest.approx(11.0)
+    assert video.read == pytest.approx(522.0)
+    assert small.write == video.write == 5.0
+    overridden = dispatchers.get_upload_timeout(
+        size=100 * 1024,
+        overrides={
+            "upload_min_throughput_kbps": "50",
+            "upload_stall_timeout_sec": "invalid",
+            "upload_response_timeout_sec": "-1",
+            "upload_domain": "upload.wpswatch.org",
+        },
+    )
+    assert overridden.read == pytest.approx(12.0)
+    assert overridden.write == 5.0
+    # A zero throughput is ignored rather than failing every upload
+    zero = dispatchers.get_upload_timeout(
+        size=100 * 1024, overrides={"upload_min_throughput_kbps": "0"}
+    )
+    assert zero.read == small.read
+
+
+@pytest.mark.asyncio
+async def test_image_hashes_are_released_when_the_upload_is_cancelled(
+    mocker,
+    mock_redis,
+    mock_cloud_storage_client,
+    destination_integration_v2,
+    fake_wpswatch,
+):
+    mocker.patch.object(settings, "IMAGE_DEDUP_ENABLED", True)
+    mock_redis.set.return_value = async_return(True)
+    mocker.patch("app.services.dispatchers.redis_client", mock_redis)
+    mocker.patch("app.services.dispatchers.gcp_storage", mock_cloud_storage_client)
+    fake_wpswatch.api_keys = None
+    fake_wpswatch.latency = lambda: 5.0
+    dispatcher = dispatchers.WPSWatchImageDispatcher(
+        integration=destination_integration_v2
+    )
+    # i.e. the push client disconnected in the middle of the upload
+    task = asyncio.ensure_future(
+        dispatcher.send(
+            image=schemas_v2.WPSWatchImage(file_path="attachments/elephant.jpg"),
+            related_event=schemas_v2.WPSWatchImageMetadata(camera_id="gunditest"),
+        )
+    )
+    while not fake_wpswatch.counters["requests"]:
+        await asyncio.sleep(0.01)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    await dispatchers.close_wpswatch_clients()
+    # So the redelivered message isn't taken as a duplicate
+    claimed_key = mock_redis.set.call_args.args[0]
+    mock_redis.delete.assert_called_once_with(claimed_key)
@@ -0,0 +1,97 @@
+import json
+import aiohttp
+import pytest
+from gundi_core import events
+from app.core import system_events
+from app.core.event_spool import EventSpool, drain
+from app.tests.conftest import async_return
+
+
+@pytest.fixture
+def spool(mocker, tmp_path):
+    spool = EventSpool(path=str(tmp_path / "events_spool.sqlite3"))
+    mocker.patch("app.core.system_events._spool", spool)
+    return spool
+
+
+@pytest.fixture
+def observation_delivered_event(observation_delivered_pubsub_message):
+    return events.ObservationDelivered.parse_obj(
+        json.loads(observation_delivered_pubsub_message.data)
+    )
+
+
+@pytest.mark.asyncio
+async def test_events_are_spooled_when_pubsub_fails_and_replayed_later(
+    mocker, spool, mock_pubsub_client, observation_delivered_event
+):
+    mocker.patch("app.core.system_events.pubsub", mock_pubsub_client)
+    mock_publisher = mock_pubsub_client.PublisherClient.return_value
+    mock_publisher.publish.side_effect = aiohttp.ClientError("Service Unavailable")
+    # The failure doesn't reach the caller, the event is kept in the spool instead
+    await system_events.publish_event(
+        event=observation_delivered_event, topic_name="dispatcher-events"
+    )
+    assert mock_publisher.publish.call_count == 1
+    assert await spool.count() == 1
+    # Pub/Sub is back
+    mock_publisher.publish.side_effect = None
+    mock_publisher.publish.return_value = async_return({"messageIds": ["1"]})
+    published = await drain(spool, system_events._publish_spooled, batch_size=10)
+    assert published == 1
+    assert await spool.count() == 0
+    await spool.close()
+
+
+@pytest.mark.asyncio
+async def test_spooled_events_are_claimed_by_one_process_at_a_time(tmp_path):
+    path = str(tmp_path / "events_spool.sqlite3")
+    spool, other_spool = EventSpool(path=path), EventSpool(path=path)
+    for i in range(3):
+        await spool.append(topic="dispatcher-events", payload=f"event {i}".encode())
+    claimed = await spool.claim_batch(limit=2)
+    assert [payload for _, _, payload in claimed] == [b"event 0", b"event 1"]
+    claimed_by_other = await other_spool.claim_batch(limit=10)
+    assert [payload for _, _, payload in claimed_by_other] == [b"event 2"]
+    # Events given back, after a failed publish, can be claimed again
+    await spool.unclaim([event_id for event_id, _, _ in claimed])
+    assert len(await other_spool.claim_batch(limit=10)) == 3
+    await spool.close()
+    await other_spool.close()
+
+
+@pytest.mark.asyncio
+async def test_emitted_events_are_published_in_background_and_drained_on_shutdown(
+    mocker, mock_pubsub_client, observation_delivered_event
+):
+    mocker.patch("app.core.system_events.pubsub", mock_pubsub_client)
+    mock_publisher = mock_pubsub_client.PublisherClient.return_value
+    emitter_tasks = system_events.start_emitter()
+    for _ in range(3):
+        await system_events.emit_event(
+            event=observation_delivered_event, topic_name="dispatcher-events"
+        )
+    # Handlers don't wait for Pub/Sub
+    assert not mock_publisher.publish.called
+    await system_events.stop_emitter(emitter_tasks)
+    assert mock_publisher.publish.call_count == 3
+    assert all(task.done() for task in emitter_tasks)
+
+
+@pytest.mark.asyncio
+async def test_spooled_events_are_replayed_on_shutdown(
+    mocker, spool, mock_pubsub_client
+):
+    mocker.patch("app.core.system_events.pubsub", mock_pubsub_client)
+    mocker.patch.object(system_events.settings, "EVENTS_SPOOL_BATCH_SIZE", 2)
+    mock_publisher = mock_pubsub_client.PublisherClient.return_value
+    mock_publisher.publish.return_value = async_return({"messageIds": ["1"]})
+    for i in range(5):
+        await spool.append(topic="dispatcher-events", payload=f"event {i}".encode())
+    await system_events.stop_spool_drainer(task=None)
+    # Replayed in batches before the instance goes away
+    assert mock_publisher.publish.call_count == 3
+    assert system_events._spool is None
+    reopened = EventSpool(path=spool.path)
+    assert await reopened.count() == 0
+    await reopened.close()
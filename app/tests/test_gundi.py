@@ -0,0 +1,142 @@
+import asyncio
+import time
+import httpx
+import pytest
+from app.core import gundi
+from app.core.cache_keys import integration_details_key, outbound_detail_key
+from app.core.errors import ReferenceDataError
+from app.core.serialization import pack, versioned_key
+from app.tests.conftest import async_return
+
+
+@pytest.mark.asyncio
+async def test_misconfigured_integration_is_cached_as_invalid(
+    mocker, mock_redis, mock_gundi_client_v2_class, destination_integration_v2
+):
+    # The API Key is missing
+    destination_integration_v2.configurations = [
+        config
+        for config in destination_integration_v2.configurations
+        if config.action.value != "auth"
+    ]
+    mocker.patch("app.core.gundi.GundiClient", mock_gundi_client_v2_class)
+    mocker.patch("app.core.gundi.redis_client", mock_redis)
+    mocker.patch("app.core.gundi._cache_db", mock_redis)
+    mocker.patch("app.core.utils.redis_client", mock_redis)
+    integration_id = str(destination_integration_v2.id)
+    with pytest.raises(ReferenceDataError):
+        await gundi.get_integration_details(integration_id=integration_id)
+    mock_redis.setex.assert_called_once_with(
+        f"{integration_details_key(integration_id)}.invalid",
+        gundi._negative_cache_ttl,
+        "misconfigured",
+    )
+    # Retries fail fast without asking the portal again
+    mock_portal = mock_gundi_client_v2_class.return_value
+    mock_portal.get_integration_details.reset_mock()
+    mock_redis.get.side_effect = lambda key: async_return(
+        "misconfigured" if key.endswith(".invalid") else None
+    )
+    with pytest.raises(ReferenceDataError):
+        await gundi.get_integration_details(integration_id=integration_id)
+    assert not mock_portal.get_integration_details.called
+
+
+@pytest.mark.asyncio
+async def test_invalidate_integration_cache_clears_known_issues(mocker, mock_redis):
+    mock_redis.publish.return_value = async_return(1)
+    mocker.patch("app.core.gundi.redis_client", mock_redis)
+    mocker.patch("app.core.gundi._cache_db", mock_redis)
+    await gundi.invalidate_integration_cache(integration_id="1234")
+    deleted_keys = mock_redis.delete.call_args.args
+    assert versioned_key(integration_details_key("1234")) in deleted_keys
+    assert f"{integration_details_key('1234')}.invalid" in deleted_keys
+    assert f"{outbound_detail_key('1234')}.invalid" in deleted_keys
+    # Other instances are notified
+    mock_redis.publish.assert_called_once_with(
+        gundi.settings.CONFIG_INVALIDATION_CHANNEL, "1234"
+    )
+
+
+@pytest.mark.asyncio
+async def test_stale_integration_details_are_served_while_refreshed_once(
+    mocker, mock_redis, mock_gundi_client_v2_class, destination_integration_v2
+):
+    integration_id = str(destination_integration_v2.id)
+    fetched_at = time.time() - gundi._cache_ttl - 1  # Past the soft TTL
+    stale_entry = pack(
+        {
+            "fetched_at": fetched_at,
+            "config": destination_integration_v2.dict(by_alias=True),
+        }
+    )
+    mock_redis.get.side_effect = lambda key: async_return(
+        stale_entry
+        if key == versioned_key(integration_details_key(integration_id))
+        else None
+    )
+    mocker.patch("app.core.gundi.GundiClient", mock_gundi_client_v2_class)
+    mocker.patch("app.core.gundi.redis_client", mock_redis)
+    mocker.patch("app.core.gundi._cache_db", mock_redis)
+    mocker.patch("app.core.utils.redis_client", mock_redis)
+    mock_portal = mock_gundi_client_v2_class.return_value
+    mock_portal.get_integration_details.side_effect = httpx.ConnectTimeout("Timeout")
+    for _ in range(3):
+        integration = await gundi.get_integration_details(integration_id=integration_id)
+        assert integration.id == destination_integration_v2.id
+    await asyncio.gather(*gundi._refresh_tasks.values())
+    # A single refresh was attempted, and its failure didn't reach the callers
+    assert mock_portal.get_integration_details.call_count == 1
+    assert not mock_redis.setex.called
+
+
+@pytest.mark.asyncio
+async def test_invalidation_messages_clear_in_process_and_shared_caches(
+    mocker, mock_redis, destination_integration_v2
+):
+    integration_id = str(destination_integration_v2.id)
+    cache_key = integration_details_key(integration_id)
+    mocker.patch("app.core.gundi.redis_client", mock_redis)
+    mocker.patch("app.core.gundi._cache_db", mock_redis)
+    mocker.patch("app.core.gundi._local_cache_enabled", True)
+    mocker.patch("app.core.gundi._local_configs", {})
+    await gundi.cache_config(cache_key, destination_integration_v2, extra_dict={})
+    # Served from memory, without going to Redis
+    config, is_stale = await gundi.read_cached_config(
+        cache_key, schema=type(destination_integration_v2), extra_dict={}
+    )
+    assert config.id == destination_integration_v2.id and not is_stale
+    assert not mock_redis.get.called
+    # The integration is updated in the portal
+    await gundi.handle_invalidation_message(
+        {"type": "message", "channel": "invalidations", "data": integration_id}
+    )
+    assert cache_key not in gundi._local_configs
+    assert versioned_key(cache_key) in mock_redis.delete.call_args.args
+
+
+@pytest.mark.asyncio
+async def test_configs_fetched_before_an_invalidation_are_not_cached(
+    mocker, mock_redis, mock_gundi_client_v2_class, destination_integration_v2
+):
+    integration_id = str(destination_integration_v2.id)
+    mocker.patch("app.core.gundi.GundiClient", mock_gundi_client_v2_class)
+    mocker.patch("app.core.gundi.redis_client", mock_redis)
+    mocker.patch("app.core.gundi._cache_db", mock_redis)
+    mocker.patch("app.core.utils.redis_client", mock_redis)
+    mocker.patch("app.core.gundi._local_cache_enabled", True)
+    mocker.patch("app.core.gundi._local_configs", {})
+
+    async def updated_while_fetching(integration_id):
+        await gundi.handle_invalidation_message(
+            {"type": "message", "channel": "invalidations", "data": integration_id}
+        )
+        return destination_integration_v2
+
+    mock_portal = mock_gundi_client_v2_class.return_value
+    mock_portal.get_integration_details.side_effect = updated_while_fetching
+    integration = await gundi.get_integration_details(integration_id=integration_id)
+    # Used for this message, but not kept in memory or in Redis
+    assert integration.id == destination_integration_v2.id
+    assert not gundi._local_configs
+    assert not mock_redis.setex.called
@@ -0,0 +1,24 @@
+import asyncio
+import logging
+import time
+import pytest
+from app.core import loop_monitor, settings
+
+
+def blocking_call():
+    time.sleep(0.3)
+
+
+@pytest.mark.asyncio
+async def test_loop_monitor_measures_lag_and_logs_blocking_stacks(mocker, caplog):
+    mocker.patch.object(settings, "LOOP_MONITOR_INTERVAL_SEC", 0.05)
+    mocker.patch.object(settings, "LOOP_SLOW_CALLBACK_THRESHOLD_MS", 100)
+    mocker.patch.object(loop_monitor, "_lags", [])
+    task = loop_monitor.start_loop_monitor()
+    await asyncio.sleep(0.1)
+    with caplog.at_level(logging.WARNING, logger=loop_monitor.__name__):
+        blocking_call()
+        await asyncio.sleep(0.1)
+    await loop_monitor.stop_loop_monitor(task)
+    assert max(loop_monitor._lags) >= 200
+    assert "blocking_call" in caplog.text
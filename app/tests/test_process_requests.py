@@ -6,9 +6,12 @@ import httpx
 from fastapi.testclient import TestClient
 from gundi_core import schemas
 from app.core import settings
-from app.core.errors import TooManyRequests
-from app.core.utils import find_config_for_action
+from app.core.cache_keys import circuit_breaker_key, image_metadata_key
+from app.core.serialization import pack, versioned_key
+from app.core.utils import find_config_for_action, CircuitBreaker
 from app.main import app
+from app.services import event_handlers
+from app.tests.conftest import async_return
 
 
 @pytest.mark.asyncio
@@ -36,6 +39,7 @@ async def test_process_cameratrap_file_successfully(
     # Mock external dependencies
     mocker.patch("app.core.gundi.portal_client", mock_gundi_client_v1)
     mocker.patch("app.core.gundi.redis_client", mock_redis)
+    mocker.patch("app.core.gundi._cache_db", mock_redis)
     mocker.patch("app.core.utils.redis_client", mock_redis)
     mocker.patch("app.services.dispatchers.redis_client", mock_redis)
     mocker.patch("app.services.dispatchers.gcp_storage", mock_cloud_storage_client)
@@ -80,6 +84,7 @@ async def test_raises_on_wpswatch_api_bad_status(
     # Mock external dependencies
     mocker.patch("app.core.gundi.portal_client", mock_gundi_client_v1)
     mocker.patch("app.core.gundi.redis_client", mock_redis)
+    mocker.patch("app.core.gundi._cache_db", mock_redis)
     mocker.patch("app.core.utils.redis_client", mock_redis)
     mocker.patch("app.services.dispatchers.redis_client", mock_redis)
     mocker.patch("app.services.dispatchers.gcp_storage", mock_cloud_storage_client)
@@ -121,6 +126,7 @@ async def test_raises_on_wpswatch_api_timeout(
     # Mock external dependencies
     mocker.patch("app.core.gundi.portal_client", mock_gundi_client_v1)
     mocker.patch("app.core.gundi.redis_client", mock_redis)
+    mocker.patch("app.core.gundi._cache_db", mock_redis)
     mocker.patch("app.core.utils.redis_client", mock_redis)
     mocker.patch("app.services.dispatchers.redis_client", mock_redis)
     mocker.patch("app.services.dispatchers.gcp_storage", mock_cloud_storage_client)
@@ -162,6 +168,7 @@ async def test_throttling_on_rate_limit_exceeded(
     # Mock external dependencies
     mocker.patch("app.core.gundi.portal_client", mock_gundi_client_v1)
     mocker.patch("app.core.gundi.redis_client", mock_redis_with_rate_limit_exceeded)
+    mocker.patch("app.core.gundi._cache_db", mock_redis_with_rate_limit_exceeded)
     mocker.patch("app.core.utils.redis_client", mock_redis_with_rate_limit_exceeded)
     mocker.patch(
         "app.services.dispatchers.redis_client", mock_redis_with_rate_limit_exceeded
@@ -175,16 +182,16 @@ async def test_throttling_on_rate_limit_exceeded(
         route = respx_mock.post(f"api/Upload", name="upload_file").respond(
             httpx.codes.OK
         )
-        # Check that the dispatcher raises an exception so the message is retried later
-        with pytest.raises(TooManyRequests):
-            with TestClient(
-                app
-            ) as api_client:  # Use as context manager to trigger lifespan hooks
-                api_client.post(
-                    "/",
-                    headers=pubsub_cloud_event_headers,
-                    json=cameratrap_v1_cloud_event_payload,
-                )
+        # Rejected with 429 so the message is retried later
+        with TestClient(
+            app
+        ) as api_client:  # Use as context manager to trigger lifespan hooks
+            response = api_client.post(
+                "/",
+                headers=pubsub_cloud_event_headers,
+                json=cameratrap_v1_cloud_event_payload,
+            )
+            assert response.status_code == httpx.codes.TOO_MANY_REQUESTS
     # Check that the wpswatch api was NOT called
     assert not route.called
     # Check that the file was retrieved but Not deleted
@@ -192,6 +199,136 @@ async def test_throttling_on_rate_limit_exceeded(
     assert not mock_cloud_storage_client.delete.called
 
 
+@pytest.mark.asyncio
+async def test_rejects_before_download_when_circuit_is_open(
+    mocker,
+    mock_redis_with_circuit_open,
+    mock_gundi_client_v1,
+    mock_cloud_storage_client,
+    mock_pubsub_client,
+    pubsub_cloud_event_headers,
+    cameratrap_v1_cloud_event_payload,
+):
+    # Mock external dependencies
+    mocker.patch("app.core.gundi.portal_client", mock_gundi_client_v1)
+    mocker.patch("app.core.gundi.redis_client", mock_redis_with_circuit_open)
+    mocker.patch("app.core.gundi._cache_db", mock_redis_with_circuit_open)
+    mocker.patch("app.core.utils.redis_client", mock_redis_with_circuit_open)
+    mocker.patch("app.services.dispatchers.redis_client", mock_redis_with_circuit_open)
+    mocker.patch("app.services.dispatchers.gcp_storage", mock_cloud_storage_client)
+    mocker.patch("app.services.process_messages.pubsub", mock_pubsub_client)
+    async with respx.mock(
+        base_url="https://wpswatch-api.test.com", assert_all_called=False
+    ) as respx_mock:
+        # Mock the WPSWatch API response
+        route = respx_mock.post(f"api/Upload", name="upload_file").respond(
+            httpx.codes.OK
+        )
+        # Rejected with 503 so the message is retried later
+        with TestClient(
+            app
+        ) as api_client:  # Use as context manager to trigger lifespan hooks
+            response = api_client.post(
+                "/",
+                headers=pubsub_cloud_event_headers,
+                json=cameratrap_v1_cloud_event_payload,
+            )
+            assert response.status_code == httpx.codes.SERVICE_UNAVAILABLE
+    # Check that neither the file was downloaded nor the wpswatch api called
+    assert not mock_cloud_storage_client.download.called
+    assert not route.called
+
+
+@pytest.mark.asyncio
+async def test_rejects_when_half_open_probes_are_in_flight(
+    mocker,
+    mock_redis_with_cached_event,
+    mock_redis_with_circuit_half_open,
+    mock_gundi_client_v2_class,
+    mock_cloud_storage_client,
+    mock_pubsub_client,
+    pubsub_cloud_event_headers,
+    attachment_v2_cloud_event_payload,
+    destination_integration_v2,
+):
+    # Mock external dependencies
+    mocker.patch("app.core.gundi.GundiClient", mock_gundi_client_v2_class)
+    mocker.patch("app.core.gundi.redis_client", mock_redis_with_circuit_half_open)
+    mocker.patch("app.core.gundi._cache_db", mock_redis_with_circuit_half_open)
+    mocker.patch("app.core.utils.redis_client", mock_redis_with_circuit_half_open)
+    mocker.patch("app.core.system_events.pubsub", mock_pubsub_client)
+    mocker.patch("app.services.event_handlers._cache_db", mock_redis_with_cached_event)
+    mocker.patch(
+        "app.services.dispatchers.redis_client", mock_redis_with_circuit_half_open
+    )
+    mocker.patch("app.services.dispatchers.gcp_storage", mock_cloud_storage_client)
+    mocker.patch("app.services.process_messages.pubsub", mock_pubsub_client)
+    async with respx.mock(
+        base_url=destination_integration_v2.base_url, assert_all_called=False
+    ) as respx_mock:
+        route = respx_mock.post(f"api/Upload", name="upload_file").respond(
+            httpx.codes.OK
+        )
+        # Only one probe is allowed until a probe succeeds
+        with TestClient(
+            app
+        ) as api_client:  # Use as context manager to trigger lifespan hooks
+            response = api_client.post(
+                "/",
+                headers=pubsub_cloud_event_headers,
+                json=attachment_v2_cloud_event_payload,
+            )
+            assert response.status_code == httpx.codes.SERVICE_UNAVAILABLE
+    # No probe slot is taken and nothing is sent
+    assert mock_redis_with_circuit_half_open.eval.call_args.args[
+        2
+    ] == circuit_breaker_key("wpswatch-api-qa.azurewebsites.net")
+    assert not mock_redis_with_circuit_half_open.hincrby.called
+    assert not mock_cloud_storage_client.download.called
+    assert not route.called
+
+
+@pytest.mark.asyncio
+async def test_circuit_opens_after_consecutive_failures(mock_redis):
+    mock_redis.eval.return_value = async_return(["open", 5, 1])  # 5th failure
+    circuit_breaker = CircuitBreaker(
+        redis_client=mock_redis, host="wpswatch-api.test.com", failure_threshold=5
+    )
+    with pytest.raises(httpx.ConnectTimeout):
+        async with circuit_breaker:
+            raise httpx.ConnectTimeout("Connection timed out")
+    assert circuit_breaker.state == CircuitBreaker.OPEN
+    mock_redis.eval.assert_called_once()
+    _, _, key, _, threshold, *_ = mock_redis.eval.call_args.args
+    assert key == circuit_breaker_key("wpswatch-api.test.com")
+    assert threshold == 5
+
+
+@pytest.mark.asyncio
+async def test_circuit_opened_by_another_instance_is_kept(mock_redis):
+    host = "wpswatch-api.test.com"
+    mock_redis.hgetall.return_value = async_return({"failures": "2"})
+    instance_a = CircuitBreaker(redis_client=mock_redis, host=host)
+    instance_b = CircuitBreaker(redis_client=mock_redis, host=host)
+    await instance_a.acquire()
+    assert instance_a.failures == 2
+    # Instance B opens the circuit while A is uploading
+    mock_redis.eval.return_value = async_return(["open", 5, 1])
+    await instance_b.record_failure()
+    assert instance_b.state == CircuitBreaker.OPEN
+    # A's success doesn't close it: the stored state is checked in the same script
+    mock_redis.eval.return_value = async_return("open")
+    await instance_a.record_success()
+    assert instance_a.state == CircuitBreaker.OPEN
+    assert not mock_redis.delete.called
+    assert mock_redis.eval.call_args.args[3] == CircuitBreaker.CLOSED
+    # Nor does a late failure open it again, extending the recovery time
+    mock_redis.eval.return_value = async_return(["open", 0, 0])
+    await CircuitBreaker(redis_client=mock_redis, host=host).record_failure()
+    assert not mock_redis.hset.called
+    assert not mock_redis.expire.called
+
+
 @pytest.mark.asyncio
 async def test_process_event_v2_successfully(
     mocker,
@@ -207,6 +344,7 @@ async def test_process_event_v2_successfully(
     # Mock external dependencies
     mocker.patch("app.core.gundi.GundiClient", mock_gundi_client_v2_class)
     mocker.patch("app.core.gundi.redis_client", mock_redis)
+    mocker.patch("app.core.gundi._cache_db", mock_redis)
     mocker.patch("app.core.utils.redis_client", mock_redis)
     mocker.patch("app.core.system_events.pubsub", mock_pubsub_client)
     mocker.patch("app.services.event_handlers._cache_db", mock_redis)
@@ -239,9 +377,9 @@ async def test_process_event_v2_successfully(
         ]
         event_data = event_v2_cloud_event_payload["message"]["data"]
         decoded_event_data = json.loads(base64.b64decode(event_data))
-        serialized_payload = json.dumps(decoded_event_data["payload"], default=str)
+        serialized_payload = pack(decoded_event_data["payload"])
         mock_redis.setex.assert_called_with(
-            name=f"wps_image_metadata.{gundi_id}.{destination_id}",
+            name=versioned_key(image_metadata_key(gundi_id, destination_id)),
             time=settings.IMAGE_METADATA_CACHE_TTL,
             value=serialized_payload,
         )
@@ -266,6 +404,7 @@ async def test_process_attachment_v2_successfully(
     # Mock external dependencies
     mocker.patch("app.core.gundi.GundiClient", mock_gundi_client_v2_class)
     mocker.patch("app.core.gundi.redis_client", mock_redis)
+    mocker.patch("app.core.gundi._cache_db", mock_redis)
     mocker.patch("app.core.utils.redis_client", mock_redis)
     mocker.patch("app.core.system_events.pubsub", mock_pubsub_client)
     mocker.patch("app.services.event_handlers._cache_db", mock_redis_with_cached_event)
@@ -329,3 +468,21 @@ async def test_process_attachment_v2_successfully(
             )
             assert response.status_code == 200
             assert route.called
+
+
+@pytest.mark.asyncio
+async def test_image_metadata_cached_by_previous_versions_is_found(mocker, mock_redis):
+    legacy_key = image_metadata_key("event-id", "destination-id")
+    legacy_cache = {legacy_key: b'{"camera_id": "gunditest"}'}
+    mock_redis.get.side_effect = lambda name: async_return(legacy_cache.get(name))
+    mocker.patch("app.services.event_handlers._cache_db", mock_redis)
+    metadata = await event_handlers.get_image_metadata_from_cache(
+        gundi_id="event-id", destination_id="destination-id"
+    )
+    assert metadata.camera_id == "gunditest"
+    # Written in both formats, so instances of the previous version can read it too
+    await event_handlers.cache_image_metadata(
+        data=metadata, gundi_id="event-id", destination_id="destination-id"
+    )
+    written_keys = [call.kwargs["name"] for call in mock_redis.setex.call_args_list]
+    assert written_keys == [legacy_key, versioned_key(legacy_key)]
@@ -0,0 +1,37 @@
+import asyncio
+import json
+import os
+import pstats
+import pytest
+from app.core import profiling, settings
+
+
+def make_body(**attributes):
+    return json.dumps({"message": {"data": "", "attributes": attributes}}).encode()
+
+
+@pytest.mark.asyncio
+async def test_request_with_profiling_token_is_profiled(mocker, tmp_path):
+    mocker.patch.object(settings, "PROFILING_TOKEN", "secret")
+    mocker.patch.object(settings, "PROFILING_OUTPUT_DIR", str(tmp_path))
+    request = mocker.MagicMock(headers={settings.PROFILING_HEADER: "secret"})
+    body = make_body(
+        gundi_id="e6795790-4a5f-4d47-ac93-de7d7713698b",
+        destination_id="79bef222-74aa-4065-88a8-ac9656246693",
+    )
+    async with profiling.profile_request(request=request, body=body):
+        await asyncio.sleep(0)
+    (profile_file,) = os.listdir(tmp_path)
+    assert "e6795790-4a5f-4d47-ac93-de7d7713698b" in profile_file
+    assert "79bef222-74aa-4065-88a8-ac9656246693" in profile_file
+    assert pstats.Stats(str(tmp_path / profile_file)).total_calls > 0
+
+
+@pytest.mark.asyncio
+async def test_requests_are_not_profiled_by_default(mocker, tmp_path):
+    mocker.patch.object(settings, "PROFILING_TOKEN", None)
+    mocker.patch.object(settings, "PROFILING_OUTPUT_DIR", str(tmp_path))
+    request = mocker.MagicMock(headers={settings.PROFILING_HEADER: "guess"})
+    async with profiling.profile_request(request=request, body=make_body()):
+        await asyncio.sleep(0)
+    assert not os.listdir(tmp_path)
@@ -0,0 +1,13 @@
+from app.core import settings
+from app import serve
+
+
+def test_worker_count_follows_available_cpus(mocker):
+    mocker.patch.object(settings, "SERVER_WORKERS", 0)
+    mocker.patch.object(settings, "SERVER_MAX_WORKERS", 8)
+    mocker.patch.object(serve, "available_cpus", return_value=4)
+    assert serve.get_worker_count() == 4
+    serve.available_cpus.return_value = 32
+    assert serve.get_worker_count() == 8
+    mocker.patch.object(settings, "SERVER_WORKERS", 2)
+    assert serve.get_worker_count() == 2
@@ -0,0 +1,66 @@
+import time
+import pytest
+from opentelemetry.sdk.trace import TracerProvider, sampling
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import (
+    InMemorySpanExporter,
+)
+from app.core import tracing
+from app.core.tracing.config import (
+    RecordUnsampledSampler,
+    KeepErrorsAndSlowSpansProcessor,
+)
+
+
+@pytest.fixture
+def span_exporter():
+    return InMemorySpanExporter()
+
+
+@pytest.fixture
+def unsampled_tracer_provider(span_exporter):
+    tracer_provider = TracerProvider(
+        sampler=RecordUnsampledSampler(sampling.TraceIdRatioBased(rate=0.0)),
+        shutdown_on_exit=False,
+    )
+    tracer_provider.add_span_processor(
+        KeepErrorsAndSlowSpansProcessor(
+            span_exporter, keep_errors=True, keep_slower_than_ms=50
+        )
+    )
+    yield tracer_provider
+    tracer_provider.shutdown()
+
+
+def test_unsampled_spans_are_exported_only_on_error_or_when_slow(
+    unsampled_tracer_provider, span_exporter
+):
+    tracer = unsampled_tracer_provider.get_tracer(__name__)
+    with tracer.start_as_current_span("dispatch_ok") as span:
+        tracing.set_bounded_attribute(span, "payload", {"camera_id": "gunditest"})
+    with pytest.raises(ValueError):
+        with tracer.start_as_current_span("dispatch_error") as span:
+            tracing.set_bounded_attribute(span, "payload", {"camera_id": "gunditest"})
+            raise ValueError("Token for integration is missing")
+    with tracer.start_as_current_span("dispatch_slow"):
+        time.sleep(0.06)
+    unsampled_tracer_provider.force_flush()  # Spans are exported in batches
+    exported_spans = {span.name: span for span in span_exporter.get_finished_spans()}
+    assert set(exported_spans) == {"dispatch_error", "dispatch_slow"}
+    # Payloads are formatted for sampled spans only
+    assert "payload" not in exported_spans["dispatch_error"].attributes
+
+
+def test_payload_attributes_are_bounded(mocker):
+    mocker.patch("app.core.settings.TRACE_MAX_ATTRIBUTE_LENGTH", 100)
+    span = mocker.MagicMock()
+    span.get_span_context.return_value.trace_flags.sampled = True
+    payload = {"file_path": "x" * 10_000, "items": list(range(10_000))}
+    tracing.set_bounded_attribute(span, "transformed_message", payload)
+    key, value = span.set_attribute.call_args.args
+    assert key == "transformed_message"
+    assert len(value) <= 100
+    # Nothing is formatted for spans not sampled
+    span.reset_mock()
+    span.get_span_context.return_value.trace_flags.sampled = False
+    tracing.set_bounded_attribute(span, "transformed_message", payload)
+    assert not span.set_attribute.called
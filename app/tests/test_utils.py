@@ -0,0 +1,161 @@
+import asyncio
+import os
+import pytest
+from aioredis import ConnectionError
+from aioredis.sentinel import Sentinel
+from app.core.errors import (
+    BulkheadFull,
+    ByteBudgetExceeded,
+    ConfigurationValidationError,
+)
+from app.core.utils import (
+    Bulkhead,
+    ByteBudget,
+    LazyClient,
+    _ByteBudgetState,
+    MeteredConnectionPool,
+    MeteredSentinelConnectionPool,
+    get_redis_pool,
+    get_worker_byte_budget,
+)
+from app.core import settings, utils
+
+
+@pytest.mark.asyncio
+async def test_lazy_client_is_created_on_first_use_and_reset_on_close(
+    mocker, mock_redis
+):
+    factory = mocker.MagicMock(return_value=mock_redis)
+    client = LazyClient(factory)
+    assert not client.is_initialized
+    assert not factory.called
+    await client.get("integration_details.1234")
+    await client.get("integration_details.5678")
+    assert factory.call_count == 1
+    await client.close()
+    assert mock_redis.close.called
+    assert not client.is_initialized
+
+
+class FakeConnection:
+    def __init__(self, **kwargs):
+        self.pid = os.getpid()
+        self.host = kwargs.get("host", "localhost")
+        self.port = kwargs.get("port", 6379)
+
+    async def connect(self):
+        pass
+
+    async def can_read(self):
+        return False
+
+    async def disconnect(self):
+        pass
+
+
+def standalone_pool(**kwargs):
+    return MeteredConnectionPool(**kwargs)
+
+
+def sentinel_pool(**kwargs):
+    pool = MeteredSentinelConnectionPool("mymaster", Sentinel([]), **kwargs)
+    pool.master_address = ("localhost", 6379)
+    return pool
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("pool_factory", [standalone_pool, sentinel_pool])
+async def test_redis_pool_tracks_connections_in_use_and_waiters(pool_factory):
+    pool = pool_factory(
+        name="test", max_connections=1, timeout=5, connection_class=FakeConnection
+    )
+    connection = await pool.get_connection("GET")
+    assert pool.in_use == 1
+    # The pool is exhausted, the next caller waits
+    waiter = asyncio.ensure_future(pool.get_connection("GET"))
+    await asyncio.sleep(0)
+    assert pool.waiting == 1
+    await pool.release(connection)
+    assert await waiter is connection
+    assert pool.waiting == 0
+    assert pool.in_use == 1
+    assert pool.size == 1
+    # Callers waiting past the timeout fail
+    pool.timeout = 0.01
+    with pytest.raises(ConnectionError):
+        await pool.get_connection("GET")
+
+
+def test_redis_pool_follows_the_configured_mode(mocker):
+    mocker.patch("app.core.utils._redis_pools", {})
+    mocker.patch("app.core.settings.REDIS_MODE", "sentinel")
+    mocker.patch(
+        "app.core.settings.REDIS_SENTINELS", ["sentinel-1:26379", "sentinel-2:26379"]
+    )
+    pool = get_redis_pool()
+    assert isinstance(pool, MeteredSentinelConnectionPool)
+    assert len(pool.sentinel_manager.sentinels) == 2
+    mocker.patch("app.core.utils._redis_pools", {})
+    mocker.patch("app.core.settings.REDIS_MODE", "cluster")
+    with pytest.raises(ConfigurationValidationError):
+        get_redis_pool()
+
+
+@pytest.mark.asyncio
+async def test_bulkhead_rejects_when_a_host_is_saturated(mocker):
+    mocker.patch("app.core.utils._bulkheads", {})
+    limits = {"max_concurrency": 1, "max_queue": 1, "max_queue_wait_sec": 5}
+    release = asyncio.Event()
+
+    async def dispatch(host):
+        async with Bulkhead(host=host, **limits):
+            await release.wait()
+
+    in_progress = asyncio.ensure_future(dispatch("slow.wpswatch.org"))
+    queued = asyncio.ensure_future(dispatch("slow.wpswatch.org"))
+    await asyncio.sleep(0)
+    # The slow site has no room left, other sites are unaffected
+    with pytest.raises(BulkheadFull):
+        await Bulkhead(host="slow.wpswatch.org", **limits).acquire()
+    other = Bulkhead(host="healthy.wpswatch.org", **limits)
+    await asyncio.wait_for(other.acquire(), timeout=1)
+    other.release()
+    release.set()
+    await asyncio.gather(in_progress, queued)
+
+
+@pytest.mark.asyncio
+async def test_byte_budget_holds_downloads_until_memory_is_freed(mocker):
+    budget = mocker.patch("app.core.utils._byte_budget", _ByteBudgetState())
+    limits = {"max_bytes": 100, "max_wait_sec": 5}
+    first = ByteBudget(nbytes=60, **limits)
+    await first.acquire()
+    # A big file waits for the memory, and the small ones arriving later wait behind it
+    big = asyncio.ensure_future(ByteBudget(nbytes=80, **limits).acquire())
+    small = asyncio.ensure_future(ByteBudget(nbytes=10, **limits).acquire())
+    await asyncio.sleep(0)
+    assert not big.done() and not small.done()
+    assert budget.in_use == 60 and budget.waiting == 90
+    # Reservations waiting past the limit are rejected
+    with pytest.raises(ByteBudgetExceeded):
+        await ByteBudget(nbytes=10, max_bytes=100, max_wait_sec=0).acquire()
+    first.release()
+    await asyncio.gather(big, small)
+    assert budget.in_use == 90 and budget.waiting == 0
+    # Files bigger than the budget are taken as the whole budget
+    assert ByteBudget(nbytes=500, **limits).nbytes == 100
+
+
+def test_byte_budget_is_shared_by_the_workers(mocker):
+    mocker.patch.object(settings, "BYTE_BUDGET_MAX_BYTES", 800)
+    assert get_worker_byte_budget(4) == 200
+    mocker.patch.object(settings, "BYTE_BUDGET_MAX_BYTES", 0)
+    mocker.patch.object(settings, "BYTE_BUDGET_MEMORY_FRACTION", 0.25)
+    mocker.patch.object(utils, "_cgroup_memory_limit", return_value=4000)
+    assert get_worker_byte_budget(2) == 500
+    # A process serving alone takes the same budget as a single worker of app.serve
+    mocker.patch.object(settings, "BYTE_BUDGET_WORKER_MAX_BYTES", 0)
+    assert ByteBudget(nbytes=0).max_bytes == get_worker_byte_budget(1) == 1000
+    utils._cgroup_memory_limit.return_value = None
+    mocker.patch.object(settings, "BYTE_BUDGET_NO_LIMIT_MAX_BYTES", 1000)
+    assert get_worker_byte_budget(8) == 125
@@ -0,0 +1,49 @@
+import pytest
+import respx
+import httpx
+from fastapi.testclient import TestClient
+from app.main import app
+from app.services import warmup, dispatchers
+from app.tests.conftest import async_return
+
+
+@pytest.mark.asyncio
+async def test_warmup_preloads_active_destinations_and_upload_hosts(
+    mocker, mock_redis, mock_gundi_client_v2_class, destination_integration_v2
+):
+    destination_id = str(destination_integration_v2.id)
+    upload_host = destination_integration_v2.base_url.rstrip("/")
+    recently_used = {
+        dispatchers.ACTIVE_DESTINATIONS_KEY: [destination_id],
+        dispatchers.UPLOAD_HOSTS_KEY: [upload_host],
+    }
+    mock_redis.zrevrange.side_effect = lambda key, start, end: async_return(
+        recently_used[key]
+    )
+    mocker.patch("app.core.utils.redis_client", mock_redis)
+    mocker.patch("app.core.gundi.redis_client", mock_redis)
+    mocker.patch("app.core.gundi._cache_db", mock_redis)
+    mocker.patch("app.services.event_handlers._cache_db", mock_redis)
+    mocker.patch("app.core.gundi.GundiClient", mock_gundi_client_v2_class)
+    async with respx.mock(assert_all_called=True) as respx_mock:
+        route = respx_mock.head(upload_host).respond(httpx.codes.OK)
+        await warmup.warm_up()
+    await dispatchers.close_wpswatch_clients()
+    assert warmup.status == warmup.WarmupStatus.DONE
+    assert mock_redis.ping.called
+    assert route.called
+    # Integration details were retrieved from the portal and cached
+    mock_gundi_client_v2_class.return_value.get_integration_details.assert_called_with(
+        integration_id=destination_id
+    )
+
+
+def test_health_check_reports_unavailable_until_warmup_finishes(mocker):
+    mocker.patch("app.main.warmup.start_warmup", return_value=None)
+    mocker.patch.object(warmup, "status", warmup.WarmupStatus.PENDING)
+    with TestClient(app) as api_client:
+        response = api_client.get("/")
+        assert response.status_code == 503
+        warmup.status = warmup.WarmupStatus.TIMED_OUT
+        response = api_client.get("/")
+        assert response.status_code == 200
@@ -0,0 +1,116 @@
+"""
+Compare the cache encodings for integration configs and image metadata: pydantic JSON
+with validated reads (previous format) vs msgpack with trusted reads (current format).
+
+Reports encode and decode time per entry, and bytes per entry as stored in Redis.
+
+Usage:
+    python -m benchmarks.cache_encoding --iterations 20000 --configurations 10
+"""
+import argparse
+import os
+import timeit
+import uuid
+
+os.environ.setdefault("GCP_ENVIRONMENT_ENABLED", "false")
+os.environ.setdefault("TRACING_ENABLED", "false")
+os.environ.setdefault("LOGGING_LEVEL", "WARNING")
+
+from gundi_core.schemas import v2 as gundi_schemas_v2  # noqa: E402
+from app.core.serialization import pack_model, unpack_model  # noqa: E402
+
+
+def make_integration(configurations: int) -> gundi_schemas_v2.Integration:
+    integration_id = str(uuid.uuid4())
+    action = {
+        "id": str(uuid.uuid4()),
+        "type": "push",
+        "name": "Push Events",
+        "value": "push_events",
+    }
+    return gundi_schemas_v2.Integration.parse_obj(
+        {
+            "id": integration_id,
+            "name": "WPS Watch Site",
+            "base_url": "https://wpswatch-api.example.com",
+            "enabled": True,
+            "type": {
+                "id": str(uuid.uuid4()),
+                "name": "WPSWatch",
+                "value": "wps_watch",
+                "description": "",
+                "actions": [
+                    {
+                        **action,
+                        "description": "",
+                        "schema": {
+                            "type": "object",
+                            "required": ["upload_domain"],
+                            "properties": {"upload_domain": {"type": "string"}},
+                        },
+                    }
+                ],
+            },
+            "owner": {"id": str(uuid.uuid4()), "name": "Org", "description": ""},
+            "configurations": [
+                {
+                    "id": str(uuid.uuid4()),
+                    "integration": integration_id,
+                    "action": action,
+                    "data": {"upload_domain": f"upload-{i}.wpswatch.example.com"},
+                }
+                for i in range(configurations)
+            ],
+            "additional": {"topic": "wpswatch-topic", "broker": "gcp_pubsub"},
+            "status": "healthy",
+            "status_details": "",
+        }
+    )
+
+
+def measure(label, model, iterations):
+    schema = type(model)
+    json_data = model.json().encode()
+    msgpack_data = pack_model(model)
+    results = {
+        "json": (
+            timeit.timeit(lambda: model.json(), number=iterations),
+            timeit.timeit(lambda: schema.parse_raw(json_data), number=iterations),
+            len(json_data),
+        ),
+        "msgpack": (
+            timeit.timeit(lambda: pack_model(model), number=iterations),
+            timeit.timeit(
+                lambda: unpack_model(schema, msgpack_data), number=iterations
+            ),
+            len(msgpack_data),
+        ),
+    }
+    print(f"\n{label}")
+    for encoding, (encode_time, decode_time, size) in results.items():
+        print(
+            f"  {encoding:<8} encode {encode_time / iterations * 1e6:7.1f} us   "
+            f"decode {decode_time / iterations * 1e6:7.1f} us   {size:6d} bytes"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument(
+        "--configurations", type=int, default=10, help="Configurations per integration"
+    )
+    args = parser.parse_args()
+
+    measure(
+        "Integration details", make_integration(args.configurations), args.iterations
+    )
+    measure(
+        "Image metadata",
+        gundi_schemas_v2.WPSWatchImageMetadata(camera_id="camera-1234"),
+        args.iterations,
+    )
+
+
+if __name__ == "__main__":
+    main()
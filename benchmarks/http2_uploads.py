@@ -0,0 +1,181 @@
+"""
+Compare upload throughput to a WPS Watch site using HTTP/2 multiplexing vs HTTP/1.1 pooling.
+
+A fake upload endpoint is served locally with hypercorn over TLS, so the protocol is
+negotiated through ALPN as it is with real WPS Watch sites. Uploads go through the
+dispatcher's shared client (`dispatchers.wpswatch_upload`).
+
+Usage:
+    python -m benchmarks.http2_uploads --uploads 500 --concurrency 50 --size-kb 200 --latency-ms 50
+"""
+import argparse
+import asyncio
+import datetime
+import multiprocessing
+import os
+import tempfile
+import time
+
+# Run the dispatcher code without GCP or tracing
+os.environ.setdefault("GCP_ENVIRONMENT_ENABLED", "false")
+os.environ.setdefault("TRACING_ENABLED", "false")
+os.environ.setdefault("LOGGING_LEVEL", "WARNING")
+
+HOST = "localhost"
+
+
+def generate_certificate(directory):
+    """
+    Self-signed certificate for localhost. It's also used as the CA bundle by the client.
+    """
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, HOST)])
+    now = datetime.datetime.utcnow()
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(x509.SubjectAlternativeName([x509.DNSName(HOST)]), False)
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), True)
+        .sign(key, hashes.SHA256())
+    )
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    with open(certfile, "wb") as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(keyfile, "wb") as f:
+        f.write(
+            key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.TraditionalOpenSSL,
+                serialization.NoEncryption(),
+            )
+        )
+    return certfile, keyfile
+
+
+def make_upload_app(latency_ms):
+    connections = set()
+
+    async def app(scope, receive, send):
+        if scope["type"] != "http":
+            return
+        if scope["path"] == "/_stats":
+            body = f'{{"connections": {len(connections)}}}'.encode()
+        else:
+            connections.add(tuple(scope["client"]))
+            more_body = True
+            while more_body:
+                message = await receive()
+                more_body = message.get("more_body", False)
+            await asyncio.sleep(latency_ms / 1000)  # Simulated site processing / RTT
+            body = b'{"status": "ok"}'
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"content-type", b"application/json")],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+
+    return app
+
+
+def run_server(port, certfile, keyfile, latency_ms):
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    config = Config()
+    config.bind = [f"{HOST}:{port}"]
+    config.certfile = certfile
+    config.keyfile = keyfile
+    config.alpn_protocols = ["h2", "http/1.1"]
+    config.loglevel = "ERROR"
+    asyncio.run(serve(make_upload_app(latency_ms), config))
+
+
+async def run_uploads(http2, url, uploads, concurrency, payload):
+    from app.core import settings
+    from app.services import dispatchers
+
+    settings.WPSWATCH_HTTP2_ENABLED = http2
+    semaphore = asyncio.Semaphore(concurrency)
+    protocols = set()
+
+    async def upload(i):
+        async with semaphore:
+            response = await dispatchers.wpswatch_upload(
+                f"{url}/api/Upload",
+                data={"From": "gundiservice.org", "To": f"camera{i}@upload.test"},
+                headers={"Wps-Api-Key": "benchmark"},
+                files={"Attachment1": (f"image{i}.jpg", payload)},
+                timeout=30,
+            )
+            response.raise_for_status()
+            protocols.add(response.http_version)
+
+    # Warm up so connection setup doesn't skew the comparison
+    await upload(-1)
+    start = time.perf_counter()
+    await asyncio.gather(*[upload(i) for i in range(uploads)])
+    elapsed = time.perf_counter() - start
+    stats = (await dispatchers.get_wpswatch_client(http2).get(f"{url}/_stats")).json()
+    await dispatchers.close_wpswatch_clients()
+    return elapsed, protocols, stats["connections"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--uploads", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--size-kb", type=int, default=200)
+    parser.add_argument("--latency-ms", type=int, default=50)
+    parser.add_argument("--port", type=int, default=8443)
+    args = parser.parse_args()
+
+    payload = os.urandom(args.size_kb * 1024)
+    url = f"https://{HOST}:{args.port}"
+    with tempfile.TemporaryDirectory() as directory:
+        certfile, keyfile = generate_certificate(directory)
+        os.environ["SSL_CERT_FILE"] = certfile  # Trusted by httpx
+        print(
+            f"{args.uploads} uploads of {args.size_kb} KB, concurrency {args.concurrency}, "
+            f"server latency {args.latency_ms} ms"
+        )
+        print(f"{'mode':<10}{'seconds':>10}{'uploads/s':>12}{'MB/s':>10}{'conns':>8}")
+        for http2 in (False, True):
+            # A fresh server per mode, so connection counts are not mixed up
+            server = multiprocessing.Process(
+                target=run_server,
+                args=(args.port, certfile, keyfile, args.latency_ms),
+                daemon=True,
+            )
+            server.start()
+            time.sleep(1.5)
+            try:
+                elapsed, protocols, connections = asyncio.run(
+                    run_uploads(http2, url, args.uploads, args.concurrency, payload)
+                )
+            finally:
+                server.terminate()
+                server.join()
+            mode = "/".join(sorted(protocols))
+            megabytes = args.uploads * args.size_kb / 1024
+            print(
+                f"{mode:<10}{elapsed:>10.2f}{args.uploads / elapsed:>12.1f}"
+                f"{megabytes / elapsed:>10.1f}{connections:>8}"
+            )
+
+
+if __name__ == "__main__":
+    main()
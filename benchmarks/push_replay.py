@@ -0,0 +1,284 @@
+"""
+Replay Pub/Sub push requests against a running dispatcher and report how it copes with the load.
+
+Envelopes are read from a JSON lines file of recorded requests, one `{"headers": {...}, "body": {...}}`
+(or just the push body) per line, or synthesized from templates: v1 camera trap, v2 event and
+v2 attachment. Before sending, `ce-time`/`publish_time` are set to the current time and the
+message, event and Gundi ids are replaced, so messages are neither discarded as too old nor
+deduplicated. Attachments are related to the latest event sent with the Gundi id they refer to
+(the event template for synthesized ones), so they find the event metadata cached by it.
+
+Requests are sent open loop: arrivals follow the schedule (a constant rate, or Poisson arrivals
+at the same mean rate) whether or not earlier requests have completed. Latencies are measured
+from the scheduled send time, so a backed up client doesn't hide server delays.
+
+Reports latency percentiles, the status code mix and the throttling rate (429/503 responses,
+returned by the dispatcher when rate limited, out of capacity or with the circuit open).
+
+Usage:
+    python -m benchmarks.push_replay --url http://localhost:8080 --rps 50 --duration 30 \\
+        --arrivals poisson --mix event=2,attachment=1,camera_trap=1
+    python -m benchmarks.push_replay --url http://localhost:8080 --recorded requests.jsonl
+"""
+import argparse
+import asyncio
+import base64
+import collections
+import copy
+import datetime
+import itertools
+import json
+import random
+import time
+import uuid
+
+import httpx
+
+SUBSCRIPTION = "projects/MY-PROJECT/subscriptions/MY-SUB"
+PUBSUB_HEADERS = {
+    "Content-Type": "application/json",
+    "ce-specversion": "1.0",
+    "ce-type": "google.cloud.pubsub.topic.v1.messagePublished",
+    "ce-source": "//pubsub.googleapis.com/projects/MY-PROJECT/topics/MY-TOPIC",
+}
+THROTTLED_STATUS_CODES = {429, 503}
+
+V2_ATTRIBUTES = {
+    "gundi_version": "v2",
+    "provider_key": "gundi_trap_tagger_d88ac520-2bf6-4e6b-ab09-38ed1ec6947a",
+    "source_id": "ac1b9cdc-a193-4515-b446-b177bcc5f342",
+    "external_source_id": "gunditest",
+    "destination_id": "79bef222-74aa-4065-88a8-ac9656246693",
+    "data_provider_id": "d88ac520-2bf6-4e6b-ab09-38ed1ec6947a",
+    "annotations": "{}",
+    "tracing_context": "{}",
+}
+TEMPLATES = {
+    "camera_trap": (
+        {
+            "file": "cameratrap.jpg",
+            "camera_name": "Mariano's Camera",
+            "camera_description": "test camera",
+            "time": "2023-03-07 11:51:00-03:00",
+            "location": '{"longitude": -122.5, "latitude": 48.65}',
+        },
+        {
+            "observation_type": "ct",
+            "device_id": "Mariano Camera",
+            "outbound_config_id": "5f658487-67f7-43f1-8896-d78778e49c30",
+            "integration_id": "a244fddd-3f64-4298-81ed-b6fccc60cef8",
+            "tracing_context": "{}",
+        },
+    ),
+    "event": (
+        {
+            "event_id": "b6294ace-dc8c-4820-ad90-be2f948a06db",
+            "timestamp": "2024-08-20 21:10:32.569895+00:00",
+            "schema_version": "v1",
+            "payload": {"camera_id": "gunditest"},
+            "event_type": "EventTransformedWPSWatch",
+        },
+        {
+            **V2_ATTRIBUTES,
+            "gundi_id": "2a1e0e6c-334f-42fe-9d45-12c34ed4866f",
+            "related_to": "None",
+            "stream_type": "ev",
+        },
+    ),
+    "attachment": (
+        {
+            "event_id": "47a464ab-99f0-4d0e-8d0c-b554b245b8a2",
+            "timestamp": "2024-08-20 21:43:53.129679+00:00",
+            "schema_version": "v1",
+            "payload": {"file_path": "attachments/elephant_africa_animal_216932.jpg"},
+            "event_type": "AttachmentTransformedWPSWatch",
+        },
+        {
+            **V2_ATTRIBUTES,
+            "gundi_id": "e6795790-4a5f-4d47-ac93-de7d7713698b",
+            "related_to": "2a1e0e6c-334f-42fe-9d45-12c34ed4866f",
+            "stream_type": "att",
+        },
+    ),
+}
+
+
+def synthesize(kind: str) -> dict:
+    data, attributes = TEMPLATES[kind]
+    return {
+        "headers": dict(PUBSUB_HEADERS),
+        "body": {
+            "message": {
+                "data": base64.b64encode(json.dumps(data).encode()).decode(),
+                "attributes": dict(attributes),
+            },
+            "subscription": SUBSCRIPTION,
+        },
+    }
+
+
+def load_recorded(path: str) -> list:
+    envelopes = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if "body" not in record:  # Just the push body
+                record = {"headers": dict(PUBSUB_HEADERS), "body": record}
+            envelopes.append(record)
+    return envelopes
+
+
+def parse_mix(mix: str) -> list:
+    kinds = []
+    for item in mix.split(","):
+        kind, _, weight = item.partition("=")
+        if kind not in TEMPLATES:
+            raise ValueError(f"Unknown message kind '{kind}': {', '.join(TEMPLATES)}")
+        kinds.extend([kind] * int(weight or 1))
+    return kinds
+
+
+def refresh(envelope: dict, sent_ids: dict) -> dict:
+    """
+    Make a recorded or synthesized envelope look like a new message published just now.
+    sent_ids maps the original Gundi ids of the events sent to their new ids.
+    """
+    envelope = copy.deepcopy(envelope)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    message_id = str(random.randint(10**14, 10**15 - 1))
+    headers = envelope["headers"]
+    headers["ce-time"] = now.isoformat(timespec="milliseconds").replace("+00:00", "Z")
+    headers["ce-id"] = message_id
+    message = envelope["body"]["message"]
+    message["publish_time"] = headers["ce-time"]
+    message["message_id"] = message["messageId"] = message_id
+    attributes = message.setdefault("attributes", {})
+    if attributes.get("gundi_version") == "v2":
+        original_id = attributes.get("gundi_id")
+        attributes["gundi_id"] = str(uuid.uuid4())
+        if attributes.get("stream_type") == "ev":
+            sent_ids[original_id] = attributes["gundi_id"]
+        elif attributes.get("related_to") in sent_ids:
+            # Related to the latest copy of the event, if it was sent already
+            attributes["related_to"] = sent_ids[attributes["related_to"]]
+        data = json.loads(base64.b64decode(message["data"]))
+        data["event_id"] = str(uuid.uuid4())
+        data["timestamp"] = now.isoformat()
+        message["data"] = base64.b64encode(json.dumps(data).encode()).decode()
+    return envelope
+
+
+def arrival_times(rps: float, duration: float, arrivals: str):
+    """
+    Send offsets, in seconds from the start of the run
+    """
+    offset = 0.0
+    while True:
+        if arrivals == "poisson":
+            offset += random.expovariate(rps)
+        else:
+            offset += 1 / rps
+        if offset >= duration:
+            return
+        yield offset
+
+
+async def replay(args, envelopes):
+    results = []
+    sent_ids = {}
+    limits = httpx.Limits(max_connections=args.max_connections)
+    async with httpx.AsyncClient(
+        base_url=args.url, limits=limits, timeout=args.timeout
+    ) as client:
+
+        async def send(scheduled, envelope):
+            envelope = refresh(envelope, sent_ids)
+            try:
+                response = await client.post(
+                    "/", headers=envelope["headers"], json=envelope["body"]
+                )
+            except httpx.HTTPError as e:
+                outcome = type(e).__name__
+                throttled = False
+            else:
+                outcome = str(response.status_code)
+                throttled = response.status_code in THROTTLED_STATUS_CODES
+            results.append((time.perf_counter() - scheduled, outcome, throttled))
+
+        start = time.perf_counter()
+        tasks = []
+        envelopes = itertools.cycle(envelopes)
+        for offset in arrival_times(args.rps, args.duration, args.arrivals):
+            scheduled = start + offset
+            await asyncio.sleep(max(scheduled - time.perf_counter(), 0))
+            tasks.append(asyncio.ensure_future(send(scheduled, next(envelopes))))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+    return results, elapsed
+
+
+def percentile(samples, pct) -> float:
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * pct / 100), len(samples) - 1)]
+
+
+def report(results, elapsed):
+    if not results:
+        print("No requests were sent")
+        return
+    latencies = [latency * 1000 for latency, _, _ in results]
+    print(f"{len(results)} requests in {elapsed:.1f}s ({len(results) / elapsed:.1f}/s)")
+    print(
+        "latency ms   "
+        + "   ".join(f"p{p} {percentile(latencies, p):.1f}" for p in (50, 90, 99))
+        + f"   max {max(latencies):.1f}"
+    )
+    outcomes = collections.Counter(outcome for _, outcome, _ in results)
+    print(
+        "status codes "
+        + "   ".join(
+            f"{outcome}: {count}" for outcome, count in sorted(outcomes.items())
+        )
+    )
+    throttled = sum(1 for _, _, is_throttled in results if is_throttled)
+    print(f"throttled    {throttled} ({throttled / len(results):.1%})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--url", default="http://localhost:8080")
+    parser.add_argument("--rps", type=float, default=20.0)
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument(
+        "--arrivals", choices=["constant", "poisson"], default="poisson"
+    )
+    parser.add_argument(
+        "--mix",
+        default="event=1,attachment=1,camera_trap=1",
+        help=f"Weighted message kinds to synthesize ({', '.join(TEMPLATES)})",
+    )
+    parser.add_argument("--recorded", help="JSON lines file with recorded requests")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--max-connections", type=int, default=1000)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    if args.recorded:
+        envelopes = load_recorded(args.recorded)
+    else:
+        kinds = parse_mix(args.mix)
+        random.shuffle(kinds)
+        envelopes = [synthesize(kind) for kind in kinds]
+    print(
+        f"Replaying {len(envelopes)} envelope(s) to {args.url} at {args.rps}/s "
+        f"({args.arrivals} arrivals) for {args.duration}s"
+    )
+    results, elapsed = asyncio.run(replay(args, envelopes))
+    report(results, elapsed)
+
+
+if __name__ == "__main__":
+    main()
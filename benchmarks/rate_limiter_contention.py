@@ -0,0 +1,259 @@
+"""
+Measure how the distributed rate limiter behaves under contention on a single URL key.
+
+N processes x M coroutines try to acquire the limiter for the same URL against a local Redis,
+holding it for a while when admitted. For each limiter implementation it reports:
+  - acquire latency (admitted and rejected attempts)
+  - Redis commands per acquire attempt, from the server's INFO commandstats
+  - over-admission: admissions while the limit was already reached by other holders
+  - fairness: Jain's index over the admissions per coroutine (1.0 is perfectly fair)
+
+Implementations are compared side by side. Besides the built-in ones, any class with the
+RateLimiterSemaphore interface can be given as module:Class.
+
+Usage:
+    python -m benchmarks.rate_limiter_contention --redis-url redis://localhost:6379/15 \\
+        --processes 4 --coroutines 100 --duration 10 --hold-ms 50 \\
+        --implementations pipeline lua
+"""
+import argparse
+import asyncio
+import importlib
+import multiprocessing
+import os
+import statistics
+import time
+
+os.environ.setdefault("GCP_ENVIRONMENT_ENABLED", "false")
+os.environ.setdefault("TRACING_ENABLED", "false")
+os.environ.setdefault("LOGGING_LEVEL", "WARNING")
+
+URL = "https://wpswatch-api.example.com/api/Upload"
+
+
+class LuaRateLimiter:
+    """
+    Alternative for comparison: a single round trip per acquire, rejected attempts
+    don't count against the limit and don't push back the expiration of the key.
+    """
+
+    ACQUIRE_SCRIPT = """
+    local count = redis.call('INCR', KEYS[1])
+    if count == 1 or redis.call('TTL', KEYS[1]) == -1 then
+        redis.call('EXPIRE', KEYS[1], ARGV[2])
+    end
+    if count > tonumber(ARGV[1]) then
+        redis.call('DECR', KEYS[1])
+        return -count
+    end
+    return count
+    """
+    # Once the key has expired, late releases must not drive the counter negative
+    RELEASE_SCRIPT = """
+    if tonumber(redis.call('GET', KEYS[1]) or '0') > 0 then
+        return redis.call('DECR', KEYS[1])
+    end
+    return 0
+    """
+
+    def __init__(self, redis_client, url, **kwargs):
+        from app.core.cache_keys import rate_limiter_key
+        from app.core import settings
+
+        self.redis_client = redis_client
+        self.key = rate_limiter_key(url)
+        self.max_requests = kwargs.get("max_requests", settings.MAX_REQUESTS)
+        self.max_requests_time_window_sec = kwargs.get(
+            "max_requests_time_window_sec", settings.MAX_REQUESTS_TIME_WINDOW_SEC
+        )
+        self._acquire = redis_client.register_script(self.ACQUIRE_SCRIPT)
+        self._release = redis_client.register_script(self.RELEASE_SCRIPT)
+
+    async def __aenter__(self):
+        from app.core.errors import TooManyRequests
+
+        count = await self._acquire(
+            keys=[self.key],
+            args=[self.max_requests, self.max_requests_time_window_sec],
+        )
+        if count < 0:
+            raise TooManyRequests(f"Too many requests: {-count}")
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self._release(keys=[self.key])
+
+
+IMPLEMENTATIONS = {
+    "pipeline": "app.core.utils:RateLimiterSemaphore",
+    "lua": f"{__name__}:LuaRateLimiter",
+}
+
+
+def load_implementation(name: str):
+    module_name, class_name = IMPLEMENTATIONS.get(name, name).split(":")
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+async def run_coroutine(limiter_cls, redis, args, deadline, records):
+    from app.core.errors import TooManyRequests
+
+    while time.time() < deadline:
+        limiter = limiter_cls(
+            redis_client=redis,
+            url=URL,
+            max_requests=args.max_requests,
+            max_requests_time_window_sec=args.window_sec,
+        )
+        start = time.time()
+        try:
+            async with limiter:
+                admitted_at = time.time()
+                await asyncio.sleep(args.hold_ms / 1000)
+                released_at = time.time()
+        except TooManyRequests:
+            records["rejected"].append(time.time() - start)
+            await asyncio.sleep(args.retry_ms / 1000)
+        else:
+            records["admitted"].append(admitted_at - start)
+            records["holds"].append((admitted_at, released_at))
+
+
+def run_process(implementation, args, start_at, results):
+    import aioredis
+
+    async def main():
+        redis = aioredis.from_url(
+            args.redis_url,
+            decode_responses=True,
+            max_connections=args.coroutines,
+        )
+        limiter_cls = load_implementation(implementation)
+        await asyncio.sleep(max(start_at - time.time(), 0))
+        deadline = start_at + args.duration
+        records = [
+            {"admitted": [], "rejected": [], "holds": []}
+            for _ in range(args.coroutines)
+        ]
+        await asyncio.gather(
+            *[run_coroutine(limiter_cls, redis, args, deadline, r) for r in records]
+        )
+        await redis.close()
+        return records
+
+    results.put(asyncio.run(main()))
+
+
+async def redis_command_calls(redis_url) -> int:
+    import aioredis
+
+    redis = aioredis.from_url(redis_url, decode_responses=True)
+    stats = await redis.info("commandstats")
+    await redis.close()
+    return sum(stats[name]["calls"] for name in stats if name != "cmdstat_info")
+
+
+def over_admissions(holds, limit) -> int:
+    """
+    Admissions that happened while `limit` holders already had the limiter
+    """
+    events = sorted(
+        [(admitted, 1) for admitted, _ in holds]
+        + [(released, -1) for _, released in holds]
+    )
+    holders = over = 0
+    for _, change in events:
+        if change > 0 and holders >= limit:
+            over += 1
+        holders += change
+    return over
+
+
+def jain_index(values) -> float:
+    if not any(values):
+        return 0.0
+    return sum(values) ** 2 / (len(values) * sum(v * v for v in values))
+
+
+def percentile(samples, pct) -> float:
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * pct / 100), len(samples) - 1)]
+
+
+def run_implementation(implementation, args):
+    import aioredis
+
+    async def reset():
+        redis = aioredis.from_url(args.redis_url)
+        await redis.flushdb()
+        await redis.config_resetstat()
+        await redis.close()
+
+    asyncio.run(reset())
+    results = multiprocessing.Queue()
+    start_at = time.time() + 1.0  # Processes start together
+    processes = [
+        multiprocessing.Process(
+            target=run_process, args=(implementation, args, start_at, results)
+        )
+        for _ in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+    records = [record for _ in processes for record in results.get()]
+    for process in processes:
+        process.join()
+    commands = asyncio.run(redis_command_calls(args.redis_url))
+
+    admitted = [latency for r in records for latency in r["admitted"]]
+    rejected = [latency for r in records for latency in r["rejected"]]
+    holds = [hold for r in records for hold in r["holds"]]
+    attempts = len(admitted) + len(rejected)
+    latencies = admitted + rejected
+    print(f"\n{implementation}")
+    print(
+        f"  attempts {attempts}   admitted {len(admitted)}   rejected {len(rejected)}   "
+        f"admitted/s {len(admitted) / args.duration:.1f}"
+    )
+    print(
+        f"  acquire latency ms   p50 {percentile(latencies, 50) * 1000:.2f}   "
+        f"p99 {percentile(latencies, 99) * 1000:.2f}   max {max(latencies or [0]) * 1000:.2f}"
+    )
+    print(f"  Redis commands per attempt {commands / max(attempts, 1):.2f}")
+    print(
+        f"  over-admissions {over_admissions(holds, args.max_requests)}   "
+        f"fairness {jain_index([len(r['admitted']) for r in records]):.3f}"
+    )
+    if admitted:
+        print(f"  mean admitted latency ms {statistics.mean(admitted) * 1000:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--redis-url", default="redis://localhost:6379/15")
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--coroutines", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--hold-ms", type=float, default=50.0)
+    parser.add_argument("--retry-ms", type=float, default=10.0)
+    parser.add_argument("--max-requests", type=int, default=3)
+    parser.add_argument("--window-sec", type=int, default=1)
+    parser.add_argument(
+        "--implementations",
+        nargs="+",
+        default=list(IMPLEMENTATIONS),
+        help=f"Built-in ({', '.join(IMPLEMENTATIONS)}) or module:Class",
+    )
+    args = parser.parse_args()
+    print(
+        f"{args.processes} processes x {args.coroutines} coroutines, "
+        f"limit {args.max_requests} per {args.window_sec}s, hold {args.hold_ms}ms"
+    )
+    for implementation in args.implementations:
+        run_implementation(implementation, args)
+
+
+if __name__ == "__main__":
+    main()
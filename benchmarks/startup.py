@@ -0,0 +1,112 @@
+"""
+Track cold start costs: import time of app.main and time-to-first-request of a new instance.
+
+Each run uses a fresh interpreter, as a new instance on a scale-to-zero platform does.
+The slowest imports are listed from `python -X importtime` to spot new heavy modules.
+
+Usage:
+    python -m benchmarks.startup --runs 5 --port 8181
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+ENV = {
+    **os.environ,
+    "LOGGING_LEVEL": "WARNING",
+    # Startup shouldn't need GCP credentials or network access
+    "GCP_ENVIRONMENT_ENABLED": os.environ.get("GCP_ENVIRONMENT_ENABLED", "false"),
+    "TRACING_ENABLED": os.environ.get("TRACING_ENABLED", "false"),
+}
+IMPORT_SNIPPET = (
+    "import time; start = time.perf_counter(); import app.main; "
+    "print(time.perf_counter() - start)"
+)
+
+
+def measure_import_time() -> float:
+    output = subprocess.check_output(
+        [sys.executable, "-c", IMPORT_SNIPPET], env=ENV, text=True
+    )
+    return float(output.strip().splitlines()[-1])
+
+
+def slowest_imports(top: int):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app.main"],
+        env=ENV,
+        capture_output=True,
+        text=True,
+    )
+    timings = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, module = line.split("|")
+        timings.append((int(cumulative_us), module.rstrip()))
+    return sorted(timings, reverse=True)[:top]
+
+
+def measure_time_to_first_request(port: int, timeout: float = 30.0) -> float:
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "app.main:app",
+            "--port",
+            str(port),
+            "--log-level",
+            "warning",
+        ],
+        env=ENV,
+    )
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                response = httpx.get(f"http://127.0.0.1:{port}/", timeout=1.0)
+            except httpx.TransportError:
+                time.sleep(0.01)
+                continue
+            if response.status_code == 200:
+                return time.perf_counter() - start
+            time.sleep(0.01)
+        raise TimeoutError(f"The server didn't respond within {timeout} seconds")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def summary(label, samples):
+    return (
+        f"{label:<24} median {statistics.median(samples) * 1000:8.1f} ms   "
+        f"min {min(samples) * 1000:8.1f} ms   max {max(samples) * 1000:8.1f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8181)
+    parser.add_argument("--top", type=int, default=15, help="Slowest imports to list")
+    args = parser.parse_args()
+
+    import_times = [measure_import_time() for _ in range(args.runs)]
+    first_request_times = [
+        measure_time_to_first_request(args.port) for _ in range(args.runs)
+    ]
+    print(summary("import app.main", import_times))
+    print(summary("time to first request", first_request_times))
+    print("\nSlowest imports (cumulative):")
+    for cumulative_us, module in slowest_imports(args.top):
+        print(f"{cumulative_us / 1000:8.1f} ms  {module}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+"""
+Measure how the dispatcher's throughput scales with the number of worker processes of `app.serve`.
+
+For each worker count (and loop/HTTP implementation), a server is started in a fresh process and
+loaded by several client processes keeping a fixed number of Pub/Sub push requests in flight.
+Requests are `POST /` with envelopes synthesized as in `benchmarks.push_replay` (or recorded ones),
+refreshed before each send, so every request goes through the whole dispatch: config lookup,
+image download and upload. Uploads go to a fake WPS Watch site (`app.tests.fake_wpswatch`), started
+here unless `--wpswatch-url` is given, and the uploads it received are reported per second.
+
+The dispatcher runs with the environment of this process: Redis, the files bucket and the portal
+(or its cached configs) must be reachable, with the destinations of the envelopes pointing at the
+fake site (http://localhost:8282 by default).
+
+Usage:
+    python -m benchmarks.worker_scaling --workers 1 2 4 --clients 4 --concurrency 32 --duration 10
+    python -m benchmarks.worker_scaling --workers 4 --stacks asyncio/h11 uvloop/httptools \\
+        --mix event=2,attachment=1 --wpswatch-latency lognormal:0.2:0.5
+"""
+import argparse
+import asyncio
+import itertools
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import time
+from urllib.parse import urlparse
+
+import httpx
+
+from benchmarks.push_replay import (
+    THROTTLED_STATUS_CODES,
+    load_recorded,
+    parse_mix,
+    refresh,
+    synthesize,
+)
+
+ENV = {
+    **os.environ,
+    "LOGGING_LEVEL": "WARNING",
+    "GCP_ENVIRONMENT_ENABLED": os.environ.get("GCP_ENVIRONMENT_ENABLED", "false"),
+    "TRACING_ENABLED": os.environ.get("TRACING_ENABLED", "false"),
+    "WARMUP_ENABLED": "false",
+}
+
+
+def wait_until_ready(url, timeout=30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if httpx.get(url).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise TimeoutError(f"Server not ready at {url}")
+
+
+def wpswatch_stats(url) -> dict:
+    return httpx.get(f"{url}/_stats").json()
+
+
+def run_client(url, envelopes, concurrency, start_at, duration, results):
+    async def main():
+        latencies = []
+        throttled = 0
+        errors = 0
+        sent_ids = {}
+        pending = itertools.cycle(envelopes)
+        limits = httpx.Limits(max_connections=concurrency)
+        async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+
+            async def worker():
+                nonlocal throttled, errors
+                while time.time() < start_at + duration:
+                    envelope = refresh(next(pending), sent_ids)
+                    start = time.perf_counter()
+                    try:
+                        response = await client.post(
+                            url, headers=envelope["headers"], json=envelope["body"]
+                        )
+                    except httpx.HTTPError:
+                        errors += 1
+                        continue
+                    if response.status_code in THROTTLED_STATUS_CODES:
+                        throttled += 1
+                    elif response.is_error:
+                        errors += 1
+                    else:
+                        latencies.append(time.perf_counter() - start)
+
+            await asyncio.sleep(max(start_at - time.time(), 0))
+            await asyncio.gather(*[worker() for _ in range(concurrency)])
+        return latencies, throttled, errors
+
+    results.put(asyncio.run(main()))
+
+
+def measure(args, envelopes, workers, loop, http):
+    env = {
+        **ENV,
+        "PORT": str(args.port),
+        "SERVER_WORKERS": str(workers),
+        "SERVER_LOOP": loop,
+        "SERVER_HTTP": http,
+    }
+    server = subprocess.Popen(
+        [sys.executable, "-m", "app.serve"],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    url = f"http://localhost:{args.port}/"
+    try:
+        wait_until_ready(url)  # Health check
+        uploads_before = wpswatch_stats(args.wpswatch_url).get("uploads", 0)
+        results = multiprocessing.Queue()
+        start_at = time.time() + 1.0  # Clients start together
+        clients = [
+            multiprocessing.Process(
+                target=run_client,
+                args=(
+                    url,
+                    envelopes,
+                    args.concurrency,
+                    start_at,
+                    args.duration,
+                    results,
+                ),
+            )
+            for _ in range(args.clients)
+        ]
+        for client in clients:
+            client.start()
+        outcomes = [results.get() for _ in clients]
+        for client in clients:
+            client.join()
+        uploads = wpswatch_stats(args.wpswatch_url).get("uploads", 0) - uploads_before
+    finally:
+        server.terminate()
+        server.wait()
+    latencies = sorted(latency for client, _, _ in outcomes for latency in client)
+    throttled = sum(throttled for _, throttled, _ in outcomes)
+    errors = sum(errors for _, _, errors in outcomes)
+    p99 = latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0.0
+    return (
+        len(latencies) / args.duration,
+        p99,
+        uploads / args.duration,
+        throttled,
+        errors,
+    )
+
+
+def start_wpswatch(args):
+    port = urlparse(args.wpswatch_url).port
+    wpswatch = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "app.tests.fake_wpswatch",
+            "--port",
+            str(port),
+            "--latency",
+            args.wpswatch_latency,
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    wait_until_ready(f"{args.wpswatch_url}/_stats")
+    return wpswatch
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument(
+        "--stacks",
+        nargs="+",
+        default=["uvloop/httptools"],
+        help="Event loop and HTTP parser, as loop/http",
+    )
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument(
+        "--mix",
+        default="event=1,attachment=1,camera_trap=1",
+        help="Weighted message kinds to synthesize, as in benchmarks.push_replay",
+    )
+    parser.add_argument("--recorded", help="JSON lines file with recorded requests")
+    parser.add_argument("--port", type=int, default=8181)
+    parser.add_argument(
+        "--wpswatch-url",
+        help="WPS Watch site the destinations point at (a fake one is started if not set)",
+    )
+    parser.add_argument("--wpswatch-latency", default="constant:0.05")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    if args.recorded:
+        envelopes = load_recorded(args.recorded)
+    else:
+        kinds = parse_mix(args.mix)
+        random.shuffle(kinds)
+        envelopes = [synthesize(kind) for kind in kinds]
+    wpswatch = None
+    if not args.wpswatch_url:
+        args.wpswatch_url = "http://localhost:8282"
+        wpswatch = start_wpswatch(args)
+    print(
+        f"{args.clients} client processes x {args.concurrency} requests in flight, "
+        f"{args.duration}s per run, {os.cpu_count()} CPUs, uploading to {args.wpswatch_url}"
+    )
+    print(
+        f"{'stack':<20}{'workers':>8}{'req/s':>10}{'p99 ms':>10}"
+        f"{'uploads/s':>11}{'throttled':>11}{'errors':>8}"
+    )
+    try:
+        for stack in args.stacks:
+            loop, http = stack.split("/")
+            for workers in args.workers:
+                throughput, p99, uploads, throttled, errors = measure(
+                    args, envelopes, workers, loop, http
+                )
+                print(
+                    f"{stack:<20}{workers:>8}{throughput:>10.0f}{p99:>10.1f}"
+                    f"{uploads:>11.0f}{throttled:>11}{errors:>8}"
+                )
+    finally:
+        if wpswatch:
+            wpswatch.terminate()
+            wpswatch.wait()
+
+
+if __name__ == "__main__":
+    main()